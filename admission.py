@@ -0,0 +1,101 @@
+# admission.py
+import asyncio, heapq, itertools, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Kiểm soát nhận call MCP (admission control) trong loop nền của MCPBridge:
+# - PriorityLimiter = semaphore có hàng đợi giới hạn: tối đa `limit` call chạy cùng lúc,
+#   tối đa `max_queue` call chờ; hàng đợi đầy → từ chối ngay (AdmissionRejected, không treo caller)
+# - slot trống được trao cho waiter ưu tiên cao nhất (high < normal < low), cùng mức → FIFO
+#   → tool nặng (doc search) để "low" không chặn được tool nhanh (balance) để "high"
+# Chỉ dùng trong 1 event loop (không thread-safe) — bridge gọi từ loop nền.
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+def priority_of(name: Any, default: int = PRIORITIES["normal"]) -> int:
+    """"high"/"normal"/"low" hoặc số (nhỏ = ưu tiên hơn) → số."""
+    if isinstance(name, (int, float)) and not isinstance(name, bool):
+        return int(name)
+    return PRIORITIES.get(str(name or "").lower(), default)
+
+
+class AdmissionRejected(Exception):
+    """Call bị từ chối trước khi tới server: reason "full" (hàng đợi đầy) hoặc "timeout" (chờ quá lâu)."""
+
+    def __init__(self, reason: str, queued: int):
+        super().__init__(f"queue {reason} ({queued} waiting)")
+        self.reason = reason
+        self.queued = queued
+
+
+class PriorityLimiter:
+    """limit <= 0 = không giới hạn chạy đồng thời (vẫn đếm active); max_queue < 0 = hàng đợi không giới hạn."""
+
+    def __init__(self, limit: int = 0, max_queue: int = 64, on_change: Optional[Callable[[], None]] = None):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.on_change = on_change     # cập nhật gauge active/queued
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _p, _s, f in self._heap if not f.done())
+
+    def _has_room(self) -> bool:
+        return self.limit <= 0 or self.active < self.limit
+
+    async def acquire(self, priority: int = PRIORITIES["normal"], timeout: Optional[float] = None) -> float:
+        """Chờ tới lượt; trả số giây đã chờ. Hủy (caller timeout) → rời hàng, không chiếm slot."""
+        if self._has_room() and not self.queued:
+            self.active += 1
+            self._changed()
+            return 0.0
+        queued = self.queued
+        if 0 <= self.max_queue <= queued:
+            raise AdmissionRejected("full", queued)
+        if len(self._heap) > 2 * queued + 32:   # dọn entry của waiter đã hủy / hết hạn
+            self._heap = [e for e in self._heap if not e[2].done()]
+            heapq.heapify(self._heap)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), fut))
+        self._changed()
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout if timeout and timeout > 0 else None)
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                return time.monotonic() - t0    # vừa được trao slot đúng lúc hết hạn → dùng luôn
+            fut.cancel()
+            self._changed()
+            raise AdmissionRejected("timeout", self.queued)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release()                  # đã được trao slot nhưng caller bị hủy → trả lại
+            else:
+                fut.cancel()
+                self._changed()
+            raise
+        return time.monotonic() - t0
+
+    def release(self) -> None:
+        self.active = max(0, self.active - 1)
+        self.wake()
+
+    def wake(self) -> None:
+        """Trao slot trống cho waiter ưu tiên nhất (gọi cả khi limit được nới lúc reload)."""
+        while self._heap and self._has_room():
+            _p, _s, fut = heapq.heappop(self._heap)
+            if fut.done():
+                continue                        # waiter đã hủy / hết hạn
+            self.active += 1
+            fut.set_result(None)
+        self._changed()
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change()
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "limit": self.limit, "queued": self.queued, "max_queue": self.max_queue}
@@ -0,0 +1,225 @@
+# artifact_store.py
+import os, re, hashlib, tempfile, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import METRICS
+
+# Kho file sinh ra khi trả lời (ảnh bảng PNG, ảnh MCP base64, result MCP spill ra đĩa).
+# - tên file content-addressed: <prefix>_<sha256[:20]><suffix> → cùng nội dung = cùng file,
+#   render đồng thời không bao giờ đè nhau (ghi file tạm rồi os.replace)
+# - retention: xoá file cũ hơn max_age; tổng dung lượng > max_bytes → xoá file cũ nhất tới ~90%
+#   (file mới hơn keep_recent giây không bị xoá theo dung lượng: có thể đang chờ gửi Telegram)
+# - sweeper nền (daemon thread) chạy mỗi sweep_interval giây, tự bật ở lần ghi đầu tiên
+# Metric: artifact_bytes / artifact_files (gauge), artifact_writes, artifact_dedup_hits,
+#         artifact_evicted{reason=age|size}
+#
+# Env: ARTIFACT_DIR (out_images), ARTIFACT_MAX_MB (256), ARTIFACT_MAX_AGE (21600s),
+#      ARTIFACT_SWEEP_INTERVAL (60s; 0 = không chạy nền, vẫn dọn khi vượt dung lượng)
+
+_TMP_PREFIX = ".tmp_"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _safe_prefix(prefix: Optional[str]) -> str:
+    # chỉ giữ tên gốc (bỏ thư mục, đuôi, ký tự lạ) → không ghi ra ngoài thư mục kho
+    stem = os.path.splitext(os.path.basename(prefix or ""))[0]
+    stem = re.sub(r"[^A-Za-z0-9_-]", "_", stem).strip("_")[:40]
+    return stem or "artifact"
+
+
+class ArtifactWriter:
+    """Ghi dần vào file tạm + băm song song; close() đổi tên sang tên content-addressed."""
+
+    def __init__(self, store: "ArtifactStore", prefix: str, suffix: str):
+        self._store = store
+        self._prefix = _safe_prefix(prefix)
+        self._suffix = suffix
+        self._hash = hashlib.sha256()
+        fd, self._tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=store.root)
+        self._f = os.fdopen(fd, "wb")
+        self.size = 0
+        self.path: Optional[str] = None
+
+    def write(self, b: bytes) -> None:
+        self._f.write(b)
+        self._hash.update(b)
+        self.size += len(b)
+
+    def close(self) -> str:
+        if self.path is None:
+            self._f.close()
+            name = f"{self._prefix}_{self._hash.hexdigest()[:20]}{self._suffix}"
+            self.path = self._store._commit(self._tmp, name, self.size)
+        return self.path
+
+    def abort(self) -> None:
+        self._f.close()
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+    def __enter__(self) -> "ArtifactWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ArtifactStore:
+    """Thư mục file tạm có giới hạn tuổi + dung lượng. Thread-safe."""
+
+    def __init__(self, root: str = "out_images", max_bytes: int = 256 * 1024 * 1024,
+                 max_age: float = 6 * 3600, sweep_interval: float = 60.0, keep_recent: float = 60.0):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max(1024 * 1024, int(max_bytes))
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.keep_recent = keep_recent
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None   # ước lượng tổng byte (None = chưa quét lần nào)
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls) -> "ArtifactStore":
+        return cls(
+            root=os.getenv("ARTIFACT_DIR", "out_images"),
+            max_bytes=int(_env_float("ARTIFACT_MAX_MB", 256) * 1024 * 1024),
+            max_age=_env_float("ARTIFACT_MAX_AGE", 6 * 3600),
+            sweep_interval=_env_float("ARTIFACT_SWEEP_INTERVAL", 60),
+        )
+
+    # ---------- ghi ----------
+    def writer(self, prefix: str = "artifact", suffix: str = "") -> ArtifactWriter:
+        os.makedirs(self.root, exist_ok=True)
+        self._ensure_sweeper()
+        return ArtifactWriter(self, prefix, suffix)
+
+    def put_bytes(self, data: bytes, prefix: str = "artifact", suffix: str = "") -> str:
+        """Lưu bytes, trả path tuyệt đối (đã có file cùng nội dung → dùng lại)."""
+        with self.writer(prefix, suffix) as w:
+            w.write(data)
+        return w.path
+
+    def _commit(self, tmp: str, name: str, size: int) -> str:
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            # cùng nội dung đã có → bỏ file tạm, làm mới mtime để retention tính lại từ bây giờ
+            os.remove(tmp)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            METRICS.inc("artifact_dedup_hits")
+            return path
+        os.replace(tmp, path)
+        METRICS.inc("artifact_writes")
+        with self._lock:
+            if self._total is not None:
+                self._total += size
+            over = self._total is None or self._total > self.max_bytes
+        if over:
+            self.sweep()
+        return path
+
+    # ---------- dọn ----------
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        out = []
+        try:
+            with os.scandir(self.root) as it:
+                for e in it:
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    if e.is_file():
+                        out.append((st.st_mtime, st.st_size, e.path))
+        except FileNotFoundError:
+            pass
+        return out
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def sweep(self) -> Dict[str, int]:
+        """Xoá file quá tuổi, rồi file cũ nhất nếu vượt dung lượng. Trả số file đã xoá theo lý do."""
+        with self._lock:
+            now = time.time()
+            files = sorted(self._scan())            # cũ nhất trước
+            evicted = {"age": 0, "size": 0}
+            kept: List[Tuple[float, int, str]] = []
+            for mtime, size, path in files:
+                stale_tmp = os.path.basename(path).startswith(_TMP_PREFIX) and now - mtime > 3600
+                if (self.max_age > 0 and now - mtime > self.max_age) or stale_tmp:
+                    if self._remove(path):
+                        evicted["age"] += 1
+                        continue
+                kept.append((mtime, size, path))
+            total = sum(s for _, s, _ in kept)
+            if total > self.max_bytes:
+                target = int(self.max_bytes * 0.9)
+                rest = []
+                for mtime, size, path in kept:
+                    if total > target and now - mtime > self.keep_recent and self._remove(path):
+                        evicted["size"] += 1
+                        total -= size
+                        continue
+                    rest.append((mtime, size, path))
+                kept = rest
+            self._total = total
+        for reason, n in evicted.items():
+            if n:
+                METRICS.inc("artifact_evicted", n, reason=reason)
+        METRICS.set("artifact_bytes", total)
+        METRICS.set("artifact_files", len(kept))
+        if evicted["size"] or evicted["age"]:
+            print(f"[ARTIFACT] swept {evicted['age']} old + {evicted['size']} over-size file(s); "
+                  f"{len(kept)} file(s), {total / 1048576:.1f} MB left", flush=True)
+        return evicted
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is not None or self.sweep_interval <= 0:
+            return
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="artifact-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self) -> None:
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[ARTIFACT] sweep failed: {type(e).__name__}: {e}", flush=True)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            files = self._scan()
+        return {
+            "path": self.root,
+            "files": len(files),
+            "bytes": sum(s for _, s, _ in files),
+            "max_bytes": self.max_bytes,
+            "max_age_s": self.max_age,
+        }
+
+
+ARTIFACTS = ArtifactStore.from_env()
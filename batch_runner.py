@@ -0,0 +1,157 @@
+# batch_runner.py
+"""
+Trả lời hàng loạt câu hỏi offline (FAQ, regression check, digest hằng ngày).
+
+    python batch_runner.py questions.jsonl -o answers.jsonl -c 8 --timeout 90
+
+Input JSONL, mỗi dòng: {"id": "...", "question": "...", "session_id": "..." (tuỳ chọn)}
+  (chấp nhận "q"/"text" thay cho "question").
+Output JSONL, mỗi dòng: {"id", "question", "answer", "images", "latency_s", "usage", "error"}
+
+Mọi item dùng chung 1 instance chatbot → chung MCP bridge, cache, retry/circuit breaker.
+Test offline: --base-url http://127.0.0.1:8089 (xem fake_anthropic.py) hoặc --fake.
+"""
+import argparse, json, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List
+
+from deadline import Deadline
+
+# item trả về quá deadline bấy nhiêu giây → ghi lỗi timeout (Deadline không cắt được bước nào đó)
+_DEADLINE_GRACE = 5.0
+
+
+def _read_items(path: str) -> List[Dict[str, Any]]:
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except Exception as e:
+                print(f"[BATCH] skip line {i}: {e}", file=sys.stderr)
+                continue
+            q = obj.get("question") or obj.get("q") or obj.get("text")
+            if not q:
+                print(f"[BATCH] skip line {i}: no question", file=sys.stderr)
+                continue
+            items.append({"id": obj.get("id", i), "question": q, "session_id": obj.get("session_id")})
+    return items
+
+
+def _run_one(llm, item: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+    """
+    Chạy 1 câu hỏi ngay trong worker của pool (không thread phụ bị bỏ lại). `timeout` là deadline
+    của request: LLM/MCP/vẽ bảng tự dừng và trả lời dở dang, nên worker luôn được trả về pool.
+    """
+    sid = item["session_id"] or f"batch-{item['id']}"
+    rv: Dict[str, Any] = {}
+    error = None
+    t0 = time.perf_counter()
+    try:
+        rv = llm.asking_stream(item["question"], session_id=sid, telegram=False, print_live=False,
+                               deadline=Deadline(timeout)) or {}
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    latency = time.perf_counter() - t0
+
+    if not error and rv.get("error"):
+        error = rv["error"]   # vd. "overloaded": bị circuit breaker chặn, text chỉ là thông báo quá tải
+    elif not error and rv.get("timed_out"):
+        error = f"deadline exceeded at {', '.join(rv['timed_out'])}"
+    elif not error and timeout > 0 and latency > timeout + _DEADLINE_GRACE:
+        error = f"timeout after {timeout:.0f}s"
+    if not item["session_id"]:
+        llm.reset(sid)  # session tạm → giải phóng bộ nhớ
+    return {
+        "id": item["id"],
+        "question": item["question"],
+        "answer": rv.get("text", ""),
+        "images": rv.get("images", []),
+        "latency_s": round(latency, 3),
+        "usage": rv.get("usage") or {},
+        "error": error,
+    }
+
+
+def _pct(vals: List[float], p: float) -> float:
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1))))]
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Bulk question answering with bounded concurrency")
+    ap.add_argument("input", help="JSONL câu hỏi")
+    ap.add_argument("-o", "--output", default="answers.jsonl", help="JSONL kết quả ('-' = stdout)")
+    ap.add_argument("-c", "--concurrency", type=int, default=4)
+    ap.add_argument("--timeout", type=float, default=120.0, help="timeout mỗi item (giây, 0 = không giới hạn)")
+    ap.add_argument("--model", default=os.getenv("BATCH_MODEL", "claude-3-7-sonnet-20250219"))
+    ap.add_argument("--base-url", default=None, help="Anthropic base URL (vd. fake server local)")
+    ap.add_argument("--fake", action="store_true", help="tự chạy fake_anthropic.py trong process")
+    ap.add_argument("--limit", type=int, default=0, help="chỉ chạy N item đầu")
+    a = ap.parse_args(argv)
+
+    fake_srv = None
+    if a.fake:
+        from fake_anthropic import serve
+        fake_srv = serve(port=0, tool_use=True)
+        threading.Thread(target=fake_srv.serve_forever, daemon=True).start()
+        a.base_url = f"http://127.0.0.1:{fake_srv.server_address[1]}"
+    if a.base_url:
+        os.environ["ANTHROPIC_BASE_URL"] = a.base_url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "fake-key")
+
+    items = _read_items(a.input)
+    if a.limit > 0:
+        items = items[:a.limit]
+    if not items:
+        print("[BATCH] no items.", file=sys.stderr)
+        return 1
+
+    from chatbot import chatbot  # import muộn: env (base URL) phải set trước khi tạo client
+    llm = chatbot(a.model)
+
+    out = sys.stdout if a.output == "-" else open(a.output, "w", encoding="utf-8")
+    write_lock = threading.Lock()
+    latencies: List[float] = []
+    errors = 0
+    tokens = {"input_tokens": 0, "output_tokens": 0}
+    t_start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, a.concurrency), thread_name_prefix="batch") as ex:
+            futs = [ex.submit(_run_one, llm, it, a.timeout) for it in items]
+            for fut in as_completed(futs):
+                res = fut.result()
+                with write_lock:
+                    out.write(json.dumps(res, ensure_ascii=False) + "\n")
+                    out.flush()
+                latencies.append(res["latency_s"])
+                if res["error"]:
+                    errors += 1
+                for k in tokens:
+                    tokens[k] += int(res["usage"].get(k, 0) or 0)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if fake_srv is not None:
+            fake_srv.shutdown()
+
+    wall = time.perf_counter() - t_start
+    print(
+        f"[BATCH] {len(items)} items in {wall:.1f}s ({len(items) / wall:.2f}/s), errors={errors}, "
+        f"p50={_pct(latencies, 50):.2f}s p95={_pct(latencies, 95):.2f}s, "
+        f"tokens in={tokens['input_tokens']} out={tokens['output_tokens']}",
+        file=sys.stderr,
+    )
+    pf = llm.prefetcher.stats()
+    if pf["started"]:
+        print(f"[BATCH] prefetch started={pf['started']:.0f} hits={pf['hits']:.0f} hit_rate={pf['hit_rate']:.0%}", file=sys.stderr)
+    return 0 if errors == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
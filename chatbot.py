@@ -1,12 +1,18 @@
 # chatbot.py
-import os, re, anthropic, json
+import os, re, anthropic, json, httpx
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from typing import Any, Dict, List, Optional
 from tools import get_tools, run_client_tool
 from mcp_bridge import MCPBridge  # dùng MCP server(s) có sẵn
-from anthropic import APIStatusError
-import random, time 
+from llm_retry import RETRY, OverloadedError
+from llm_http import shared_http
+from model_router import ModelRouter
+import postprocess as pp
+from result_compactor import compact_text, apply_token_budget
+from prefetch import Prefetcher, PrefetchSet
+from deadline import Deadline, DeadlineExceeded
+from metrics import METRICS
 import ast 
-from urllib.parse import urlparse, parse_qs, unquote
 from datetime import datetime, timezone
 def _now_str():
     now = datetime.now().astimezone()
@@ -24,6 +30,7 @@ SYSTEM_PROMPT = (
     [Runtime]
     now: {_now_str()}"""
 )
+OVERLOADED_TEXT = "🚥 Model đang quá tải. Hãy thử lại sau ít phút."
 import json
 # ---------------- Memory (per chat/session) ----------------
 class _Memory:
@@ -43,185 +50,41 @@ class chatbot:
         self.model = model
         self.mem = _Memory()
         # web_search (server tool) bật qua header beta
+        # pool HTTP dùng chung + warm-up (llm_http.py); timeout lấy theo pool
+        self.http = shared_http()
         self.client = anthropic.Anthropic(
             api_key=os.environ["ANTHROPIC_API_KEY"],
-            default_headers={"anthropic-beta": "web-search-2025-03-05"}
+            default_headers={"anthropic-beta": "web-search-2025-03-05"},
+            http_client=self.http.client,
+            timeout=self.http.timeout,
         )
         # window & tóm tắt
         self.MAX_TURNS = 14
         self.KEEP_TURNS = 6
+        # ngân sách token cho toàn bộ tool result trong 1 lượt (trước vòng 2)
+        self.TOOL_RESULT_BUDGET = int(os.getenv("TOOL_RESULT_TOKEN_BUDGET", "6000"))
+        # retry/backoff + circuit breaker dùng chung toàn process (llm_retry.py)
+        self.retry = RETRY
+        # chọn model theo tier (summary/intent/tool_args/answer) — cấu hình qua env MODEL_ROUTES
+        self.router = ModelRouter.from_env(model)
         # MCP bridge (từ file riêng mcp_bridge.py)
         # Đổi "mcp.json" -> "mcp.sei.json" nếu file của bạn tên khác
         self.mcp = MCPBridge("mcp.json")
-        self.mcp.start()  # nếu không có/khởi tạo lỗi → export 0 tool, chatbot vẫn chạy
-        print("[MCP] tools:", [t["name"] for t in self.mcp.anthropic_tools()])
+        # khởi động nền: không chặn import main.py / đăng ký webhook; lỗi → export 0 tool, chatbot vẫn chạy
+        self.mcp.start_background()
+        # câu hỏi cần MCP chờ tối đa bấy nhiêu giây khi server còn đang khởi động
+        self.MCP_READY_WAIT = float(os.getenv("MCP_READY_WAIT", "8"))
+        # gọi trước tool MCP chắc chắn cần (địa chỉ → balance, tx hash, APR) song song vòng 1
+        self.prefetcher = Prefetcher(self.mcp, enabled=os.getenv("MCP_PREFETCH", "1") != "0")
+        # chỉ gửi k tool MCP liên quan nhất tới câu hỏi (BM25, tool_ranker.py); 0 = gửi hết
+        self.MCP_TOOL_TOP_K = int(os.getenv("MCP_TOOL_TOP_K", "12"))
+        # vẽ bảng PNG chạy ở pool riêng để áp timeout (TABLE_RENDER_TIMEOUT, không quá deadline request)
+        self.RENDER_TIMEOUT = float(os.getenv("TABLE_RENDER_TIMEOUT", "20"))
+        self._render_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="render")
         # detect bảng text để chuyển sang ảnh (fallback)
         self._fence_pat = re.compile(r"```(?:[^\n]*\n)?([\s\S]*?)```", re.MULTILINE)
         self._table_line_pat = re.compile(r"^\s*[\|\+].*[\|\+]\s*$")
         self._sep_line_pat = re.compile(r"^\s*[-=\+\|\s:]+\s*$")
-    def _remove_markdown_images(self, s: str) -> str:
-        """Loại bỏ mọi Markdown image ![alt](url) khỏi text."""
-        if not s:
-            return s
-        s = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', s)
-        return re.sub(r'\n{3,}', '\n\n', s).strip()
-
-    def _extract_apr_value(self, s: str):
-        """
-        Cố tìm 1 số APR % trong đoạn văn (EN/VN).
-        Ví dụ: 'APR is around 10.8%' hoặc 'APR hiện tại ~ 9,76%'.
-        Trả về float hoặc None.
-        """
-        if not s:
-            return None
-        # chuẩn hoá dấu phẩy-dấu chấm
-        ss = s.replace(",", ".")
-        m = re.search(r'(?i)\bapr\b[^0-9]{0,12}([0-9]+(?:\.[0-9]+)?)\s*%', ss)
-        if m:
-            try:
-                return float(m.group(1))
-            except Exception:
-                return None
-        return None
-
-    def _strip_mcp_noise_and_md_images(self, s: str) -> str:
-        """Gộp 2 bước: xoá 'sei:...' & xoá Markdown images."""
-        s = self._strip_mcp_noise(s)
-        s = self._remove_markdown_images(s)
-        return s
-
-    def _remove_markdown_images(self, s: str) -> str:
-        """Xoá mọi Markdown image ![...](...)."""
-        if not s:
-            return s
-        return re.sub(r"!\[[^\]]*\]\([^)]+\)", "", s)
-
-    def _extract_series_tables_from_md_images(self, s: str):
-        """
-        Tìm các Markdown image có tham số series=[...] trong URL (đồ thị),
-        trích thành bảng Date, APR (%) để vẽ ảnh local.
-        Return: list[ {columns, rows, code_block} ]
-        """
-        out = []
-        if not s:
-            return out
-        for m in re.finditer(r"!\[[^\]]*\]\(([^)]+)\)", s):
-            url = m.group(1)
-            try:
-                pr = urlparse(url)
-            except Exception:
-                continue
-            qs = parse_qs(pr.query or "")
-            raw_series = (qs.get("series") or [None])[0]
-            if not raw_series:
-                continue
-            try:
-                arr = json.loads(unquote(raw_series))
-                # kỳ vọng dạng [{"name":"...","data":[{"x":"2024-01-01","y":11.2}, ...]}]
-                if not isinstance(arr, list) or not arr:
-                    continue
-                series0 = arr[0] or {}
-                data = series0.get("data") or []
-                rows = []
-                for pt in data:
-                    x = pt.get("x")
-                    y = pt.get("y")
-                    if x is None or y is None:
-                        continue
-                    try:
-                        yv = float(y)
-                    except Exception:
-                        continue
-                    rows.append([str(x), f"{yv:.2f}"])
-                if rows:
-                    out.append({
-                        "columns": ["Date", "APR (%)"],
-                        "rows": rows,
-                        "code_block": m.group(0)   # nguyên cụm ![...](...)
-                    })
-            except Exception:
-                continue
-        return out
-    def _strip_mcp_noise(self, s: str) -> str:
-        """
-        Xoá các dòng gọi MCP trần kiểu 'sei:xxx' hoặc 'sei:xxx(...)' / 'sei_xxx(...)'.
-        """
-        if not s:
-            return s
-        out_lines = []
-        pat = re.compile(r'^\s*(sei[:_][\w:]+)\s*(\([^)]*\))?\s*$', re.I)
-        for ln in s.splitlines():
-            if pat.match(ln.strip()):
-                continue
-            out_lines.append(ln)
-        s = "\n".join(out_lines)
-        return re.sub(r"\n{3,}", "\n\n", s).strip()
-
-    def _iter_code_fences(self, text: str):
-        """
-        Duyệt toàn bộ code fences dạng ```...```, trả về nguyên block (kể cả ```).
-        """
-        if not text:
-            return
-        for m in re.finditer(r"```[\s\S]*?```", text):
-            yield m.group(0)
-
-    def _remove_matplotlib_blocks(self, text: str) -> str:
-        """
-        Bỏ các code block có chứa matplotlib/pandas (không thực thi).
-        """
-        if not text:
-            return text
-        out = text
-        for blk in list(self._iter_code_fences(text)):
-            low = blk.lower()
-            if "matplotlib" in low or "plt." in low or "pandas" in low:
-                out = out.replace(blk, "")
-        return re.sub(r"\n{3,}", "\n\n", out).strip()
-
-    def _extract_apr_from_python(self, code_block: str):
-        """
-        Tìm current_apr = 9.76 trong code python để dựng bảng ảnh đơn giản.
-        """
-        m = re.search(r'current_apr\s*=\s*([0-9]+(?:\.[0-9]+)?)', code_block)
-        if not m:
-            return None
-        try:
-            return float(m.group(1))
-        except Exception:
-            return None
-
-    def _extract_make_table_image_args_from_text(self, s: str):
-        """
-        Bắt make_table_image({...}) nếu model lỡ in ra text thay vì gọi tool.
-        Hỗ trợ 'headers'→'columns'.
-        """
-        if not s:
-            return None
-        m = re.search(r"make_table_image\s*\(\s*(\{[\s\S]*?\})\s*\)", s, re.I)
-        if not m:
-            return None
-        raw_obj = m.group(1)
-        try:
-            payload = json.loads(raw_obj)
-        except Exception:
-            try:
-                payload = json.loads(re.sub(r"'", '"', raw_obj))
-            except Exception:
-                return None
-        cols = payload.get("columns") or payload.get("headers") or []
-        rows = payload.get("rows") or payload.get("data") or []
-        return {
-            "columns": [str(c) for c in cols],
-            "rows": rows,
-            "title": payload.get("title"),
-            "theme": payload.get("theme", "light"),
-            "font_size": int(payload.get("font_size", 18)),
-            "cell_padding": payload.get("cell_padding", [16, 10]),
-            "code_block": m.group(0),
-        }
-
-
     # ---------------- public ----------------
     def _normalize_tool_def(self, t: dict) -> dict:
         """Đảm bảo mọi tool đều có 'name' nhất quán để khử trùng theo tên."""
@@ -249,20 +112,109 @@ class chatbot:
             seen.add(key)
             out.append(tt)
         return out
-    def _is_overloaded(self, e: Exception) -> bool:
-        s = str(e).lower()
-        if "overloaded" in s or "rate limit" in s or "temporarily" in s:
-            return True
-        # Thêm bắt theo class APIStatusError (nếu body có type)
-        if isinstance(e, APIStatusError):
+    def _llm_kwargs(self, tier: str, temperature: Optional[float] = 0.7) -> Dict[str, Any]:
+        """model/max_tokens/temperature cho 1 lời gọi Anthropic theo tier của router."""
+        kw = self.router.route(tier)
+        if temperature is not None:
+            kw.setdefault("temperature", temperature)
+        return kw
+
+    def _is_chitchat(self, q: str, *, allow_mcp: bool, allow_web: bool, want_docs: bool) -> bool:
+        """Câu ngắn, không cần MCP/web/docs (chào hỏi, cảm ơn...) → đi tier 'intent' rẻ hơn."""
+        return len(q) <= 60 and not (allow_mcp or allow_web or want_docs) and "bảng" not in q and "table" not in q
+
+    def _client_for(self, dl: Optional[Deadline]):
+        """
+        Client Anthropic với timeout httpx = min(timeout pool, thời gian còn lại của request).
+        Có deadline → tắt retry nội bộ của SDK (mỗi lần thử lại lấy trọn timeout → vượt deadline);
+        quá tải, lỗi kết nối và 5xx được RetryEngine thử lại trong hạn (llm_retry.is_transient).
+        """
+        t = dl.clamp(self.http.timeout.read) if dl is not None else None
+        if t is None or t == self.http.timeout.read:
+            return self.client
+        return self.client.with_options(
+            timeout=httpx.Timeout(t, connect=min(t, self.http.timeout.connect)),
+            max_retries=0,
+        )
+
+    def _run_table_tool(self, args: Dict[str, Any], dl: Optional[Deadline] = None) -> Optional[str]:
+        """run_client_tool('make_table_image') có giới hạn thời gian; quá hạn → None (thread render bị bỏ lại)."""
+        if dl is not None and dl.expired():
+            dl.expire("render")
+            return None
+        t = dl.clamp(self.RENDER_TIMEOUT) if dl is not None else (self.RENDER_TIMEOUT or None)
+        fut = self._render_pool.submit(run_client_tool, "make_table_image", args)
+        try:
+            return fut.result(t)
+        except FutureTimeout:
+            fut.cancel()
+            if dl is not None and dl.expired():
+                dl.expire("render")
+            else:
+                METRICS.inc("table_render_timeouts")
+                print(f"[RENDER] make_table_image timed out after {t:g}s", flush=True)
+            return None
+
+    def _add_usage(self, acc: Optional[Dict[str, int]], resp) -> None:
+        """Cộng dồn usage (input/output tokens) của 1 response Anthropic vào acc."""
+        u = getattr(resp, "usage", None)
+        if acc is None or u is None:
+            return
+        acc["input_tokens"] += int(getattr(u, "input_tokens", 0) or 0)
+        acc["output_tokens"] += int(getattr(u, "output_tokens", 0) or 0)
+
+    def _stream_answer(self, system_txt: str, messages: List[Dict[str, Any]], tools: List[Dict[str, Any]], _emit,
+                       tier: str = "answer", usage: Optional[Dict[str, int]] = None,
+                       deadline: Optional[Deadline] = None) -> str:
+        """
+        Stream 1 lượt trả lời, lọc rác ngay khi stream, emit text_delta. Trả về text đã lọc.
+        Hết deadline giữa chừng → dừng stream, trả phần đã nhận (stage 'llm_stream').
+        """
+        stream_text_acc = ""
+        last_emitted = ""
+        with self.router.timed(tier), self._client_for(deadline).beta.messages.stream(
+            **self._llm_kwargs(tier),
+            system=system_txt,
+            tools=tools,
+            messages=messages,
+        ) as stream:
+            cut = False
             try:
-                body = e.body if hasattr(e, "body") else None
-                err = (body or {}).get("error") or {}
-                if (err.get("type") or "").lower() == "overloaded_error":
-                    return True
-            except Exception:
-                pass
-        return False
+                for ev in stream:
+                    if deadline is not None and deadline.expired():
+                        cut = True
+                        break
+                    if getattr(ev, "type", "") == "content_block_delta" and hasattr(ev, "delta") and getattr(ev.delta, "text", None):
+                        piece = ev.delta.text or ""
+                        stream_text_acc += piece
+
+                        # chặn dòng MCP đơn
+                        stream_text_acc = re.sub(r'(?m)^\s*sei[:_][\w:]+(\([^)]*\))?\s*$','', stream_text_acc)
+                        # chặn markdown image
+                        stream_text_acc = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', stream_text_acc)
+
+                        # chỉ emit phần mới sau khi đã lọc
+                        new_chunk = stream_text_acc[len(last_emitted):]
+                        if new_chunk:
+                            _emit({"type": "text_delta", "text": new_chunk})
+                            last_emitted = stream_text_acc
+            except Exception as e:
+                # read timeout do deadline kẹp lại → giữ phần đã stream; lỗi khác → raise như cũ
+                timed_out = isinstance(e, (anthropic.APITimeoutError, httpx.TimeoutException))
+                if not (timed_out and deadline is not None and deadline.expired()):
+                    if last_emitted:
+                        e.partial_output = True   # đã emit 1 phần → RetryEngine không thử lại (tránh lặp text)
+                    raise
+                cut = True
+            if cut:
+                deadline.expire("llm_stream")
+            elif usage is not None:
+                try:
+                    self._add_usage(usage, stream.get_final_message())
+                except Exception:
+                    pass
+        return stream_text_acc.strip()
+
     def reset(self, session_id: str):
         self.mem.clear(session_id)
         
@@ -274,11 +226,14 @@ class chatbot:
         telegram: bool = True,
         sink=None,                 # callback đẩy event ra UI (tuỳ chọn)
         print_live: bool = True,   # mặc định: in realtime ra terminal
+        deadline: Optional[Deadline] = None,  # hạn chót của request (LLM, MCP, vẽ bảng); None = không giới hạn
     ) -> Dict[str, Any]:
         """
         Stream trực tiếp trong hàm (không cần iterate bên ngoài).
         Tự quyết định khi nào dùng tool/MCP dựa trên nội dung câu hỏi.
-        Trả về: {"text": final_text, "images": [...]}
+        Trả về: {"text": final_text, "images": [...], "usage": {"input_tokens", "output_tokens"},
+                 "timed_out": [stage, ...]}
+        Hết deadline → câu trả lời dở dang được chốt kèm ghi chú bước nào quá hạn.
 
         Event cho UI (nếu có sink):
         - {"type":"tool_call", "name": str, "args": dict}
@@ -287,7 +242,7 @@ class chatbot:
         - {"type":"done", "final_text": str, "images": [str]}
         """
         store = self.mem.get(session_id)
-        mcp_tools = self.mcp.anthropic_tools()
+        dl = deadline or Deadline()
 
         # ---------- emit helper ----------
         def _emit(ev: Dict[str, Any]):
@@ -332,10 +287,22 @@ class chatbot:
                 "changelog", "thay đổi", "gần đây", "recent", "tăng/giảm", "volume",
             ]
             return any(tok in q_ for tok in recency_markers)
+
+        # MCP khởi động nền: câu cần MCP chờ ngắn, hết hạn thì trả lời không có dữ liệu live.
+        # Tool được publish ngay khi từng server lên → đã có tool thì không chờ server chậm còn lại.
+        mcp_pending = False
+        if _need_mcp(q) and not self.mcp.is_ready() and not self.mcp.anthropic_tools():
+            _emit({"type": "tool_result", "name": "system", "text": "⏳ MCP đang khởi động, chờ giây lát..."})
+            mcp_pending = not self.mcp.wait_ready(dl.clamp(self.MCP_READY_WAIT) if self.MCP_READY_WAIT > 0 else 0)
+            if mcp_pending and dl.expired():
+                dl.expire("mcp_wait")
+        mcp_tools = self.mcp.anthropic_tools()
         explicit_tool = self._explicit_mcp_tool(q, mcp_tools)
         allow_mcp = (_need_mcp(q) and bool(mcp_tools)) or bool(explicit_tool)
         allow_web = _need_web(q)
         allow_client_table = True  # luôn cho phép vẽ bảng khi model chủ động gọi
+        want_docs = self._need_docs(q)
+        cheap = self._is_chitchat(q, allow_mcp=allow_mcp, allow_web=allow_web, want_docs=want_docs)
 
         # ---------- “Tôi vừa hỏi gì?” ----------
         if self._is_ask_last_question(message):
@@ -349,20 +316,14 @@ class chatbot:
         system_txt = SYSTEM_PROMPT
         if store["summary"]:
             system_txt += "\n\n[Conversation summary]\n" + store["summary"]
+        if mcp_pending:
+            system_txt += (
+                "\n\n[MCP status]\nSome MCP servers are still starting up; their tools are not available yet. "
+                "If live on-chain data is needed, say it is temporarily unavailable and ask the user to retry shortly."
+            )
 
-        want_docs = self._need_docs(q)
         user_msg = {"role": "user", "content": [{"type": "text", "text": message}]}
-        if mcp_tools and allow_mcp:
-            # chỉ preview khi thực sự cho dùng MCP
-            preview = []
-            for t in mcp_tools[:16]:
-                if self._is_doc_search_tool(t.get("name"), t.get("description")) and not want_docs:
-                    continue
-                desc = (t.get("description") or "").strip()
-                preview.append(f"- {t['name']}" + (f": {desc}" if desc else ""))
-            if preview:
-                system_txt += "\n\n[Available MCP tools]\n" + "\n".join(preview)
-        
+
         # ===== Chọn tools =====
 # ===== Chọn tools (chuẩn, không trùng) =====
         local_tools_all = get_tools()
@@ -383,10 +344,12 @@ class chatbot:
         # 2) Lọc MCP tools một lần (nếu cho phép)
         filtered_mcp: List[Dict[str, Any]] = []
         if allow_mcp:
-            for t in mcp_tools:
-                if self._is_doc_search_tool(t.get("name"), t.get("description")) and not want_docs:
-                    continue
-                filtered_mcp.append(t)
+            allowed = [t for t in mcp_tools
+                       if want_docs or not self._is_doc_search_tool(t.get("name"), t.get("description"))]
+            filtered_mcp = self._rank_mcp_tools(message, allowed, explicit_tool)
+            if filtered_mcp:
+                # chỉ preview khi thực sự cho dùng MCP; chỉ tên — description đã nằm trong tool block
+                system_txt += "\n\n[Available MCP tools]\n" + ", ".join(t["name"] for t in filtered_mcp[:16])
 
         # 3) Gộp & khử trùng theo name
         tools = filtered_local + filtered_mcp
@@ -395,30 +358,51 @@ class chatbot:
         if print_live:
             print("[DBG] tools sending:", [t.get("name") for t in tools], flush=True)
 
+        # báo trạng thái quá tải/xếp hàng lên UI (event "⏳ Model quá tải" sẵn có)
+        def _on_wait(label: str):
+            def _cb(attempt: int, attempts: int, delay: float, queued: bool):
+                if queued:
+                    txt = f"⏳ {label} quá tải, đang xếp hàng chờ ~{delay:.0f}s..."
+                else:
+                    txt = f"⏳ {label} quá tải, thử lại lần {attempt+1}/{attempts}..."
+                _emit({"type": "tool_result", "name": "system", "text": txt})
+            return _cb
+
+        usage = {"input_tokens": 0, "output_tokens": 0}
+        # prefetch chạy trên loop MCP trong lúc chờ vòng 1
+        prefetch = self.prefetcher.start(message, filtered_mcp) if (allow_mcp and not cheap) else PrefetchSet()
+        if print_live and len(prefetch):
+            print(f"[PREFETCH] started {len(prefetch)} call(s)", flush=True)
         first = None
-        if tools:
-            _delays = [0.8, 1.6, 3.2, 6.4]
-            for _i, _d in enumerate(_delays, 1):
-                try:
-                    first = self.client.messages.create(
-                        model=self.model,
-                        max_tokens=8000,
-                        temperature=0.7,
-                        system=system_txt,
-                        messages=[*store["turns"], user_msg],
-                        tools=tools,
+        if tools and not dl.timed_out:
+            round1_tier = "intent" if cheap else "tool_args"
+            try:
+                with self.router.timed(round1_tier):
+                    first = self.retry.call(
+                        lambda: self._client_for(dl).messages.create(
+                            **self._llm_kwargs(round1_tier),
+                            system=system_txt,
+                            messages=[*store["turns"], user_msg],
+                            tools=tools,
+                        ),
+                        on_wait=_on_wait("Model"),
+                        deadline=dl,
                     )
-                    break
-                except Exception as e:
-                    if self._is_overloaded(e) and _i < len(_delays):
-                        if sink: sink({"type":"tool_result","name":"system","text":f"⏳ Model quá tải, thử lại lần {_i+1}/{len(_delays)}..."})
-                        time.sleep(_d + random.random()*0.5)
-                        continue
+                self._add_usage(usage, first)
+            except (DeadlineExceeded, anthropic.APITimeoutError):
+                if not dl.expired():
                     raise
+                dl.expire("llm")
+            except OverloadedError:
+                prefetch.discard()
+                txt = OVERLOADED_TEXT
+                _emit({"type": "done", "final_text": txt, "images": []})
+                return {"text": txt, "images": [], "usage": usage, "timed_out": list(dl.stages), "error": "overloaded"}
 
 
         images: List[str] = []
         tool_results: List[Dict[str, Any]] = []
+        structured: List[Any] = []   # "data" của MCP result lượt này → vẽ bảng thẳng từ object, không parse lại text
 
         if first is not None:
             # Tìm tool_use do model đề xuất (chỉ những tool ta vừa cho phép)
@@ -435,7 +419,7 @@ class chatbot:
             for tu in client_tool_uses:
                 args = tu.input or {}
                 _emit({"type": "tool_call", "name": tu.name, "args": args})
-                out_path = run_client_tool("make_table_image", args)
+                out_path = self._run_table_tool(args, dl)
                 if isinstance(out_path, str):
                     images.append(out_path)
                     tool_results.append({
@@ -455,14 +439,23 @@ class chatbot:
 
 
             # ---- Thực thi MCP tool ----
+            text_results: List[Any] = []   # (tool_use, entry) — thu gọn theo ngân sách chung rồi mới gửi
+            outs: List[Any] = []
             for tu in mcp_tool_uses:
-                args = tu.input or {}
-                _emit({"type": "tool_call", "name": tu.name, "args": args})
+                _emit({"type": "tool_call", "name": tu.name, "args": tu.input or {}})
+                outs.append(prefetch.take(tu.name, tu.input or {}, timeout=dl.clamp(self.mcp.call_timeout), deadline=dl))
+            # các tool chưa có kết quả prefetch → chạy song song (chung 1 timeout)
+            misses = [i for i, o in enumerate(outs) if o is None]
+            if misses:
                 try:
-                    out = self.mcp.exec_tool(tu.name, args)
+                    ran = self.mcp.exec_tools([(mcp_tool_uses[i].name, mcp_tool_uses[i].input or {}) for i in misses],
+                                              deadline=dl)
                 except Exception as e:
-                    out = {"text": f"[MCP] exec_tool raised: {type(e).__name__}: {e}"}
+                    ran = [{"text": f"[MCP] exec_tool raised: {type(e).__name__}: {e}"}] * len(misses)
+                for i, o in zip(misses, ran):
+                    outs[i] = o
 
+            for tu, out in zip(mcp_tool_uses, outs):
                 if not isinstance(out, dict) or out is None:
                     out = {"text": f"[MCP] invalid result from {tu.name}"}
 
@@ -476,232 +469,115 @@ class chatbot:
                     _emit({"type": "tool_result", "name": tu.name, "image_path": out["image_path"]})
                 else:
                     raw_txt = out.get("text", "[MCP] no text")
-                    # nếu là tool dạng doc-search → làm sạch
-                    txt = self._clean_doc_text(raw_txt) if self._looks_like_doc_tool(tu.name) else raw_txt
+                    data = out.get("data")
+                    policy = self.mcp.compact_policy(tu.name)
+                    # nếu là tool dạng doc-search → làm sạch; còn lại → thu gọn JSON theo policy
+                    if self._looks_like_doc_tool(tu.name):
+                        txt, data = self._clean_doc_text(raw_txt), None
+                    else:
+                        txt = compact_text(raw_txt, policy, data=data)
+                    if data is not None:
+                        structured.append(data)
+                    text_results.append((tu, {"text": txt, "policy": policy, "data": data}))
 
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": tu.id,
-                        "content": [{"type": "text", "text": txt}],
-                    })
-                    _emit({"type": "tool_result", "name": tu.name, "text": txt})
+            apply_token_budget([e for _, e in text_results], self.TOOL_RESULT_BUDGET)
+            for tu, e in text_results:
+                tool_results.append({
+                    "type": "tool_result",
+                    "tool_use_id": tu.id,
+                    "content": [{"type": "text", "text": e["text"]}],
+                })
+                _emit({"type": "tool_result", "name": tu.name, "text": e["text"]})
 
+        prefetch.discard()  # prefetch Claude không dùng tới → bỏ
 
         # ---------- STREAM câu trả lời & IN RA TRỰC TIẾP ----------
-        buf: List[str] = []
-        if tool_results:
-            buf = []
-            _delays = [0.8, 1.6, 3.2]
-            _stream_ok = False
-            for _i, _d in enumerate(_delays, 1):
+        final_text = ""
+        overloaded = False   # bị breaker chặn / hết lượt retry → báo lỗi cho caller (batch_runner)
+        if dl.timed_out or dl.expired():
+            # hết hạn trước vòng 2 → chốt với phần đã có (text vòng 1 nếu có)
+            if not dl.timed_out:
+                dl.expire("llm")
+        elif tool_results:
+            round2_messages = [
+                *store["turns"],
+                user_msg,
+                {"role": "assistant", "content": first.content},
+                {"role": "user", "content": tool_results},
+            ]
+            second_tools = tools if allow_web else []  # giữ tắt tools ở vòng 2
+            try:
+                final_text = self.retry.call(
+                    lambda: self._stream_answer(system_txt, round2_messages, second_tools, _emit, usage=usage,
+                                                deadline=dl),
+                    on_wait=_on_wait("Stream"),
+                    max_attempts=3,
+                    deadline=dl,
+                )
+            except OverloadedError:
+                final_text = OVERLOADED_TEXT
+                overloaded = True
+            except DeadlineExceeded:
+                final_text = ""
+            except Exception:
+                # Fallback: gọi create() không stream để lấy full text
                 try:
-                    second_tools = tools if allow_web else []
-                    with self.client.beta.messages.stream(
-                        model=self.model,
-                        max_tokens=8000,
-                        temperature=0.7,
-                        system=system_txt,
-                        tools=second_tools,  # giữ tắt tools ở vòng 2
-                        messages=[
-                            *store["turns"],
-                            user_msg,
-                            {"role": "assistant", "content": first.content},
-                            {"role": "user", "content": tool_results},
-                        ],
-                    ) as stream:
-                        stream_text_acc = ""
-                        last_emitted = ""
-                        for ev in stream:
-                            if getattr(ev, "type", "") == "content_block_delta" and hasattr(ev, "delta") and getattr(ev.delta, "text", None):
-                                piece = ev.delta.text or ""
-                                stream_text_acc += piece
-
-                                # chặn dòng MCP đơn
-                                stream_text_acc = re.sub(r'(?m)^\s*sei[:_][\w:]+(\([^)]*\))?\s*$','', stream_text_acc)
-                                # chặn markdown image
-                                stream_text_acc = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', stream_text_acc)
-
-                                # chỉ emit phần mới sau khi đã lọc
-                                new_chunk = stream_text_acc[len(last_emitted):]
-                                if new_chunk:
-                                    _emit({"type": "text_delta", "text": new_chunk})
-                                    last_emitted = stream_text_acc
-                    _stream_ok = True
-                    break
-                except Exception as e:
-                    if self._is_overloaded(e) and _i < len(_delays):
-                        _emit({"type":"tool_result","name":"system","text":f"⏳ Stream quá tải, thử lại lần {_i+1}/{len(_delays)}..."})
-                        time.sleep(_d + random.random()*0.5)
-                        continue
-                    # Fallback: gọi create() không stream để lấy full text
-                    try:
-                        resp = self.client.messages.create(
-                            model=self.model,
-                            max_tokens=8000,
-                            temperature=0.7,
-                            system=system_txt,
-                            tools=[],  # vẫn tắt tools vòng 2
-                            messages=[
-                                *store["turns"],
-                                user_msg,
-                                {"role": "assistant", "content": first.content},
-                                {"role": "user", "content": tool_results},
-                            ],
+                    with self.router.timed("answer"):
+                        resp = self.retry.call(
+                            lambda: self._client_for(dl).messages.create(
+                                **self._llm_kwargs("answer"),
+                                system=system_txt,
+                                tools=[],  # vẫn tắt tools vòng 2
+                                messages=round2_messages,
+                            ),
+                            on_wait=_on_wait("Model"),
+                            max_attempts=3,
+                            deadline=dl,
                         )
-                        text_blocks = [getattr(b, "text", "") for b in resp.content if getattr(b, "type", None) == "text"]
-                        final_text = "".join(text_blocks).strip()
-                        if final_text:
-                            _emit({"type":"text_delta","text":final_text})
-                            buf = [final_text]
-                            _stream_ok = True
-                            break
-                    except Exception as e2:
-                        if self._is_overloaded(e2) and _i < len(_delays):
-                            time.sleep(_d + random.random()*0.5)
-                            continue
-                        else:
-                            raise
-
-            final_text = "".join(buf).strip()
-            if not final_text and first is not None:
-                final_text = "".join(getattr(b, "text", "") for b in first.content if getattr(b, "type", None) == "text").strip()
-
+                except OverloadedError:
+                    resp = None
+                    final_text = OVERLOADED_TEXT
+                    overloaded = True
+                except (DeadlineExceeded, anthropic.APITimeoutError):
+                    if not dl.expired():
+                        raise
+                    dl.expire("llm")
+                    resp = None
+                    final_text = ""
+                if resp is not None:
+                    self._add_usage(usage, resp)
+                    text_blocks = [getattr(b, "text", "") for b in resp.content if getattr(b, "type", None) == "text"]
+                    final_text = "".join(text_blocks).strip()
+                if final_text:
+                    _emit({"type": "text_delta", "text": final_text})
         else:
             # Không có tool cần chạy → stream thẳng câu trả lời (và tắt tools nếu không cần)
             second_tools = tools if allow_web else []  # tắt tools trong lượt stream này để tránh model "tự dưng" gọi tool
-            with self.client.beta.messages.stream(
-                model=self.model,
-                max_tokens=8000,
-                temperature=0.7,
-                system=system_txt,
-                tools=second_tools,
-                messages=[*store["turns"], user_msg],
-            ) as stream:
-                stream_text_acc = ""
-                last_emitted = ""
-                for ev in stream:
-                    if getattr(ev, "type", "") == "content_block_delta" and hasattr(ev, "delta") and getattr(ev.delta, "text", None):
-                        piece = ev.delta.text or ""
-                        stream_text_acc += piece
-
-                        # chặn dòng MCP đơn
-                        stream_text_acc = re.sub(r'(?m)^\s*sei[:_][\w:]+(\([^)]*\))?\s*$','', stream_text_acc)
-                        # chặn markdown image
-                        stream_text_acc = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', stream_text_acc)
-
-                        # chỉ emit phần mới sau khi đã lọc
-                        new_chunk = stream_text_acc[len(last_emitted):]
-                        if new_chunk:
-                            _emit({"type": "text_delta", "text": new_chunk})
-                            last_emitted = stream_text_acc
-            final_text = "".join(buf).strip()
-            if not final_text and first is not None:
-                final_text = "".join(getattr(b, "text", "") for b in first.content if getattr(b, "type", None) == "text").strip()
+            try:
+                final_text = self.retry.call(
+                    lambda: self._stream_answer(system_txt, [*store["turns"], user_msg], second_tools, _emit,
+                                                tier="intent" if cheap else "answer", usage=usage, deadline=dl),
+                    on_wait=_on_wait("Stream"),
+                    deadline=dl,
+                )
+            except OverloadedError:
+                final_text = OVERLOADED_TEXT
+                overloaded = True
+            except (DeadlineExceeded, anthropic.APITimeoutError):
+                if not dl.expired():
+                    raise
+                dl.expire("llm")
+                final_text = ""
+        if not final_text and first is not None:
+            final_text = "".join(getattr(b, "text", "") for b in first.content if getattr(b, "type", None) == "text").strip()
         print()
         print("[DBG] allow_mcp=", allow_mcp, "allow_web=", allow_web, "want_docs=", want_docs)
         print("[DBG] tools_v1=", [t.get("name") for t in tools])
 
-        # ---------- Fallback: nếu model in code python tạo bảng -> trích dữ liệu & vẽ ảnh ----------
-        if not images and final_text:
-            tables = self._extract_series_tables_from_md_images(final_text)
-            for tb in tables:
-                img_path = self._table_to_image(tb["columns"], tb["rows"], _emit)
-                if img_path:
-                    images.append(img_path)
-                    final_text = final_text.replace(tb["code_block"], "").strip()
-                    break 
-        # 2.x) Xoá mọi markdown image còn sót lại
-        final_text = self._remove_markdown_images(final_text)
-        # 2.1) Xoá các dòng MCP thô như 'sei:staking_apr' / 'sei:staking_info()'
-        final_text = self._strip_mcp_noise(final_text)
-
-        # 2.2) Nếu model in 'make_table_image({...})' → tự render ảnh & xoá code
-        if not images and final_text:
-            mt = self._extract_make_table_image_args_from_text(final_text)
-            if mt and mt["columns"] and mt["rows"]:
-                args2 = {
-                    "columns": mt["columns"],
-                    "rows": mt["rows"],
-                    "title": mt.get("title"),
-                    "theme": mt.get("theme", "light"),
-                    "font_size": mt.get("font_size", 18),
-                    "cell_padding": mt.get("cell_padding", [16, 10]),
-                }
-                _emit({"type": "tool_call", "name": "make_table_image", "args": args2})
-                out_path = run_client_tool("make_table_image", args2)
-                if isinstance(out_path, str):
-                    images.append(out_path)
-                    _emit({"type": "tool_result", "name": "make_table_image", "image_path": out_path})
-                    final_text = final_text.replace(mt["code_block"], "").strip()
-
-        # 2.3) Nếu còn code matplotlib → cố gắng rút current_apr và dựng ảnh bảng
-        if not images and final_text:
-            made_img = False
-            for blk in list(self._iter_code_fences(final_text)):
-                low = blk.lower()
-                if "matplotlib" in low or "plt." in low or "pandas" in low:
-                    apr = self._extract_apr_from_python(blk)
-                    if apr is not None:
-                        args2 = {
-                            "columns": ["Thông số", "Giá trị"],
-                            "rows": [["APR hiện tại", f"{apr:.2f}%"]],
-                            "title": "Thông tin APR của SEI",
-                            "theme": "light",
-                        }
-                        _emit({"type": "tool_call", "name": "make_table_image", "args": args2})
-                        out_path = run_client_tool("make_table_image", args2)
-                        if isinstance(out_path, str):
-                            images.append(out_path)
-                            _emit({"type": "tool_result", "name": "make_table_image", "image_path": out_path})
-                            final_text = final_text.replace(blk, "").strip()
-                            made_img = True
-                            break
-            # Nếu không parse được → ít nhất cũng bỏ hẳn code matplotlib cho sạch
-            if not made_img:
-                final_text = self._remove_matplotlib_blocks(final_text)
-        # 2.4) Bỏ mọi Markdown image, rồi nếu CHƯA có ảnh => cố gắng tự dựng PNG từ số APR nhặt được trong text
-        final_text = self._strip_mcp_noise_and_md_images(final_text)
-
-        if not images and final_text:
-            apr_val = self._extract_apr_value(final_text)
-            if apr_val is not None:
-                args2 = {
-                    "columns": ["Thông số", "Giá trị"],
-                    "rows": [["APR hiện tại", f"{apr_val:.2f}%"]],
-                    "title": "Thông tin APR của SEI",
-                    "theme": "light",
-                }
-                _emit({"type": "tool_call", "name": "make_table_image", "args": args2})
-                out_path = run_client_tool("make_table_image", args2)
-                if isinstance(out_path, str):
-                    images.append(out_path)
-                    _emit({"type": "tool_result", "name": "make_table_image", "image_path": out_path})
-
-
-        
-        # ---------- Fallback: bảng chữ (Markdown/ASCII) -> ảnh ----------
-        if not images and final_text:
-            tbl = self._extract_first_table_block(final_text)
-            if tbl:
-                parsed = self.md_table(tbl)  # <— dùng hàm md_table đã có
-                if parsed:
-                    img_tool = self.mcp.find_image_table_tool()
-                    if img_tool:
-                        _emit({"type": "tool_call", "name": img_tool, "args": {"columns": parsed["columns"], "rows": parsed["rows"]}})
-                        out = self.mcp.exec_tool(img_tool, {"columns": parsed["columns"], "rows": parsed["rows"]})
-                        if isinstance(out, dict) and out.get("image_path"):
-                            images.append(out["image_path"])
-                            _emit({"type": "tool_result", "name": img_tool, "image_path": out["image_path"]})
-                            final_text = final_text.replace(tbl, "").replace("```", "").strip()
-                    else:
-                        args2 = {"columns": parsed["columns"], "rows": parsed["rows"], "title": None, "theme": "light"}
-                        _emit({"type": "tool_call", "name": "make_table_image", "args": args2})
-                        out_path = run_client_tool("make_table_image", args2)
-                        if isinstance(out_path, str):
-                            images.append(out_path)
-                            _emit({"type": "tool_result", "name": "make_table_image", "image_path": out_path})
-                            final_text = final_text.replace(tbl, "").replace("```", "").strip()
-
+        # ---------- Hậu xử lý: tách block 1 lượt rồi chạy mọi fallback trên list block ----------
+        final_text = self._postprocess_answer(final_text, images, _emit, dl, structured)
+        if dl.timed_out:
+            final_text = f"{final_text}\n\n{dl.note()}".strip()
 
         # ---------- lưu history + done ----------
         store["turns"].append(user_msg)
@@ -709,7 +585,8 @@ class chatbot:
         self._maybe_summarize(session_id)
 
         _emit({"type": "done", "final_text": final_text, "images": images})
-        return {"text": final_text, "images": images}
+        return {"text": final_text, "images": images, "usage": usage, "timed_out": list(dl.stages),
+                "error": "overloaded" if overloaded else None}
 
 
 
@@ -730,7 +607,9 @@ class chatbot:
         """
         store = self.mem.get(session_id)
 
-        # Danh sách MCP tools khả dụng
+        # Danh sách MCP tools khả dụng (MCP còn khởi động và chưa có tool nào → chờ ngắn)
+        if not self.mcp.is_ready() and not self.mcp.anthropic_tools():
+            self.mcp.wait_ready(self.MCP_READY_WAIT)
         mcp_tools = self.mcp.anthropic_tools()
 
         # Nếu user nói "kết nối MCP/SEI MCP" mà không nêu tác vụ cụ thể:
@@ -762,16 +641,15 @@ class chatbot:
                 return {"text": f"Bạn vừa hỏi: “{last_q}”.", "images": []}
             return {"text": "Mình chưa thấy câu hỏi trước đó trong lịch sử chat này.", "images": []}
 
+        mcp_tools = self._rank_mcp_tools(message, mcp_tools, self._explicit_mcp_tool(message.lower(), mcp_tools))
+
         # System + tóm tắt (nếu có), kèm preview MCP tools (nếu có)
         system_txt = SYSTEM_PROMPT
         if store["summary"]:
             system_txt += "\n\n[Conversation summary]\n" + store["summary"]
         if mcp_tools:
-            preview = []
-            for t in mcp_tools[:16]:
-                desc = (t.get("description") or "").strip()
-                preview.append(f"- {t['name']}" + (f": {desc}" if desc else ""))
-            system_txt += "\n\n[Available MCP tools]\n" + "\n".join(preview)
+            # chỉ tên — description đã nằm trong tool block
+            system_txt += "\n\n[Available MCP tools]\n" + ", ".join(t["name"] for t in mcp_tools[:16])
 
         user_msg = {"role": "user", "content": [{"type": "text", "text": message}]}
 
@@ -788,14 +666,13 @@ class chatbot:
         tools.extend(mcp_tools)  # tools từ MCP servers (nếu có)
 
         # ----- Vòng 1: non-stream để xem có client/MCP tool cần chạy không -----
-        first = self.client.messages.create(
-            model=self.model,
-            max_tokens=8000,
-            temperature=0.7,
-            system=system_txt,
-            messages=[*store["turns"], user_msg],
-            tools=tools,
-        )
+        with self.router.timed("tool_args"):
+            first = self.client.messages.create(
+                **self._llm_kwargs("tool_args"),
+                system=system_txt,
+                messages=[*store["turns"], user_msg],
+                tools=tools,
+            )
 
         images: List[str] = []
         tool_results: List[Dict[str, Any]] = []
@@ -862,10 +739,8 @@ class chatbot:
         # ----- Vòng 2: CHỈ stream nếu có tool_result (client hoặc MCP). Nếu không, trả text vòng 1 -----
         if tool_results:
             full_chunks: List[str] = []
-            with self.client.beta.messages.stream(
-                model=self.model,
-                max_tokens=8000,
-                temperature=0.7,
+            with self.router.timed("answer"), self.client.beta.messages.stream(
+                **self._llm_kwargs("answer"),
                 system=system_txt,
                 tools=tools,
                 messages=[
@@ -918,6 +793,101 @@ class chatbot:
 
         return {"text": final_text, "images": images}
     
+    def _render_table_args(self, args: Dict[str, Any], _emit, dl: Optional[Deadline] = None) -> Optional[str]:
+        """Gọi client tool make_table_image với args, emit event; trả về path ảnh hoặc None."""
+        _emit({"type": "tool_call", "name": "make_table_image", "args": args})
+        out_path = self._run_table_tool(args, dl)
+        if isinstance(out_path, str):
+            _emit({"type": "tool_result", "name": "make_table_image", "image_path": out_path})
+            return out_path
+        return None
+
+    def _apr_table_args(self, apr: float) -> Dict[str, Any]:
+        return {
+            "columns": ["Thông số", "Giá trị"],
+            "rows": [["APR hiện tại", f"{apr:.2f}%"]],
+            "title": "Thông tin APR của SEI",
+            "theme": "light",
+        }
+
+    def _postprocess_answer(self, final_text: str, images: List[str], _emit, dl: Optional[Deadline] = None,
+                            structured: Optional[List[Any]] = None) -> str:
+        """
+        Parse final_text 1 lần thành block (prose/code/table/image/tool_call) rồi:
+        1) ảnh Markdown có series=[...] → bảng PNG
+        2) bỏ mọi ảnh Markdown & dòng MCP thô ('sei:...')
+        3) make_table_image({...}) in ra text/code → render ảnh
+        4) code matplotlib/pandas → rút current_apr dựng bảng, luôn bỏ code vẽ
+        5) số APR trong văn bản → bảng APR
+        6) bảng chữ (Markdown/ASCII) → ảnh; cột khớp 1 MCP result có cấu trúc (`structured`) → lấy
+           hàng thẳng từ object đó (đủ hàng, giá trị gốc) thay vì chữ model chép lại
+        Mọi bước chỉ chạy khi chưa có ảnh (trừ bước dọn rác). `images` được cập nhật tại chỗ.
+        Vẽ ảnh tôn trọng `dl` (hết hạn → bỏ qua ảnh, giữ text).
+        """
+        if not final_text:
+            return final_text
+        blocks = pp.parse_answer(final_text)
+
+        # 1) series chart → bảng
+        if not images:
+            for b in blocks:
+                tb = pp.series_table(b)
+                if tb:
+                    img_path = self._table_to_image(tb["columns"], tb["rows"], _emit, dl)
+                    if img_path:
+                        images.append(img_path)
+                        break
+
+        # 2) + 3) bỏ ảnh / tool-call dạng text; render make_table_image nếu chưa có ảnh
+        kept: List[Dict[str, Any]] = []
+        for b in blocks:
+            if b["kind"] == "image":
+                continue
+            call = b.get("args") if b["kind"] == "tool_call" else pp.code_table_call(b)
+            if b["kind"] == "tool_call" or call:
+                if call and not images and call["columns"] and call["rows"]:
+                    out_path = self._render_table_args(call, _emit, dl)
+                    if out_path:
+                        images.append(out_path)
+                continue
+            kept.append(b)
+        blocks = kept
+
+        # 4) code vẽ đồ thị (không thực thi) → thử rút current_apr, rồi bỏ block
+        kept = []
+        for b in blocks:
+            if pp.is_plot_code(b):
+                apr = pp.apr_from_python(b)
+                if apr is not None and not images:
+                    out_path = self._render_table_args(self._apr_table_args(apr), _emit, dl)
+                    if out_path:
+                        images.append(out_path)
+                continue
+            kept.append(b)
+        blocks = kept
+
+        # 5) số APR nhặt được trong văn bản (giữ nguyên text)
+        if not images:
+            apr_val = pp.apr_value(pp.prose_text(blocks))
+            if apr_val is not None:
+                out_path = self._render_table_args(self._apr_table_args(apr_val), _emit, dl)
+                if out_path:
+                    images.append(out_path)
+
+        # 6) bảng chữ (Markdown/ASCII) → ảnh
+        if not images:
+            tbl = pp.table_candidate(blocks)
+            parsed = self.md_table(pp.table_text(tbl)) if tbl else None
+            if parsed and structured:
+                parsed = pp.data_table_for(parsed["columns"], structured) or parsed
+            if parsed:
+                img_path = self._table_to_image(parsed["columns"], parsed["rows"], _emit, dl)
+                if img_path:
+                    images.append(img_path)
+                    blocks = [b for b in blocks if b is not tbl]
+
+        return pp.render_blocks(blocks)
+
     def _looks_like_doc_tool(self, name: str, desc: str = "") -> bool:
         n = (name or "").lower()
         d = (desc or "").lower()
@@ -979,11 +949,20 @@ class chatbot:
             if t["role"] in ("user", "assistant"):
                 texts = [c.get("text", "") for c in t["content"] if c.get("type") == "text"]
                 if texts: transcript.append(f"{t['role'].upper()}: {texts[0]}")
-        resp = self.client.messages.create(
-            model=self.model, max_tokens=512,
-            system="Summarize briefly the conversation so far; keep key facts and open items.",
-            messages=[{"role": "user", "content": "\n".join(transcript)}],
-        )
+        try:
+            with self.router.timed("summary"):
+                resp = self.retry.call(
+                    lambda: self.client.messages.create(
+                        **self._llm_kwargs("summary", temperature=None),
+                        system="Summarize briefly the conversation so far; keep key facts and open items.",
+                        messages=[{"role": "user", "content": "\n".join(transcript)}],
+                    ),
+                    max_attempts=2,
+                )
+        except Exception as e:
+            # tóm tắt thất bại (quá tải...) → giữ nguyên history, thử lại ở lượt sau
+            print(f"[SUMMARY] skipped: {type(e).__name__}: {e}", flush=True)
+            return
         summary = "".join(getattr(b, "text", "") for b in resp.content if getattr(b, "type", None) == "text").strip()
         if summary: store["summary"] = summary
         store["turns"] = store["turns"][-self.KEEP_TURNS:]
@@ -1118,7 +1097,8 @@ class chatbot:
 
         return None
 
-    def _table_to_image(self, columns: List[str], rows: List[List[str]], _emit) -> Optional[str]:
+    def _table_to_image(self, columns: List[str], rows: List[List[str]], _emit,
+                        dl: Optional[Deadline] = None) -> Optional[str]:
         """
         Gọi MCP tool tạo ảnh nếu có, không thì fallback qua client tool 'make_table_image'.
         Trả về image_path hoặc None.
@@ -1133,14 +1113,14 @@ class chatbot:
 
         if img_tool:
             _emit({"type": "tool_call", "name": img_tool, "args": args})
-            out = self.mcp.exec_tool(img_tool, args)
+            out = self.mcp.exec_tool(img_tool, args, deadline=dl)
             if isinstance(out, dict) and out.get("image_path"):
                 _emit({"type": "tool_result", "name": img_tool, "image_path": out["image_path"]})
                 return out["image_path"]
 
         # Fallback: client tool local
         _emit({"type": "tool_call", "name": "make_table_image", "args": args})
-        out_path = run_client_tool("make_table_image", args)
+        out_path = self._run_table_tool(args, dl)
         if isinstance(out_path, str):
             _emit({"type": "tool_result", "name": "make_table_image", "image_path": out_path})
             return out_path
@@ -1149,6 +1129,19 @@ class chatbot:
 
     
     
+    def _rank_mcp_tools(self, q: str, mcp_tools: List[Dict[str, Any]], explicit: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        MCP_TOOL_TOP_K tool liên quan nhất trong `mcp_tools` (BM25 theo câu hỏi, giữ nguyên cả tập nếu đã ≤ k).
+        Luôn giữ tool user gõ tên và tool prefetch sẽ gọi (để Claude dùng lại được kết quả prefetch).
+        """
+        if self.MCP_TOOL_TOP_K <= 0 or len(mcp_tools) <= self.MCP_TOOL_TOP_K:
+            return mcp_tools
+        must = [explicit] if explicit else []
+        must += [tool for _intent, tool, _args in self.prefetcher.plan(q, mcp_tools)]
+        ranked = self.mcp.rank_tools(q, self.MCP_TOOL_TOP_K, must, [t["name"] for t in mcp_tools])
+        METRICS.observe("mcp_tools_sent", len(ranked))
+        return ranked
+
     def _explicit_mcp_tool(self, q: str, mcp_tools: list[dict]) -> str | None:
         """Nếu user gõ đúng tên tool hoặc biến thể của nó, trả về tên tool thật (exact name)."""
         qn = self._normalize_tool_key(q)
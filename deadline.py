@@ -0,0 +1,87 @@
+# deadline.py
+import os, time, threading
+from typing import List, Optional
+
+from metrics import METRICS
+
+# Deadline cho 1 request (1 câu hỏi): tạo ở handler (Telegram / batch) rồi truyền xuống
+# asking_stream → LLM (timeout httpx + retry), MCP (exec_tool/exec_tools), render bảng.
+# Mỗi bước lấy timeout = min(timeout riêng của bước, thời gian còn lại).
+# Hết hạn ở bước nào → ghi stage vào metric request_deadline_exceeded{stage=...} và
+# asking_stream chốt câu trả lời dở dang kèm ghi chú (xem note()).
+#
+# Env: REQUEST_DEADLINE (120s; 0 = không giới hạn)
+
+_STAGE_TEXT = {
+    "mcp_wait": "chờ MCP khởi động",
+    "llm": "gọi model",
+    "llm_stream": "stream câu trả lời",
+    "mcp": "gọi MCP tool",
+    "render": "vẽ bảng",
+    "handler": "chờ câu trả lời",
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, stage: str):
+        super().__init__(f"request deadline exceeded at stage '{stage}'")
+        self.stage = stage
+
+
+class Deadline:
+    """Mốc hết hạn tuyệt đối (monotonic). seconds None/<=0 → không giới hạn."""
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.seconds = seconds if seconds and seconds > 0 else None
+        self._end = (time.monotonic() + self.seconds) if self.seconds else None
+        self._lock = threading.Lock()
+        self.stages: List[str] = []
+
+    @classmethod
+    def from_env(cls) -> "Deadline":
+        try:
+            return cls(float(os.getenv("REQUEST_DEADLINE", "120")))
+        except ValueError:
+            return cls(120.0)
+
+    def remaining(self) -> Optional[float]:
+        """Số giây còn lại (≥ 0); None nếu không giới hạn."""
+        if self._end is None:
+            return None
+        return max(0.0, self._end - time.monotonic())
+
+    def expired(self) -> bool:
+        return self._end is not None and time.monotonic() >= self._end
+
+    def clamp(self, timeout: Optional[float]) -> Optional[float]:
+        """min(timeout, còn lại); timeout None/<=0 = không giới hạn. None → không giới hạn."""
+        rem = self.remaining()
+        if timeout is None or timeout <= 0:
+            return None if rem is None else max(0.001, rem)
+        return timeout if rem is None else max(0.001, min(timeout, rem))
+
+    def expire(self, stage: str) -> None:
+        """Ghi nhận hết hạn tại `stage` (mỗi stage đếm 1 lần / request)."""
+        with self._lock:
+            if stage in self.stages:
+                return
+            self.stages.append(stage)
+        METRICS.inc("request_deadline_exceeded", stage=stage)
+        print(f"[DEADLINE] exceeded at stage '{stage}' ({self.seconds:g}s)", flush=True)
+
+    def check(self, stage: str) -> None:
+        """Hết hạn → expire(stage) + raise DeadlineExceeded."""
+        if self.expired():
+            self.expire(stage)
+            raise DeadlineExceeded(stage)
+
+    @property
+    def timed_out(self) -> bool:
+        return bool(self.stages)
+
+    def note(self) -> str:
+        """Ghi chú cho người dùng: bước nào đã quá hạn."""
+        if not self.stages:
+            return ""
+        what = ", ".join(_STAGE_TEXT.get(s, s) for s in self.stages)
+        return f"⏱️ Hết thời gian xử lý ({self.seconds:g}s) ở bước: {what}. Câu trả lời có thể chưa đầy đủ."
@@ -0,0 +1,126 @@
+# event_channel.py
+import asyncio, threading, time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque
+
+from metrics import METRICS
+
+# Kênh sự kiện 1 chiều: thread LLM (sink) → event loop, 1 kênh / 1 request.
+# - set_state(): trạng thái UI mới nhất (text đang stream). Chỉ giữ bản cuối → tự gộp (coalesce).
+# - put():       việc rời rạc phải làm đủ + đúng thứ tự (gửi ảnh, báo lỗi); hàng đợi có giới hạn.
+# - close():     kết thúc stream (kèm trạng thái cuối).
+# 1 consumer task trên loop xử lý tuần tự → không cần edit_lock, không tạo coroutine mỗi token,
+# bộ nhớ + overhead phẳng bất kể tốc độ token.
+
+_UNSET = object()
+
+
+class EventChannel:
+    def __init__(self, loop: asyncio.AbstractEventLoop, *, max_items: int = 32, min_interval: float = 0.2):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._state: Any = None
+        self._ver = 0
+        self._items: Deque[Any] = deque()
+        self._max_items = max_items
+        self._min_interval = min_interval
+        self._closed = False
+        self._signalled = False
+        self._wake = asyncio.Event()
+        self.dropped = 0
+
+    # ---------- producer (thread bất kỳ) ----------
+    def _signal_locked(self) -> bool:
+        if self._signalled:
+            return False
+        self._signalled = True
+        return True
+
+    def _wakeup(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:
+            pass  # loop đã đóng
+
+    def set_state(self, state: Any) -> None:
+        with self._lock:
+            self._state = state
+            self._ver += 1
+            wake = self._signal_locked()
+        if wake:
+            self._wakeup()
+
+    def put(self, item: Any) -> bool:
+        """False nếu kênh đã đóng hoặc hàng đợi đầy (item bị bỏ, có đếm metric)."""
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._items) >= self._max_items:
+                self.dropped += 1
+                METRICS.inc("ui_channel_dropped")
+                print(f"[UI] event queue full ({self._max_items}) — dropped {type(item).__name__}", flush=True)
+                return False
+            self._items.append(item)
+            wake = self._signal_locked()
+        if wake:
+            self._wakeup()
+        return True
+
+    def close(self, final_state: Any = _UNSET) -> None:
+        with self._lock:
+            if final_state is not _UNSET:
+                self._state = final_state
+                self._ver += 1
+            self._closed = True
+            wake = self._signal_locked()
+        if wake:
+            self._wakeup()
+
+    # ---------- consumer (trên loop) ----------
+    async def run(
+        self,
+        render: Callable[[Any], Awaitable[None]],
+        handle: Callable[[Any], Awaitable[None]],
+    ) -> None:
+        """
+        Xử lý tới khi close() và đã xả hết: item theo thứ tự, rồi render trạng thái mới nhất
+        (cách nhau ≥ min_interval; trạng thái cuối sau close() render ngay).
+        """
+        last_ver = 0
+        last_render = 0.0
+        renders = 0
+        while True:
+            with self._lock:
+                items = list(self._items)
+                self._items.clear()
+                ver, closed = self._ver, self._closed
+                self._signalled = False
+                self._wake.clear()
+            if not items and ver == last_ver:
+                if closed:
+                    break
+                await self._wake.wait()
+                continue
+
+            for it in items:
+                try:
+                    await handle(it)
+                except Exception as e:
+                    print(f"[UI] handle {type(it).__name__} failed: {type(e).__name__}: {e}", flush=True)
+
+            if ver != last_ver:
+                wait = self._min_interval - (time.monotonic() - last_render)
+                if wait > 0 and not closed:
+                    await asyncio.sleep(wait)
+                with self._lock:
+                    state, ver = self._state, self._ver   # lấy bản mới nhất sau khi chờ
+                last_ver = ver
+                try:
+                    await render(state)
+                except Exception as e:
+                    print(f"[UI] render failed: {type(e).__name__}: {e}", flush=True)
+                last_render = time.monotonic()
+                renders += 1
+
+        METRICS.inc("ui_state_updates", last_ver)
+        METRICS.inc("ui_renders", renders)
@@ -0,0 +1,156 @@
+# fake_anthropic.py
+"""
+Server giả lập Anthropic Messages API (POST /v1/messages, stream hoặc không) để chạy
+batch_runner / benchmark offline, không tốn quota.
+
+    python fake_anthropic.py --port 8089 --latency 0.3 --jitter 0.1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8089 python batch_runner.py questions.jsonl
+
+Trả lời = echo câu hỏi. Với --tool-use: nếu câu hỏi có địa chỉ sei1... và request có tool
+tên chứa "balance" → trả tool_use để đi hết nhánh MCP.
+"""
+import argparse, json, random, re, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _last_user_text(body: dict) -> str:
+    for m in reversed(body.get("messages") or []):
+        if m.get("role") != "user":
+            continue
+        c = m.get("content")
+        if isinstance(c, str):
+            return c
+        for part in c or []:
+            if isinstance(part, dict) and part.get("type") == "text":
+                return part.get("text") or ""
+        return ""
+    return ""
+
+
+def _has_tool_results(body: dict) -> bool:
+    last = (body.get("messages") or [{}])[-1]
+    c = last.get("content")
+    return isinstance(c, list) and any(isinstance(p, dict) and p.get("type") == "tool_result" for p in c)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "FakeAnthropic/1.0"
+    protocol_version = "HTTP/1.1"  # keep-alive → đo được tỉ lệ reuse kết nối của client
+    cfg = {"latency": 0.0, "jitter": 0.0, "tool_use": False, "chunk": 12}
+
+    def log_message(self, fmt, *args):  # im lặng
+        pass
+
+    def _sleep(self):
+        lat = self.cfg["latency"] + random.uniform(0, self.cfg["jitter"])
+        if lat > 0:
+            time.sleep(lat)
+
+    def do_GET(self):
+        # dùng cho warm-up / health
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", "11")
+        self.end_headers()
+        self.wfile.write(b'{"ok":true}')
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("content-length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if not self.path.startswith("/v1/messages"):
+            self.send_response(404)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        n = int(self.headers.get("content-length") or 0)
+        raw = self.rfile.read(n) if n else b"{}"
+        body = json.loads(raw or b"{}")
+        self._sleep()
+
+        question = _last_user_text(body)
+        in_tokens = max(1, len(raw) // 4)
+        content = None
+        if self.cfg["tool_use"] and body.get("tools") and not _has_tool_results(body):
+            addr = re.search(r"\bsei1[0-9a-z]{6,}\b", question)
+            tool = next((t["name"] for t in body["tools"] if "balance" in (t.get("name") or "")), None)
+            if addr and tool:
+                content = [{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:12]}", "name": tool,
+                            "input": {"address": addr.group(0)}}]
+        if content is None:
+            text = f"[fake:{body.get('model')}] {question}".strip()
+            content = [{"type": "text", "text": text}]
+        out_tokens = max(1, sum(len(json.dumps(c)) for c in content) // 4)
+        stop = "tool_use" if content[0]["type"] == "tool_use" else "end_turn"
+        msg = {
+            "id": f"msg_{uuid.uuid4().hex[:16]}", "type": "message", "role": "assistant",
+            "model": body.get("model"), "content": content, "stop_reason": stop, "stop_sequence": None,
+            "usage": {"input_tokens": in_tokens, "output_tokens": out_tokens},
+        }
+        if body.get("stream"):
+            self._stream(msg)
+        else:
+            data = json.dumps(msg).encode("utf-8")
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def _stream(self, msg: dict):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self.send_header("transfer-encoding", "chunked")
+        self.end_headers()
+
+        def ev(name: str, data: dict):
+            chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+
+        start = dict(msg, content=[], stop_reason=None, usage={"input_tokens": msg["usage"]["input_tokens"], "output_tokens": 1})
+        ev("message_start", {"type": "message_start", "message": start})
+        for idx, block in enumerate(msg["content"]):
+            if block["type"] == "text":
+                ev("content_block_start", {"type": "content_block_start", "index": idx, "content_block": {"type": "text", "text": ""}})
+                text, step = block["text"], self.cfg["chunk"]
+                for i in range(0, len(text), step):
+                    ev("content_block_delta", {"type": "content_block_delta", "index": idx,
+                                               "delta": {"type": "text_delta", "text": text[i:i + step]}})
+            else:
+                ev("content_block_start", {"type": "content_block_start", "index": idx,
+                                           "content_block": dict(block, input={})})
+                ev("content_block_delta", {"type": "content_block_delta", "index": idx,
+                                           "delta": {"type": "input_json_delta", "partial_json": json.dumps(block["input"])}})
+            ev("content_block_stop", {"type": "content_block_stop", "index": idx})
+        ev("message_delta", {"type": "message_delta", "delta": {"stop_reason": msg["stop_reason"], "stop_sequence": None},
+                             "usage": {"output_tokens": msg["usage"]["output_tokens"]}})
+        ev("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8089, latency: float = 0.0, jitter: float = 0.0,
+          tool_use: bool = False) -> ThreadingHTTPServer:
+    """Tạo server (chưa chạy). Gọi .serve_forever() — có thể chạy trong thread riêng."""
+    _Handler.cfg = {"latency": latency, "jitter": jitter, "tool_use": tool_use, "chunk": 12}
+    return ThreadingHTTPServer((host, port), _Handler)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Fake Anthropic Messages API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--latency", type=float, default=0.0, help="độ trễ cố định mỗi request (giây)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="độ trễ ngẫu nhiên thêm [0, jitter]")
+    ap.add_argument("--tool-use", action="store_true", help="trả tool_use cho câu hỏi có địa chỉ sei1...")
+    a = ap.parse_args()
+    srv = serve(a.host, a.port, a.latency, a.jitter, a.tool_use)
+    print(f"[FAKE] Anthropic API on http://{a.host}:{a.port}")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+# fake_mcp.py
+"""
+MCP server giả lập (stdio) replay file record của mcp_record.py — benchmark / test nhánh MCP
+offline, không cần `npx @sei-js/mcp-server` hay chain thật.
+
+    MCP_RECORD=recordings/sei.jsonl python probe_mcp.py        # 1) ghi traffic thật
+    # 2) mcp.json trỏ server sang bản replay:
+    "sei": {"command": "python", "args": ["fake_mcp.py", "recordings/sei.jsonl", "--latency", "0.05", "--jitter", "0.02"]}
+
+Tool list = list_tools cuối cùng trong file. call_tool khớp đúng (tool, args) → trả lần lượt các
+result đã ghi (vòng lại khi hết); args lạ → result bất kỳ của tool đó (--strict: báo lỗi).
+Độ trễ: --latency + uniform(0, --jitter), hoặc --recorded-latency (thời gian đã ghi × --speed).
+--seed cố định jitter → benchmark lặp lại được.
+
+Chạy như MCP service dùng chung qua HTTP (mcp.json: {"url": "http://127.0.0.1:8931/mcp"}):
+
+    python fake_mcp.py recordings/sei.jsonl --transport streamable-http --port 8931   # endpoint /mcp
+    python fake_mcp.py recordings/sei.jsonl --transport sse --port 8931               # endpoint /sse
+"""
+import argparse, asyncio, contextlib, itertools, random, sys
+from typing import Any, Dict, List, Optional
+
+import mcp.types as types
+from mcp.server.lowlevel import Server
+from mcp.server.stdio import stdio_server
+
+from mcp_record import Recording, canonical_args, load_recording
+
+
+def _log(msg: str) -> None:
+    # stdout là kênh JSON-RPC → log ra stderr
+    print(f"[FAKE-MCP] {msg}", file=sys.stderr, flush=True)
+
+
+def build_server(rec: Recording, *, latency: float = 0.0, jitter: float = 0.0, recorded_latency: bool = False,
+                 speed: float = 1.0, strict: bool = False, seed: Optional[int] = None, name: str = "fake-sei") -> Server:
+    server = Server(name)
+    rng = random.Random(seed)
+    # bỏ outputSchema: result đã ghi có thể chỉ có content (server thật không validate lại)
+    tools = [types.Tool.model_validate({k: v for k, v in t.items() if k != "outputSchema"}) for t in rec.tools]
+    exact = {key: itertools.cycle(recs) for key, recs in rec.calls.items()}
+    any_of = {tool: itertools.cycle(recs) for tool, recs in rec.by_tool.items()}
+
+    @server.list_tools()
+    async def _list_tools() -> List[types.Tool]:
+        return tools
+
+    @server.call_tool(validate_input=False)
+    async def _call_tool(tool: str, arguments: Dict[str, Any]):
+        it = exact.get((tool, canonical_args(arguments)))
+        if it is None and not strict:
+            it = any_of.get(tool)
+        if it is None:
+            raise ValueError(f"no recording for {tool}({canonical_args(arguments)})")
+        r = next(it)
+        delay = (r.get("duration_s") or 0.0) * speed if recorded_latency else latency + rng.uniform(0, jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if r.get("error"):
+            raise RuntimeError(r["error"])
+        res = r.get("result") or {}
+        content = [types.TextContent.model_validate(c) if c.get("type") == "text" else c
+                   for c in res.get("content") or []]
+        if res.get("isError"):
+            raise RuntimeError(" ".join(c.text for c in content if isinstance(c, types.TextContent)))
+        structured = res.get("structuredContent")
+        return (content, structured) if structured is not None else content
+
+    return server
+
+
+async def _serve(server: Server) -> None:
+    async with stdio_server() as (read, write):
+        await server.run(read, write, server.create_initialization_options())
+
+
+def http_app(server: Server, transport: str = "streamable-http"):
+    """ASGI app: streamable HTTP ở /mcp, hoặc SSE ở /sse (+ POST /messages/)."""
+    from starlette.applications import Starlette
+    from starlette.responses import Response
+    from starlette.routing import Mount, Route
+
+    if transport == "sse":
+        from mcp.server.sse import SseServerTransport
+        sse = SseServerTransport("/messages/")
+
+        async def _handle_sse(request):
+            async with sse.connect_sse(request.scope, request.receive, request._send) as (read, write):
+                await server.run(read, write, server.create_initialization_options())
+            return Response()
+
+        return Starlette(routes=[Route("/sse", endpoint=_handle_sse), Mount("/messages/", app=sse.handle_post_message)])
+
+    from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+    manager = StreamableHTTPSessionManager(app=server)
+
+    async def _handle(scope, receive, send):
+        await manager.handle_request(scope, receive, send)
+
+    @contextlib.asynccontextmanager
+    async def _lifespan(_app):
+        async with manager.run():
+            yield
+
+    return Starlette(routes=[Mount("/mcp", app=_handle)], lifespan=_lifespan)
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Replay recorded MCP traffic as a stdio MCP server")
+    ap.add_argument("recording", help="file JSONL từ MCP_RECORD")
+    ap.add_argument("--server", default=None, help="server trong file (mặc định: server của record đầu tiên)")
+    ap.add_argument("--latency", type=float, default=0.0, help="độ trễ cố định mỗi call (giây)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="độ trễ ngẫu nhiên thêm [0, jitter]")
+    ap.add_argument("--recorded-latency", action="store_true", help="dùng thời gian call đã ghi thay cho --latency")
+    ap.add_argument("--speed", type=float, default=1.0, help="hệ số nhân cho --recorded-latency")
+    ap.add_argument("--strict", action="store_true", help="args không khớp record → lỗi")
+    ap.add_argument("--seed", type=int, default=None, help="seed cho jitter")
+    ap.add_argument("--transport", choices=("stdio", "streamable-http", "sse"), default="stdio")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8931)
+    a = ap.parse_args(argv)
+
+    rec = load_recording(a.recording, a.server)
+    if not rec.tools:
+        _log(f"no list_tools record in {a.recording}")
+        return 1
+    _log(f"{len(rec.tools)} tool(s), {sum(len(v) for v in rec.calls.values())} recorded call(s)")
+    srv = build_server(rec, latency=a.latency, jitter=a.jitter, recorded_latency=a.recorded_latency,
+                       speed=a.speed, strict=a.strict, seed=a.seed)
+    if a.transport == "stdio":
+        asyncio.run(_serve(srv))
+    else:
+        import uvicorn
+        path = "/sse" if a.transport == "sse" else "/mcp"
+        _log(f"{a.transport} on http://{a.host}:{a.port}{path}")
+        uvicorn.run(http_app(srv, a.transport), host=a.host, port=a.port, log_level="warning")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# llm_http.py
+import os, time, threading
+from typing import Any, Dict, Optional
+
+import httpx
+from anthropic import DefaultHttpxClient
+
+from metrics import METRICS
+
+# HTTP transport dùng chung cho anthropic.Anthropic:
+# - pool size / keep-alive / HTTP2 / timeout cấu hình qua env
+# - warm-up lúc khởi động + ping khi idle để giữ kết nối TLS còn sống
+#   (mặc định của SDK: keepalive_expiry=5s → request đầu sau idle phải bắt tay TLS lại)
+# - metric tỉ lệ tái sử dụng kết nối: 1 - new_connections / requests (chỉ request thật; warm-up được gắn
+#   extension _WARMUP_EXT và đếm riêng ở llm_http_warmups / llm_http_warmup_connections)
+#
+# Env:
+#   ANTHROPIC_POOL_MAX_CONNECTIONS   (100)   ANTHROPIC_POOL_MAX_KEEPALIVE (20)
+#   ANTHROPIC_KEEPALIVE_EXPIRY       (90s)   ANTHROPIC_HTTP2 (0; cần package h2)
+#   ANTHROPIC_CONNECT_TIMEOUT        (5s)    ANTHROPIC_READ_TIMEOUT (600s)
+#   ANTHROPIC_POOL_TIMEOUT           (10s — hết chỗ trong pool thì lỗi nhanh thay vì xếp hàng ngầm)
+#   ANTHROPIC_WARMUP_INTERVAL        (45s; 0 = tắt ping idle)
+
+
+_WARMUP_EXT = "sei_warmup"
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _http2_enabled() -> bool:
+    if os.getenv("ANTHROPIC_HTTP2", "0") != "1":
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        print("[HTTP] ANTHROPIC_HTTP2=1 but package 'h2' is missing — falling back to HTTP/1.1.")
+        return False
+
+
+class LLMHttp:
+    """Giữ 1 httpx.Client (pool) cho Anthropic SDK, kèm warm-up và thống kê reuse."""
+
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = (base_url or os.getenv("ANTHROPIC_BASE_URL") or "https://api.anthropic.com").rstrip("/")
+        self.limits = httpx.Limits(
+            max_connections=int(_env_float("ANTHROPIC_POOL_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(_env_float("ANTHROPIC_POOL_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=_env_float("ANTHROPIC_KEEPALIVE_EXPIRY", 90),
+        )
+        self.timeout = httpx.Timeout(
+            _env_float("ANTHROPIC_READ_TIMEOUT", 600),
+            connect=_env_float("ANTHROPIC_CONNECT_TIMEOUT", 5),
+            pool=_env_float("ANTHROPIC_POOL_TIMEOUT", 10),
+        )
+        self.warmup_interval = _env_float("ANTHROPIC_WARMUP_INTERVAL", 45)
+        self._last_activity = 0.0
+        self._stop = threading.Event()
+        self.http2 = _http2_enabled()
+        self.client = DefaultHttpxClient(
+            limits=self.limits,
+            timeout=self.timeout,
+            http2=self.http2,
+            event_hooks={"request": [self._on_request]},
+        )
+
+    # ---------- metrics ----------
+    def _on_request(self, request: httpx.Request) -> None:
+        self._last_activity = time.monotonic()
+        warmup = bool(request.extensions.get(_WARMUP_EXT))
+        METRICS.inc("llm_http_warmups" if warmup else "llm_http_requests")
+        prev = request.extensions.get("trace")
+
+        def _trace(event_name: str, info: Dict[str, Any]):
+            # httpcore phát 'connection.connect_tcp.complete' khi phải mở kết nối mới
+            if event_name == "connection.connect_tcp.complete":
+                METRICS.inc("llm_http_warmup_connections" if warmup else "llm_http_new_connections")
+            if prev is not None:
+                return prev(event_name, info)
+
+        request.extensions["trace"] = _trace
+
+    def stats(self) -> Dict[str, Any]:
+        reqs = METRICS.get("llm_http_requests")
+        new = METRICS.get("llm_http_new_connections")
+        return {
+            "requests": reqs,
+            "new_connections": new,
+            "reuse_rate": (1 - new / reqs) if reqs else 0.0,
+            "warmups": METRICS.get("llm_http_warmups"),
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive": self.limits.max_keepalive_connections,
+        }
+
+    # ---------- warm-up ----------
+    def warm_up(self) -> bool:
+        """Mở sẵn kết nối TCP/TLS tới API (HEAD base URL, status nào cũng được)."""
+        t0 = time.perf_counter()
+        try:
+            self.client.request("HEAD", self.base_url, timeout=_env_float("ANTHROPIC_CONNECT_TIMEOUT", 5) + 5,
+                                extensions={_WARMUP_EXT: True})
+        except Exception as e:
+            print(f"[HTTP] warm-up failed: {type(e).__name__}: {e}")
+            METRICS.inc("llm_http_warmup_errors")
+            return False
+        METRICS.observe("llm_http_warmup_seconds", time.perf_counter() - t0)
+        return True
+
+    def start(self) -> None:
+        """Warm-up nền lúc khởi động + giữ ấm khi idle (không block constructor)."""
+        threading.Thread(target=self._keep_warm, name="LLMHttpWarm", daemon=True).start()
+
+    def _keep_warm(self) -> None:
+        self.warm_up()
+        if self.warmup_interval <= 0:
+            return
+        while not self._stop.wait(self.warmup_interval / 3):
+            if time.monotonic() - self._last_activity >= self.warmup_interval:
+                self.warm_up()
+
+    def close(self) -> None:
+        self._stop.set()
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+_SHARED: Optional[LLMHttp] = None
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_http() -> LLMHttp:
+    """1 pool cho cả process (tạo lười: ANTHROPIC_BASE_URL có thể được set muộn, vd. batch_runner --fake)."""
+    global _SHARED
+    with _SHARED_LOCK:
+        if _SHARED is None:
+            _SHARED = LLMHttp()
+            _SHARED.start()
+        return _SHARED
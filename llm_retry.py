@@ -0,0 +1,257 @@
+# llm_retry.py
+import os, time, random, threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+from metrics import METRICS
+from deadline import DeadlineExceeded
+
+# Retry/backoff dùng chung cho mọi lời gọi Anthropic trong process (quá tải 429/529/503 + lỗi mạng/5xx):
+# - full jitter: sleep = random(0, min(cap, base * 2^(n-1)))
+# - tôn trọng header retry-after / retry-after-ms của server
+# - circuit breaker toàn process: quá tải liên tục → mở mạch, request mới
+#   xếp hàng (chờ tới khi mạch đóng, có jitter) hoặc bị từ chối ngay nếu phải chờ quá lâu;
+#   hết cooldown → half-open: chỉ 1 request thăm dò, thành công mới đóng mạch cho số còn lại
+
+
+class OverloadedError(RuntimeError):
+    """Mạch đang mở và thời gian chờ vượt ngưỡng → request bị shed."""
+
+    def __init__(self, wait_s: float):
+        super().__init__(f"Anthropic overloaded; circuit open for another {wait_s:.1f}s")
+        self.wait_s = wait_s
+
+
+def is_overloaded(e: Exception) -> bool:
+    s = str(e).lower()
+    if "overloaded" in s or "rate limit" in s or "temporarily" in s:
+        return True
+    status = getattr(e, "status_code", None)
+    if status in (429, 529, 503):
+        return True
+    # APIStatusError: body có thể chứa {"error": {"type": "overloaded_error"}}
+    try:
+        body = getattr(e, "body", None)
+        err = (body or {}).get("error") or {}
+        if (err.get("type") or "").lower() in ("overloaded_error", "rate_limit_error"):
+            return True
+    except Exception:
+        pass
+    return False
+
+
+def is_transient(e: Exception) -> bool:
+    """
+    Lỗi mạng / 5xx (không phải quá tải) đáng thử lại — trước đây SDK tự retry, giờ SDK chạy max_retries=0
+    khi có deadline nên RetryEngine lo. Không tính vào circuit breaker. Lỗi giữa stream đã emit text
+    (e.partial_output) không thử lại để UI không bị lặp nội dung.
+    """
+    if getattr(e, "partial_output", False):
+        return False
+    status = getattr(e, "status_code", None)
+    if isinstance(status, int):
+        return status >= 500 or status == 408
+    names = {c.__name__ for c in type(e).__mro__}
+    return bool(names & {"APIConnectionError", "TransportError"})
+
+
+def retry_after_seconds(e: Exception) -> Optional[float]:
+    """Đọc retry-after-ms / retry-after (giây hoặc HTTP-date) từ response của exception."""
+    resp = getattr(e, "response", None)
+    headers = getattr(resp, "headers", None)
+    if not headers:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            return max(0.0, float(ms) / 1000.0)
+        ra = headers.get("retry-after")
+        if not ra:
+            return None
+        try:
+            return max(0.0, float(ra))
+        except ValueError:
+            dt = parsedate_to_datetime(ra)
+            return max(0.0, dt.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class CircuitBreaker:
+    """
+    Đếm lỗi quá tải trong cửa sổ `window` giây; đủ `threshold` lần → mở mạch `cooldown` giây
+    (hoặc lâu hơn nếu server trả retry-after). Hết hạn → half-open: 1 request thăm dò (probe),
+    các request khác chờ tiếp; probe thành công → đóng mạch, probe quá tải → mở lại.
+    """
+
+    def __init__(self, threshold: int = 3, window: float = 30.0, cooldown: float = 10.0, max_queue_wait: float = 20.0,
+                 probe_timeout: float = 10.0):
+        self.threshold = max(1, threshold)
+        self.window = window
+        self.cooldown = cooldown
+        self.max_queue_wait = max_queue_wait
+        self.probe_timeout = probe_timeout    # probe không báo kết quả quá lâu → cho request khác thăm dò
+        self._lock = threading.Lock()
+        self._failures: list = []
+        self._open_until = 0.0
+        self._half_open = False               # đã từng mở, chưa có thành công nào sau đó
+        self._probe_at: Optional[float] = None
+
+    def state(self) -> str:
+        with self._lock:
+            if self._open_until > time.monotonic():
+                return "open"
+            return "half_open" if self._half_open else "closed"
+
+    def remaining(self) -> float:
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def record_overload(self, retry_after: Optional[float] = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._failures = [t for t in self._failures if now - t <= self.window]
+            self._failures.append(now)
+            probe_failed = self._half_open and self._probe_at is not None
+            self._probe_at = None
+            if len(self._failures) >= self.threshold or retry_after or probe_failed:
+                tripped = len(self._failures) >= self.threshold or probe_failed
+                until = now + max(self.cooldown if tripped else 0.0, retry_after or 0.0)
+                if until > self._open_until:
+                    self._open_until = until
+                    self._half_open = True
+                    METRICS.inc("llm_breaker_opened")
+        METRICS.set("llm_breaker_open", 1 if self.state() == "open" else 0)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures.clear()
+            self._open_until = 0.0
+            self._half_open = False
+            self._probe_at = None
+        METRICS.set("llm_breaker_open", 0)
+
+    def end_probe(self) -> None:
+        """Probe kết thúc bằng lỗi không phải quá tải (mạng, 5xx...) → mạch vẫn half-open, request sau thăm dò tiếp."""
+        with self._lock:
+            self._probe_at = None
+
+    def admission_wait(self) -> float:
+        """
+        Số giây request phải chờ trước khi hỏi lại (0 = đi ngay; ở half-open chỉ đúng 1 request nhận 0).
+        Chờ có jitter để các request xếp hàng không cùng bắn ra 1 lúc. Vượt max_queue_wait → OverloadedError.
+        """
+        with self._lock:
+            now = time.monotonic()
+            remaining = self._open_until - now
+            if remaining > 0:
+                wait = remaining + random.uniform(0, min(self.cooldown, remaining) * 0.5)
+            elif not self._half_open:
+                return 0.0
+            elif self._probe_at is None or now - self._probe_at > self.probe_timeout:
+                self._probe_at = now
+                METRICS.inc("llm_breaker_probes")
+                return 0.0
+            else:
+                wait = random.uniform(0.5, 1.5) * min(1.0, self.cooldown)   # chờ kết quả probe
+        if remaining > self.max_queue_wait:
+            METRICS.inc("llm_requests_shed")
+            raise OverloadedError(remaining)
+        return wait
+
+
+class RetryEngine:
+    """
+    call(fn) — cho code chạy trong worker thread (chatbot chạy đồng bộ trong thread, sleep chặn thread đó).
+    on_wait(attempt, max_attempts, delay, queued) được gọi trước mỗi lần chờ để UI báo trạng thái.
+    deadline (deadline.Deadline): không thử / không ngủ quá hạn của request → DeadlineExceeded("llm").
+    """
+
+    def __init__(self, breaker: CircuitBreaker, max_attempts: int = 4, base: float = 0.8, cap: float = 8.0):
+        self.breaker = breaker
+        self.max_attempts = max(1, max_attempts)
+        self.base = base
+        self.cap = cap
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * (2 ** (attempt - 1))))
+
+    def _delay_for(self, e: Exception, attempt: int) -> float:
+        ra = retry_after_seconds(e)
+        self.breaker.record_overload(ra)
+        return max(ra or 0.0, self.backoff(attempt))
+
+    @staticmethod
+    def _check_deadline(deadline, delay: float = 0.0) -> None:
+        """Chờ `delay` giây nữa sẽ vượt deadline → bỏ luôn (không ngủ vô ích)."""
+        if deadline is None:
+            return
+        rem = deadline.remaining()
+        if rem is not None and rem <= delay:
+            deadline.expire("llm")
+            raise DeadlineExceeded("llm")
+
+    def _admit(self, attempt: int, attempts: int, on_wait, deadline) -> None:
+        """
+        Chờ tới khi breaker cho đi: mạch mở → chờ hết cooldown (tổng ≤ max_queue_wait, jitter không làm vượt);
+        half-open → chờ kết quả probe (chỉ bị giới hạn bởi deadline; probe treo quá probe_timeout → request khác thăm dò).
+        """
+        queued_for = 0.0
+        announced = False
+        while True:
+            open_left = self.breaker.remaining()
+            wait = self.breaker.admission_wait()
+            if wait <= 0:
+                return
+            if open_left > 0:
+                if queued_for + open_left > self.breaker.max_queue_wait:
+                    METRICS.inc("llm_requests_shed")
+                    raise OverloadedError(open_left)
+                wait = min(wait, self.breaker.max_queue_wait - queued_for)
+                queued_for += wait
+            self._check_deadline(deadline, wait)
+            if not announced:
+                announced = True
+                METRICS.inc("llm_requests_queued")
+                if on_wait: on_wait(attempt, attempts, wait, True)
+            time.sleep(wait)
+
+    def call(self, fn: Callable[[], Any], *, on_wait: Optional[Callable[..., None]] = None,
+             max_attempts: Optional[int] = None, deadline=None) -> Any:
+        attempts = max_attempts or self.max_attempts
+        for attempt in range(1, attempts + 1):
+            self._admit(attempt, attempts, on_wait, deadline)
+            try:
+                out = fn()
+                self.breaker.record_success()
+                return out
+            except Exception as e:
+                overloaded = is_overloaded(e)
+                if not overloaded:
+                    self.breaker.end_probe()
+                # stream đã emit text → không thử lại dù quá tải (tránh lặp text), nhưng breaker vẫn ghi nhận
+                partial = getattr(e, "partial_output", False)
+                if overloaded and partial:
+                    self.breaker.record_overload(retry_after_seconds(e))
+                if partial or not (overloaded or is_transient(e)) or attempt >= attempts:
+                    raise
+                METRICS.inc("llm_retries")
+                if overloaded:
+                    delay = self._delay_for(e, attempt)
+                else:
+                    METRICS.inc("llm_transient_retries")
+                    delay = self.backoff(attempt)
+                self._check_deadline(deadline, delay)
+                if on_wait: on_wait(attempt, attempts, delay, False)
+                time.sleep(delay)
+
+
+# breaker + engine dùng chung cho cả process (mọi chat cùng nhìn 1 trạng thái quá tải)
+BREAKER = CircuitBreaker(
+    threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "3")),
+    window=float(os.getenv("LLM_BREAKER_WINDOW", "30")),
+    cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", "10")),
+    max_queue_wait=float(os.getenv("LLM_QUEUE_MAX_WAIT", "20")),
+    probe_timeout=float(os.getenv("LLM_BREAKER_PROBE_TIMEOUT", "10")),
+)
+RETRY = RetryEngine(BREAKER, max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "4")))
@@ -1,5 +1,6 @@
 import os
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from aiogram import Dispatcher, types, Bot
 from aiogram.filters import Command
 from aiogram.types import Message, FSInputFile
@@ -7,7 +8,10 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from html import escape
 from chatbot import chatbot
-import os, asyncio, time, html
+from event_channel import EventChannel
+from deadline import Deadline
+from artifact_store import ARTIFACTS
+import os, asyncio, html, hmac
 from aiogram.filters import Command
 import re
 from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
@@ -20,6 +24,10 @@ if not TOKEN:
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "Applying your own webhook host here")
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/ask")
 WEBHOOK_URL = WEBHOOK_HOST + WEBHOOK_PATH
+# LLM thread tự dừng theo deadline (REQUEST_DEADLINE); quá deadline + grace mà chưa xong → handler tự chốt
+DEADLINE_GRACE = float(os.getenv("REQUEST_DEADLINE_GRACE", "5"))
+# token cho endpoint /admin/* (không set → tắt endpoint admin)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 app = FastAPI()
 dp = Dispatcher()
@@ -122,6 +130,8 @@ async def handle_text_message(message: Message):
         return
 
     sid = str(message.chat.id)
+    # hạn chót cho cả request: LLM, MCP, vẽ bảng đều lấy timeout từ đây
+    dl = Deadline.from_env()
     out_msg = await message.answer(
         mdv2_escape_inline("⏳ Đang xử lý..."),
         parse_mode=ParseMode.MARKDOWN_V2
@@ -130,25 +140,12 @@ async def handle_text_message(message: Message):
     loop = asyncio.get_running_loop()
     buf_text = ""
     tool_lines: list[str] = []
-    last_edit = 0.0
     EDIT_INTERVAL = 0.2  # an toàn hơn cho Telegram
     MAX_TOOL_LINES = 8
     last_sent_html = ""   # chống edit trùng
-    edit_lock = asyncio.Lock()  # serialize edit
-
-    async def _edit_serialized(msg: types.Message, html_text: str):
-        async with edit_lock:
-            await _safe_edit(msg, html_text)
-
-    def _post_task(coro, label: str = ""):
-        fut = asyncio.run_coroutine_threadsafe(coro, loop)
-        def _cb(f):
-            try:
-                f.result()
-            except Exception as e:
-                print(f"[ERR {label}] {type(e).__name__}: {e}", flush=True)
-        fut.add_done_callback(_cb)
-        return fut
+    # kênh sự kiện có giới hạn: sink (thread LLM) chỉ ghi trạng thái mới nhất / xếp việc rời rạc,
+    # 1 consumer trên loop gộp các lần edit (không còn 1 coroutine mỗi token)
+    chan = EventChannel(loop, max_items=32, min_interval=EDIT_INTERVAL)
 
     async def _send_photo(msg: types.Message, path: str, caption: str | None = None):
         p = os.path.abspath((path or "").strip().strip('"').strip("'"))
@@ -168,38 +165,57 @@ async def handle_text_message(message: Message):
         print(f"[SENT PHOTO ✅] {p}", flush=True)
         return True
 
-    # Đẩy coroutine về event loop từ thread khác
-    def _post(coro):
-        try:
-            asyncio.run_coroutine_threadsafe(coro, loop)
-        except Exception:
-            pass
-
-    # Hàm cập nhật UI gộp phần văn bản + phần tool
-    def _compose_and_edit():
-        nonlocal last_sent_html
+    # Gộp phần văn bản + phần tool thành text MDV2 (chạy trên loop, tối đa 1 lần / EDIT_INTERVAL)
+    def _compose(text: str, lines: tuple) -> str:
         # làm sạch ngay trong lúc stream để UI không lộ 'sei:...' hay ảnh markdown
-        main = buf_text
+        main = text
         main = re.sub(r'(?m)^\s*sei[:_][\w:]+(?:\([^)]*\))?\s*$', '', main)   # xóa dòng 'sei:staking_apr' / 'sei:...()'
         main = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', main)                      # xóa ![...](...)
         main = re.sub(r'\n{3,}', '\n\n', main).strip()
 
         safe_main = mdv2_escape_outside_code(main)
-        if tool_lines:
-            safe_main = f"{safe_main}\n\n" + "\n".join(tool_lines)
+        if lines:
+            safe_main = f"{safe_main}\n\n" + "\n".join(lines)
+        return safe_main
 
-        if safe_main == last_sent_html:
+    # consumer: state = ("stream", text, tool_lines) | ("final", md_text)
+    async def _render(state):
+        nonlocal last_sent_html
+        if state is None:
             return
-        last_sent_html = safe_main
-        _post(_edit_serialized(out_msg, safe_main))
-
-
+        safe = _compose(state[1], state[2]) if state[0] == "stream" else state[1]
+        if safe == last_sent_html:
+            return
+        last_sent_html = safe
+        await _safe_edit(out_msg, safe)
+
+    # consumer: item = ("photo", path, caption) | ("text", md_text)
+    async def _handle(item):
+        if item[0] == "photo":
+            await _send_photo(message, item[1], item[2])
+        elif item[0] == "text":
+            await message.answer(item[1], parse_mode=ParseMode.MARKDOWN_V2)
+
+    def _push_state():
+        chan.set_state(("stream", buf_text, tuple(tool_lines)))
+
+    # text cuối (MDV2) cho chan.close(("final", ...))
+    def _final_md(candidate: str) -> str:
+        candidate = candidate.strip() or "(đang trống)"
+        # Lọc rác lần cuối ở UI: xóa dòng 'sei:...' & markdown images nếu còn
+        candidate = re.sub(r'(?m)^\s*sei[:_][\w:]+(?:\([^)]*\))?\s*$', '', candidate)
+        candidate = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', candidate)
+        candidate = re.sub(r'\n{3,}', '\n\n', candidate).strip()
+
+        safe = mdv2_escape_outside_code(candidate)
+        if tool_lines:
+            safe = f"{safe}\n\n" + "\n".join(tool_lines)
+        return safe
 
     # Sink nhận sự kiện streaming từ LLM
     def sink(ev: dict):
-        nonlocal buf_text, tool_lines, last_edit, last_sent_html, best_text
+        nonlocal buf_text, tool_lines, best_text
         t = ev.get("type")
-        now = time.monotonic()
         if t == "tool_call":
             # Ẩn tool_call khỏi UI người dùng
             # (tuỳ chọn) in terminal để debug:
@@ -208,9 +224,6 @@ async def handle_text_message(message: Message):
             except Exception:
                 pass
             # KHÔNG append vào tool_lines
-            if (now - last_edit) >= EDIT_INTERVAL:
-                _compose_and_edit()
-                last_edit = now
 
         # elif t == "tool_result":
         #     image_path = ev.get("image_path")
@@ -244,9 +257,10 @@ async def handle_text_message(message: Message):
 
             if image_path:
                 print(f"[SEND PHOTO] (tool) -> {image_path}", flush=True)
-                _post_task(_send_photo(message, image_path, "Bảng đã tạo"), "send_photo_tool")
+                chan.put(("photo", image_path, "Bảng đã tạo"))
                 # (tuỳ chọn) hiển thị 1 dòng xác nhận
                 tool_lines.append(mdv2_escape_inline("📷 Ảnh bảng đã gửi."))
+                _push_state()
                 return
 
             # nếu muốn hiển thị text rút gọn từ tool:
@@ -256,9 +270,7 @@ async def handle_text_message(message: Message):
                 tool_lines.append("🔎 " + mdv2_escape_outside_code(snippet))
                 if len(tool_lines) > MAX_TOOL_LINES:
                     tool_lines[:] = tool_lines[-MAX_TOOL_LINES:]
-                if (now - last_edit) >= EDIT_INTERVAL:
-                    _compose_and_edit()
-                    last_edit = now
+                _push_state()
 
 
 
@@ -271,9 +283,7 @@ async def handle_text_message(message: Message):
             nonlocal best_text
             if len(buf_text) > len(best_text):
                 best_text = buf_text
-            if (now - last_edit) >= EDIT_INTERVAL or ("\n" in delta):
-                _compose_and_edit()
-                last_edit = now
+            _push_state()  # O(1): consumer tự gộp, edit tối đa 1 lần / EDIT_INTERVAL
             try:
                 print(delta, end="", flush=True)
             except Exception:
@@ -285,32 +295,17 @@ async def handle_text_message(message: Message):
             for p in ev.get("images") or []:
                 try:
                     print(f"[SEND PHOTO] (final) -> {p}", flush=True)
-                    # _post_task(_send_photo(message, p, "Kết quả"), "send_photo_final")
+                    # chan.put(("photo", p, "Kết quả"))
                     # tool_lines.append(mdv2_escape_inline("📷 Ảnh bảng đã gửi."))
                 except Exception as e:
-                    _post(message.answer(
-                        mdv2_escape_outside_code(f"Lỗi gửi ảnh: {type(e).__name__}: {e}"),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    ))
+                    chan.put(("text", mdv2_escape_outside_code(f"Lỗi gửi ảnh: {type(e).__name__}: {e}")))
 
             # Ưu tiên bản dài nhất giữa ev.final_text và best_text/buf_text
             ft = (ev.get("final_text") or "").strip()
             candidate = ft if len(ft) >= len(best_text) else best_text
-            candidate = candidate.strip() or "(đang trống)"
-
-            # Lọc rác lần cuối ở UI: xóa dòng 'sei:...' & markdown images nếu còn
-            candidate = re.sub(r'(?m)^\s*sei[:_][\w:]+(?:\([^)]*\))?\s*$', '', candidate)
-            candidate = re.sub(r'!\[[^\]]*\]\([^)]+\)', '', candidate)
-            candidate = re.sub(r'\n{3,}', '\n\n', candidate).strip()
 
-            safe = mdv2_escape_outside_code(candidate)
-            if tool_lines:
-                safe = f"{safe}\n\n" + "\n".join(tool_lines)
-
-            async def _final():
-                await asyncio.sleep(0.7)
-                await _edit_serialized(out_msg, safe)
-            _post(_final())
+            # trạng thái cuối: consumer xử lý sau mọi edit/ảnh trước đó (đúng thứ tự, không cần sleep)
+            chan.close(("final", _final_md(candidate)))
 
 
     # Chạy LLM (tự nhận diện kiểu trả về: generator hay dict)
@@ -321,7 +316,8 @@ async def handle_text_message(message: Message):
             session_id=sid,
             telegram=True,
             sink=sink,
-            print_live=True # in ra UI qua sink, không in console
+            print_live=True, # in ra UI qua sink, không in console
+            deadline=dl,
         )
 
         # Trường hợp 1: asking_stream là GENERATOR -> iterate để nhận event
@@ -342,14 +338,26 @@ async def handle_text_message(message: Message):
 
         # except Exception as e:
         #     # Báo lỗi lên UI nhưng không làm crash request
-        #     _post(_safe_edit(out_msg, f"❌ Lỗi xử lý: <code>{html.escape(type(e).__name__)}: {html.escape(str(e))}</code>"))
+        #     chan.close(("final", mdv2_escape_inline(f"❌ Lỗi xử lý: {type(e).__name__}: {e}")))
+
+    # 1 consumer cho cả request: xả kênh tới khi close()
+    consumer = asyncio.create_task(chan.run(_render, _handle))
 
     # Gọi executor để không block event loop
     fut = loop.run_in_executor(None, run_llm)
 
     # Giữ trạng thái 'typing...' xuyên suốt đến khi LLM xong
     async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
-        await fut  # đợi stream hoàn tất
+        try:
+            # đợi stream hoàn tất; thread LLM treo quá deadline + grace → chốt phần đã có
+            rem = dl.remaining()
+            await asyncio.wait_for(asyncio.shield(fut), None if rem is None else rem + DEADLINE_GRACE)
+        except asyncio.TimeoutError:
+            dl.expire("handler")
+            chan.close(("final", _final_md(f"{best_text}\n\n{dl.note()}")))
+        finally:
+            chan.close()  # LLM lỗi/không có 'done' → vẫn dừng consumer
+            await consumer
         # except Exception as e:
         #     # Chặn 500 & báo lỗi ra chat
         #     err = f"❌ Lỗi xử lý ngoài: <code>{html.escape(type(e).__name__)}: {html.escape(str(e))}</code>"
@@ -363,6 +371,35 @@ async def telegram_webhook(request: Request):
     await dp.feed_update(bot, update)
     return {"ok": True}
 
+# ================= Health =================
+@app.get("/healthz")
+async def healthz():
+    """Liveness: process sống + trạng thái/hàng đợi MCP + dung lượng kho ảnh/artifact (không bao giờ trả lỗi vì MCP)."""
+    sch = llm.mcp.schema_stats()
+    return {"ok": True, "mcp": llm.mcp.status(), "artifacts": await asyncio.to_thread(ARTIFACTS.stats),
+            "tool_schema_tokens": {k: sch[k] for k in ("tools", "before", "after", "saved_pct")},
+            "mcp_queues": llm.mcp.queue_stats()}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: 200 khi đã khởi động xong và phục vụ được (≥ 1 MCP server ready, server "required" đều ready);
+    503 khi còn đang khởi động, mọi server lỗi, hoặc server bắt buộc lỗi. Body giữ chi tiết từng server.
+    """
+    st = llm.mcp.status()
+    return JSONResponse(st, status_code=200 if st["serving"] else 503)
+
+# ================= Admin =================
+@app.post("/admin/mcp/reload")
+async def admin_mcp_reload(request: Request):
+    """Đọc lại mcp.json (thêm/gỡ/khởi động lại server, list lại tool) — header X-Admin-Token = ADMIN_TOKEN."""
+    token = request.headers.get("x-admin-token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return JSONResponse({"ok": False, "error": "forbidden"}, status_code=403)
+    res = await asyncio.to_thread(llm.mcp.reload)
+    ok = "error" not in res
+    return JSONResponse({"ok": ok, **res}, status_code=200 if ok else 400)
+
 @app.on_event("startup")
 async def on_startup():
     try:
@@ -375,4 +412,7 @@ async def on_shutdown():
     try:
         await bot.delete_webhook()
     except Exception:
-        pass
\ No newline at end of file
+        pass
+    # đóng session MCP (subprocess) gọn gàng
+    await asyncio.to_thread(llm.mcp.stop)
+    ARTIFACTS.stop()
\ No newline at end of file
@@ -1,17 +1,52 @@
 # mcp_bridge.py
-import os, json, base64, tempfile, traceback, threading, asyncio
-from typing import Any, Dict, List, Optional, Tuple
+import os, json, base64, copy, traceback, threading, asyncio, time, random
+import contextlib
+import concurrent.futures
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
 import re
+from metrics import METRICS
+from mcp_store import ImmutableStore
+from artifact_store import ARTIFACTS
+from mcp_record import Recorder
+from result_compactor import DEFAULT_POLICY, compact_text, loads_json
+from schema_compactor import compact_tool, schema_policy, summarize
+from tool_ranker import ToolRanker
+from admission import AdmissionRejected, PriorityLimiter, priority_of
 # ===== Import API MCP mới (1.13.x) =====
 MCP_AVAILABLE = True
 try:
     from mcp import ClientSession, StdioServerParameters
     from mcp.client.stdio import stdio_client
+    from mcp.client.streamable_http import streamablehttp_client
+    from mcp.client.sse import sse_client
+    import mcp.types as mcp_types
+    import anyio
+    import httpx
 except Exception as e:
     MCP_AVAILABLE = False
     print("[MCP] Python MCP SDK import failed:", type(e).__name__, e)
     traceback.print_exc()
 
+class _Registry(NamedTuple):
+    """Snapshot bất biến của danh sách tool — đổi cả object (1 phép gán) khi tool thay đổi."""
+    tools: Mapping[str, Tuple[str, Dict[str, Any]]]   # sanitized -> (server, meta)
+    san_to_full: Mapping[str, str]
+    full_to_san: Mapping[str, str]
+    metas: Tuple[Dict[str, Any], ...]                 # theo thứ tự đăng ký, cho anthropic_tools()
+    ranker: ToolRanker                                # index BM25 trên metas, cho rank_tools()
+
+
+_EMPTY_REGISTRY = _Registry(MappingProxyType({}), MappingProxyType({}), MappingProxyType({}), (), ToolRanker(()))
+
+
+def _exc_text(e: BaseException) -> str:
+    """'Type: msg' — ExceptionGroup (anyio TaskGroup của transport HTTP) → lỗi gốc đầu tiên bên trong."""
+    while getattr(e, "exceptions", None):   # BaseExceptionGroup (builtin từ 3.11, backport trước đó)
+        e = e.exceptions[0]
+    return f"{type(e).__name__}: {e}"
+
+
 class MCPBridge:
 
     def __init__(self, config_path: str = "mcp.json"):
@@ -21,17 +56,86 @@ class MCPBridge:
         self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._thread: Optional[threading.Thread] = None
         self._loop_ready = threading.Event()
+        # MCP state (chỉ truy cập trong loop nền)
+        # server_name -> pool session (xem _start_server); call_tool chọn session ít tải nhất
+        self._pools: Dict[str, Dict[str, Any]] = {}
+        # bản nháp danh sách tool (chỉ sửa trong loop nền) → _publish_registry() phát hành snapshot
         self._san_to_full: Dict[str, str] = {}   # sanitized -> "server:tool"
         self._full_to_san: Dict[str, str] = {}   # "server:tool" -> sanitized
-
-        # MCP state (chỉ truy cập trong loop nền)
-        self._sessions: Dict[str, ClientSession] = {}    # server_name -> session
-        self._tools: Dict[str, Tuple[str, Dict[str, Any]]] = {}  # full_tool_name -> (server_name, meta)
+        self._tools: Dict[str, Tuple[str, Dict[str, Any]]] = {}  # sanitized -> (server_name, meta)
+        # snapshot đọc được từ mọi thread, không cần nhảy vào loop nền
+        self._registry: _Registry = _EMPTY_REGISTRY
+        # timeout mặc định cho exec_tool / exec_tool_async (giây, 0 = không giới hạn)
+        self.call_timeout = float(os.getenv("MCP_CALL_TIMEOUT", "60"))
         from contextlib import AsyncExitStack
         self._AsyncExitStack = AsyncExitStack
-        self._stacks: Dict[str, Any] = {}  # server_name -> AsyncExitStack
+        # mỗi session 1 task sống lâu giữ AsyncExitStack (anyio yêu cầu mở/đóng context trong CÙNG task)
+        self._runners: Dict[str, asyncio.Task] = {}       # "server#id" -> runner task
+        # timeout khởi động mỗi server (spawn + initialize + list_tools); mcp.json "startupTimeout" ghi đè
+        self.startup_timeout = float(os.getenv("MCP_STARTUP_TIMEOUT", "60"))
+        # health check: ping session rảnh mỗi ping_interval giây (0 = tắt); mất kết nối → reconnect backoff
+        self.ping_interval = float(os.getenv("MCP_PING_INTERVAL", "30"))
+        self.ping_timeout = float(os.getenv("MCP_PING_TIMEOUT", "10"))
+        self.reconnect_max_delay = float(os.getenv("MCP_RECONNECT_MAX_DELAY", "60"))
+        self._stopping = False
+        # hot reload mcp.json: theo dõi file mỗi watch_interval giây (0 = tắt; vẫn reload() thủ công được)
+        self.watch_interval = float(os.getenv("MCP_CONFIG_WATCH", "2"))
+        self.drain_timeout = float(os.getenv("MCP_DRAIN_TIMEOUT", "30"))
+        # server HTTP (mcp.json "url"): số kết nối keep-alive giữ lại mỗi server
+        self.http_keepalive = int(os.getenv("MCP_HTTP_KEEPALIVE", "16"))
+        # admission control (admission.py): call đồng thời / hàng đợi / ưu tiên theo server + tool
+        # (mcp.json "limits"); server không khai báo → mặc định env. Hàng đợi đầy → từ chối ngay.
+        self._default_limits = {
+            "max_concurrent": int(os.getenv("MCP_MAX_CONCURRENT", "0")),   # 0 = không giới hạn
+            "max_queue": int(os.getenv("MCP_MAX_QUEUE", "64")),            # -1 = không giới hạn
+            "queue_timeout": float(os.getenv("MCP_QUEUE_TIMEOUT", "0")),   # 0 = chỉ theo timeout của call
+            "tools": {},
+        }
+        self._limit_policies: Dict[str, Dict[str, Any]] = {}              # server -> limits đã parse
+        self._limiters: Dict[Tuple[str, str], PriorityLimiter] = {}       # (server, tool | "*") -> limiter
+        self._specs: Dict[str, Dict[str, Any]] = {}      # server -> spec đang áp dụng (để diff khi reload)
+        self._config_sig: Optional[Tuple[int, int]] = None  # (mtime_ns, size) của mcp.json lúc đọc
+        self._reload_lock: Optional[asyncio.Lock] = None
+        self._watch_task: Optional[asyncio.Task] = None
+
+        # cache kết quả tool (chỉ truy cập trong loop nền)
+        # key = (server, tool, canonical args) -> (expire_at_monotonic, result)
+        self._cache: Dict[Tuple[str, str, str], Tuple[float, Dict[str, Any]]] = {}
+        self._inflight: Dict[Tuple[str, str, str], asyncio.Future] = {}   # single-flight
+        self._cache_policies: Dict[str, Dict[str, float]] = {}  # server -> {tool|"*": ttl_seconds}
+        # số entry tối đa MỖI server (mcp.json "cache.max_entries" ghi đè cho server đó)
+        self._cache_max_entries = int(os.getenv("MCP_CACHE_MAX_ENTRIES", "512"))
+        self._cache_caps: Dict[str, int] = {}                   # server -> max_entries
+
+        # kho bất biến trên đĩa (tx/block đã finalize) — bật qua mcp.json
+        self._store: Optional[ImmutableStore] = None
+        self._immutable_tools: Dict[str, set] = {}  # server -> {tool}
+
+        # policy thu gọn kết quả (max_items/max_str/fields theo tool) — chatbot dùng trước vòng 2
+        self._compact_policies: Dict[str, Dict[str, Any]] = {}  # server -> raw "compact" cfg
+
+        # thu gọn định nghĩa tool gửi cho Claude (xem schema_compactor.py) — server -> raw "schema" cfg
+        # (không có key = policy mặc định, false = giữ nguyên); token trước/sau theo tool để báo cáo
+        self._schema_policies: Dict[str, Any] = {}
+        self._schema_stats: Dict[str, Dict[str, Dict[str, int]]] = {}  # server -> {full: {"before", "after"}}
+
+        # result lớn (> spill_chars ký tự) → ghi từng phần ra kho artifact (trong executor, không chặn loop);
+        # result trả về chỉ còn "text" rút gọn + "spill_path", không giữ object đầy đủ (0 = tắt)
+        self.spill_chars = int(os.getenv("MCP_SPILL_BYTES", str(1024 * 1024)))
+
+        # MCP_RECORD=path.jsonl → ghi list_tools/call_tool ra file để replay bằng fake_mcp.py (xem mcp_record.py)
+        self._recorder: Optional[Recorder] = Recorder.from_env()
+        if self._recorder is not None:
+            print(f"[MCP] Recording traffic to {self._recorder.path}")
 
         self._started = False
+        # khởi động nền: trạng thái từng server + cờ "đã xong" (ready/failed đều tính là xong)
+        # _server_status chỉ ghi trong loop nền, mỗi entry được thay nguyên dict → đọc copy từ thread khác vẫn an toàn
+        self._server_status: Dict[str, Dict[str, Any]] = {}
+        self._ready = threading.Event()
+        self._start_task: Optional[asyncio.Future] = None
+        self._start_t0: Optional[float] = None
+        self._start_t1: Optional[float] = None
 
     # ---------- public ----------
     def _sanitize_name(self, full: str) -> str:
@@ -49,6 +153,7 @@ class MCPBridge:
         """
         if not MCP_AVAILABLE:
             print("[MCP] Python MCP SDK not available (see import error above).")
+            self._ready.set()
             return
 
         self._ensure_loop_thread()
@@ -60,6 +165,58 @@ class MCPBridge:
             print(f"[MCP] Start failed: {type(e).__name__}: {e}")
             traceback.print_exc()
 
+    def start_background(self) -> None:
+        """
+        Như start() nhưng không chờ: spawn/list server chạy trong loop nền.
+        Câu hỏi không cần MCP phục vụ được ngay; câu cần MCP dùng wait_ready().
+        """
+        if not MCP_AVAILABLE:
+            print("[MCP] Python MCP SDK not available (see import error above).")
+            self._ready.set()
+            return
+        self._ensure_loop_thread()
+        fut = asyncio.run_coroutine_threadsafe(self._start_async(), self._loop)
+
+        def _done(f):
+            try:
+                f.result()
+            except Exception as e:
+                print(f"[MCP] Start failed: {type(e).__name__}: {e}")
+        fut.add_done_callback(_done)
+
+    def is_ready(self) -> bool:
+        """True khi mọi server đã khởi động xong (thành công hoặc lỗi)."""
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Trạng thái khởi động cho /healthz, /readyz: {"ready", "serving", "elapsed_s", "servers": {name: {...}}}.
+        serving = khởi động xong + có ít nhất 1 server ready + mọi server "required": true trong mcp.json đều ready.
+        """
+        servers = {k: dict(v) for k, v in list(self._server_status.items())}
+        for k, v in servers.items():
+            if (self._specs.get(k) or {}).get("required"):
+                v["required"] = True
+        now = time.monotonic()
+        for k, pool in list(self._pools.items()):
+            if k in servers:
+                down = pool["downtime_s"] + ((now - pool["down_since"]) if pool["down_since"] is not None else 0.0)
+                live = [sl for sl in list(pool["slots"]) if not sl["stop"].is_set()]
+                servers[k].update({
+                    "sessions": len(live),
+                    "available": bool(live),
+                    "reconnects": pool["reconnects"],
+                    "downtime_s": round(down, 3),
+                })
+        elapsed = ((self._start_t1 or time.monotonic()) - self._start_t0) if self._start_t0 is not None else 0.0
+        up = {k for k, v in servers.items() if v.get("state") == "ready" and v.get("available", True)}
+        serving = (self._ready.is_set() and (not servers or bool(up))
+                   and all(k in up for k, v in servers.items() if v.get("required")))
+        return {"ready": self._ready.is_set(), "serving": serving, "elapsed_s": round(elapsed, 3), "servers": servers}
+
     async def start_async(self) -> None:
         """Nếu muốn tự await trong async context, dùng hàm này. (Không bắt buộc)"""
         if not MCP_AVAILABLE:
@@ -69,59 +226,176 @@ class MCPBridge:
         await self._start_async()
 
     def anthropic_tools(self) -> List[Dict[str, Any]]:
-        # Truy cập an toàn: copy snapshot từ loop nền
-        def _get():
-            return [meta for (_, meta) in self._tools.values()]
-        return self._run_func_in_loop(_get) or []
+        # đọc snapshot (không nhảy vào loop nền); copy meta để caller sửa thoải mái
+        return [dict(meta) for meta in self._registry.metas]
+
+    def rank_tools(self, query: str, k: int, must: Optional[List[str]] = None,
+                   allowed: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Top-k tool (dạng anthropic_tools()) liên quan tới `query` theo BM25 — tool trong `must` luôn có.
+        `allowed`: chỉ xét các tên này (None = mọi tool). k <= 0 → trả mọi tool được phép.
+        """
+        reg = self._registry
+        idx = reg.ranker.top_k(query, k, must or (), set(allowed) if allowed is not None else None)
+        return [dict(reg.metas[i]) for i in idx]
 
     def is_mcp_tool(self, name: str) -> bool:
-        def _has():
-            return name in self._tools
-        return bool(self._run_func_in_loop(_has))
+        return name in self._registry.tools
+
     def _resolve_full_name(self, maybe_san: str) -> Optional[str]:
+        reg = self._registry
         # nếu đã là full (có trong map) thì trả ngay
-        if maybe_san in self._san_to_full:
-            return self._san_to_full[maybe_san]
+        if maybe_san in reg.san_to_full:
+            return reg.san_to_full[maybe_san]
         # hoặc nếu đã là full (chứa ':') và có map ngược
-        if ":" in maybe_san and maybe_san in self._full_to_san:
+        if ":" in maybe_san and maybe_san in reg.full_to_san:
             return maybe_san
         # không biết -> None
         return None
-    def exec_tool(self, full_or_san: str, args: Dict[str, Any]) -> Dict[str, Any]:
+
+    def _resolve_san(self, full_or_san: str) -> Optional[str]:
+        full = self._resolve_full_name(full_or_san or "")
+        return self._registry.full_to_san.get(full) if full else None
+
+    def tool_name(self, full_or_san: str) -> Optional[str]:
+        """Tên sanitize (tên gửi cho Claude) của tool; None nếu không có."""
+        return self._resolve_san(full_or_san)
+
+    def exec_tool(self, full_or_san: str, args: Dict[str, Any], timeout: Optional[float] = None,
+                  deadline=None) -> Dict[str, Any]:
         """
         Nhận tên tool ở dạng sanitize (ví dụ: 'sei_get_chain_info') hoặc full 'server:tool'.
         Luôn trả về dict {"text": "..."} hoặc {"image_path": "..."}.
+        Blocking, tối đa `timeout` giây (mặc định MCP_CALL_TIMEOUT), không quá `deadline` của request.
         """
+        if not full_or_san:
+            return {"text": "[MCP] tool name is empty"}
         try:
-            if not full_or_san:
-                return {"text": "[MCP] tool name is empty"}
+            fut = self.submit_tool(full_or_san, args)
+        except Exception as e:
+            return {"text": f"[MCP] exec_tool error: {type(e).__name__}: {e}"}
+        if fut is None:
+            return {"text": f"[MCP] unknown tool: {full_or_san}"}
+        return self.wait_tool(fut, full_or_san, timeout, deadline)
 
-            # Resolve: sanitize -> full "server:tool"
-            full = self._resolve_full_name(full_or_san)
-            if not full:
-                return {"text": f"[MCP] unknown tool: {full_or_san}"}
+    def submit_tool(self, full_or_san: str, args: Dict[str, Any]) -> Optional[concurrent.futures.Future]:
+        """
+        Như exec_tool nhưng không chờ: trả concurrent.futures.Future của kết quả
+        (None nếu tool không tồn tại / loop chưa chạy). Dùng cho prefetch.
+        """
+        san = self._resolve_san(full_or_san)
+        if not san or not self._loop:
+            return None
+        return asyncio.run_coroutine_threadsafe(self._exec_tool_async(san, args or {}), self._loop)
 
-            # Lấy tên sanitize để tra self._tools (self._tools lưu key = sanitize)
-            san = self._full_to_san.get(full, full_or_san)
+    def wait_tool(self, fut: concurrent.futures.Future, name: str = "", timeout: Optional[float] = None,
+                  deadline=None) -> Dict[str, Any]:
+        """Đợi Future từ submit_tool; quá hạn (timeout hoặc deadline request) → huỷ call, trả {"text": "[MCP] ..."}."""
+        t = self.call_timeout if timeout is None else timeout
+        if deadline is not None:
+            t = deadline.clamp(t) or 0
+        try:
+            result = fut.result(t if t > 0 else None)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            METRICS.inc("mcp_call_timeouts", tool=self._resolve_san(name) or name)
+            if deadline is not None and deadline.expired():
+                deadline.expire("mcp")
+                return {"text": f"[MCP] {name} cancelled: request deadline reached"}
+            return {"text": f"[MCP] {name} timed out after {t:g}s"}
+        except Exception as e:
+            return {"text": f"[MCP] exec_tool error: {type(e).__name__}: {e}"}
+        return result if isinstance(result, dict) else {"text": str(result)}
 
-            # Chạy coroutine thực thi trên loop nền
-            result = self._run_coro_blocking(self._exec_tool_async(san, args or {}))
-            return result if isinstance(result, dict) else {"text": str(result)}
+    async def exec_tool_async(self, full_or_san: str, args: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Bản awaitable của exec_tool — gọi được từ BẤT KỲ event loop nào (kể cả loop nền).
+        Không bao giờ raise: lỗi/timeout trả về dict {"text": "[MCP] ..."}.
+        """
+        san = self._resolve_san(full_or_san)
+        if not san or not self._loop:
+            return {"text": f"[MCP] unknown tool: {full_or_san}"}
+        t = self.call_timeout if timeout is None else timeout
+        coro = self._exec_tool_async(san, args or {})
+        try:
+            if asyncio.get_running_loop() is self._loop:
+                aw = coro
+            else:
+                aw = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._loop))
+            result = await asyncio.wait_for(aw, t if t > 0 else None)
+        except asyncio.TimeoutError:
+            METRICS.inc("mcp_call_timeouts", tool=san)
+            return {"text": f"[MCP] {full_or_san} timed out after {t:g}s"}
         except Exception as e:
             return {"text": f"[MCP] exec_tool error: {type(e).__name__}: {e}"}
+        return result if isinstance(result, dict) else {"text": str(result)}
+
+    async def call_many(self, calls: List[Tuple[str, Dict[str, Any]]], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Chạy song song nhiều (tool, args); kết quả giữ đúng thứ tự đầu vào."""
+        return list(await asyncio.gather(*(self.exec_tool_async(n, a, timeout) for n, a in calls)))
 
+    def exec_tools(self, calls: List[Tuple[str, Dict[str, Any]]], timeout: Optional[float] = None,
+                   deadline=None) -> List[Dict[str, Any]]:
+        """call_many cho code đồng bộ (thread worker): song song, blocking tới khi xong hết (hoặc hết deadline)."""
+        if not calls:
+            return []
+        t = self.call_timeout if timeout is None else timeout
+        group_end = time.monotonic() + t
+        futs = [self.submit_tool(n, a) for n, a in calls]
+        out = []
+        for (name, _), fut in zip(calls, futs):
+            if fut is None:
+                out.append({"text": f"[MCP] unknown tool: {name}"})
+                continue
+            # cùng 1 mốc cho cả nhóm (các call chạy song song)
+            left = max(0.001, group_end - time.monotonic()) if t > 0 else 0
+            out.append(self.wait_tool(fut, name, left, deadline))
+        return out
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/coalesced theo tool + số entry đang giữ trong cache."""
+        snap = METRICS.snapshot("mcp_cache_")
+        out = {"size": len(self._cache), "counters": snap["counters"]}
+        if self._store is not None:
+            out["store"] = self._store.stats()
+            out["store"]["counters"] = METRICS.snapshot("mcp_store_")["counters"]
+        return out
+
+    def disable_cache(self) -> None:
+        """Bỏ qua cache TTL + kho bất biến (probe_mcp đo latency thật của server). reload() bật lại theo mcp.json."""
+        self._cache_policies = {}
+        self._immutable_tools = {}
+
+    def schema_stats(self) -> Dict[str, Any]:
+        """Token ước lượng của định nghĩa tool trước/sau khi thu gọn: tổng, theo server, theo tool."""
+        stats = dict(self._schema_stats)
+        per_tool = {full: dict(s) for tools in stats.values() for full, s in tools.items()}
+        return {
+            **summarize(per_tool),
+            "servers": {srv: summarize(tools) for srv, tools in stats.items()},
+            "tools": per_tool,
+        }
+
+    def compact_policy(self, full_or_san: str) -> Dict[str, Any]:
+        """Policy thu gọn result của 1 tool: {"max_items", "max_str", "prune_empty", "fields"} (field allowlist theo tool)."""
+        full = self._resolve_full_name(full_or_san) or ""
+        server, _, tool = full.partition(":")
+        cfg = self._compact_policies.get(server) or {}
+        pol = {k: cfg[k] for k in ("max_items", "max_str", "prune_empty") if k in cfg}
+        fields = (cfg.get("fields") or {}).get(tool)
+        if isinstance(fields, list) and fields:
+            pol["fields"] = [str(f) for f in fields]
+        return pol
 
     def find_image_table_tool(self) -> Optional[str]:
-        def _find():
-            for name, (_srv, meta) in self._tools.items():
-                nm = meta["name"].lower()
-                desc = (meta.get("description") or "").lower()
-                if ("table" in nm or "table" in desc) and any(
-                    k in nm or k in desc for k in ("image", "png", "render", "plot", "chart")
-                ):
-                    return name
-            return None
-        return self._run_func_in_loop(_find)
+        for name, (_srv, meta) in self._registry.tools.items():
+            nm = meta["name"].lower()
+            desc = (meta.get("description") or "").lower()
+            if ("table" in nm or "table" in desc) and any(
+                k in nm or k in desc for k in ("image", "png", "render", "plot", "chart")
+            ):
+                return name
+        return None
 
     # ---------- internal: loop/thread ----------
     def _ensure_loop_thread(self):
@@ -142,14 +416,19 @@ class MCPBridge:
         if not self._loop:
             raise RuntimeError("Failed to start MCP background loop")
 
-    def _run_coro_blocking(self, coro: asyncio.Future) -> Any:
+    def _run_coro_blocking(self, coro: asyncio.Future, timeout: Optional[float] = None) -> Any:
         """
         Chạy 1 coroutine trên loop nền và đợi kết quả (blocking) — an toàn vì loop ở thread khác.
+        Quá `timeout` giây → huỷ coroutine, raise concurrent.futures.TimeoutError.
         """
         if not self._loop:
             raise RuntimeError("MCP loop not started")
         fut = asyncio.run_coroutine_threadsafe(coro, self._loop)
-        return fut.result()
+        try:
+            return fut.result(timeout)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()
+            raise
 
     def _run_func_in_loop(self, fn):
         """
@@ -163,29 +442,752 @@ class MCPBridge:
     async def _start_async(self):
         if self._started:
             return
+        # start() và start_background() gọi chồng nhau → dùng chung 1 task
+        if self._start_task is None:
+            self._start_task = asyncio.ensure_future(self._start_servers())
+        await asyncio.shield(self._start_task)
+
+    async def _start_servers(self):
+        self._start_t0 = time.monotonic()
+        try:
+            await self._start_servers_inner()
+        finally:
+            self._start_t1 = time.monotonic()
+            self._started = True
+            self._ready.set()
+            print(f"[MCP] startup finished in {self._start_t1 - self._start_t0:.1f}s — {len(self._tools)} tool(s).")
+            if self.watch_interval > 0 and self._watch_task is None and not self._stopping:
+                self._watch_task = asyncio.ensure_future(self._watch_config())
+
+    async def _start_servers_inner(self):
         cfg = await self._load_config()
-        servers = cfg.get("mcpServers") or cfg.get("servers") or {}
-        if not isinstance(servers, dict) or not servers:
+        servers = self._servers_from(cfg)
+        if not servers:
             print("[MCP] No servers in config.")
-            self._started = True
             return
 
-        for name, spec in servers.items():
-            cmd = (spec or {}).get("command")
-            args = (spec or {}).get("args", [])
-            env  = (spec or {}).get("env", None)
-            if not cmd:
-                print(f"[MCP] Server '{name}' missing command — skip.")
+        for name in servers:
+            self._server_status[name] = {"state": "pending"}
+        self._open_store(cfg.get("immutableStore"))
+        starts = [self._prepare_server(name, spec) for name, spec in servers.items()]
+
+        # kết nối song song: tổng thời gian ≈ server chậm nhất, không phải tổng các server.
+        # Mỗi server đăng ký tool ngay khi nó sẵn sàng (không đợi server khác).
+        await asyncio.gather(*(c for c in starts if c is not None))
+
+    def _servers_from(self, cfg: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        servers = cfg.get("mcpServers") or cfg.get("servers") or {}
+        if not isinstance(servers, dict):
+            return {}
+        return {name: (spec if isinstance(spec, dict) else {}) for name, spec in servers.items()}
+
+    def _spawn_key(self, spec: Dict[str, Any]) -> str:
+        """Phần spec mà đổi thì phải khởi động lại process (còn lại áp dụng tại chỗ)."""
+        return json.dumps([spec.get("command"), spec.get("args", []), spec.get("env"),
+                           spec.get("url"), spec.get("transport"), spec.get("headers")], sort_keys=True, default=str)
+
+    def _apply_policies(self, name: str, spec: Dict[str, Any]) -> None:
+        """cache / compact / schema / immutable của 1 server (ghi đè bản cũ — dùng cả lúc reload)."""
+        self._cache_policies.pop(name, None)
+        self._cache_caps.pop(name, None)
+        self._compact_policies.pop(name, None)
+        self._schema_policies.pop(name, None)
+        self._immutable_tools.pop(name, None)
+        self._limit_policies.pop(name, None)
+        self._load_cache_policy(name, spec)
+        self._load_limit_policy(name, spec)
+        if isinstance(spec.get("compact"), dict):
+            self._compact_policies[name] = spec["compact"]
+        if "schema" in spec:
+            self._schema_policies[name] = spec["schema"]
+        tools_imm = spec.get("immutable") or []
+        if isinstance(tools_imm, list) and tools_imm:
+            self._immutable_tools[name] = {str(t) for t in tools_imm}
+
+    def _startup_timeout_of(self, spec: Dict[str, Any]) -> float:
+        try:
+            return float(spec.get("startupTimeout") or self.startup_timeout)
+        except (TypeError, ValueError):
+            return self.startup_timeout
+
+    def _transport_of(self, spec: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Cách kết nối 1 server:
+          {"command", "args", "env"}                    → stdio (spawn subprocess)
+          {"url", "transport"?, "headers"?}             → HTTP: "streamable-http" (mặc định) hoặc "sse"
+                                                          (url kết thúc bằng /sse → sse)
+        None nếu thiếu cả command lẫn url.
+        """
+        url = spec.get("url")
+        if isinstance(url, str) and url.strip():
+            url = url.strip()
+            kind = str(spec.get("transport") or ("sse" if url.rstrip("/").endswith("/sse") else "streamable-http"))
+            headers = {str(k): str(v) for k, v in (spec.get("headers") or {}).items() if v is not None}
+            return {"kind": kind.lower(), "url": url, "headers": headers}
+        cmd = spec.get("command")
+        if not cmd:
+            return None
+        return {"kind": "stdio", "cmd": self._resolve_cmd(cmd), "args": spec.get("args", []), "env": spec.get("env", None)}
+
+    def _prepare_server(self, name: str, spec: Dict[str, Any]):
+        """Ghi nhận spec + policy; trả coroutine khởi động server (None nếu thiếu command/url)."""
+        self._specs[name] = spec
+        self._apply_policies(name, spec)
+        transport = self._transport_of(spec)
+        if transport is None:
+            print(f"[MCP] Server '{name}' missing command or url — skip.")
+            self._server_status[name] = {"state": "skipped", "error": "missing command or url"}
+            return None
+        if transport["kind"] not in ("stdio", "streamable-http", "sse"):
+            print(f"[MCP] Server '{name}' unknown transport '{transport['kind']}' — skip.")
+            self._server_status[name] = {"state": "skipped", "error": f"unknown transport {transport['kind']}"}
+            return None
+        pool_cfg = self._load_pool_policy(name, spec)
+        return self._start_server(name, transport, self._startup_timeout_of(spec), pool_cfg)
+
+    async def _start_server(self, name: str, transport: Dict[str, Any], timeout: float, pool_cfg: Dict[str, Any]) -> None:
+        t0 = time.monotonic()
+        self._server_status[name] = {"state": "starting"}
+        pool = {
+            "cfg": pool_cfg, "spawn": transport, "timeout": timeout,
+            "http": None,       # httpx.AsyncClient dùng chung cho mọi session HTTP của server (keep-alive)
+            "slots": [],        # session đang sống: {"id", "session", "inflight", "last_used", "stop"}
+            "starting": 1,      # số session đang khởi động (tính luôn session đầu tiên)
+            "next_id": 0,
+            "waiters": [],      # future của caller đang chờ slot trống
+            "reaper": None,
+            "health": None,
+            "reconnecting": False,
+            "reconnects": 0,
+            "down_since": None,  # monotonic lúc mất session cuối cùng
+            "downtime_s": 0.0,
+            "closing": False,    # reload gỡ/khởi động lại server → không nhận call mới, không reconnect
+            "relist": None,      # task list lại tool (tools/list_changed), gộp nhiều thông báo liền nhau
+        }
+        self._pools[name] = pool
+        try:
+            # session đầu tiên: list tools + đăng ký vào registry
+            await self._spawn_session(name, list_tools=True)
+        except asyncio.TimeoutError:
+            print(f"[MCP] Server '{name}' did not start within {timeout:g}s — giving up.")
+            self._server_status[name] = {"state": "failed", "error": f"startup timeout ({timeout:g}s)",
+                                         "startup_s": round(time.monotonic() - t0, 3)}
+            return
+        except Exception as e:
+            print(f"[MCP] Connect '{name}' failed: {_exc_text(e)}")
+            traceback.print_exc()
+            self._server_status[name] = {"state": "failed", "error": _exc_text(e),
+                                         "startup_s": round(time.monotonic() - t0, 3)}
+            return
+        dt = time.monotonic() - t0
+        n_tools = sum(1 for srv, _ in self._tools.values() if srv == name)
+        METRICS.observe("mcp_startup_seconds", dt, server=name)
+        print(f"[MCP] Server '{name}' ready with {n_tools} tool(s) in {dt:.2f}s.")
+        self._server_status[name] = {"state": "ready", "tools": n_tools, "startup_s": round(dt, 3)}
+
+        # phần còn lại của pool (min) khởi động nền; có dải min..max thì bật reaper để co lại khi rảnh
+        for _ in range(pool_cfg["min"] - 1):
+            pool["starting"] += 1
+            asyncio.ensure_future(self._spawn_session_bg(name))
+        if pool_cfg["max"] > pool_cfg["min"]:
+            pool["reaper"] = asyncio.ensure_future(self._pool_reaper(name))
+        if self.ping_interval > 0:
+            pool["health"] = asyncio.ensure_future(self._health_loop(name))
+
+    async def _spawn_session(self, server: str, list_tools: bool = False) -> None:
+        """Mở thêm 1 session cho pool. Caller đã tăng pool["starting"]; raise nếu lỗi/timeout."""
+        pool = self._pools[server]
+        slot = {"id": pool["next_id"], "session": None, "inflight": 0,
+                "last_used": time.monotonic(), "stop": asyncio.Event(), "dead": asyncio.Event()}
+        pool["next_id"] += 1
+        ready = asyncio.get_running_loop().create_future()
+        ready.add_done_callback(lambda f: f.cancelled() or f.exception())  # tránh warning "never retrieved"
+        task = asyncio.ensure_future(self._session_runner(server, slot, list_tools, ready))
+        self._runners[f"{server}#{slot['id']}"] = task
+        timeout = pool["timeout"]
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            task.cancel()
+            raise
+        finally:
+            pool["starting"] -= 1
+            self._pool_changed(server)
+
+    async def _spawn_session_bg(self, server: str) -> None:
+        try:
+            await self._spawn_session(server)
+        except Exception as e:
+            print(f"[MCP] Server '{server}' extra session failed: {_exc_text(e)}")
+
+    async def _session_runner(self, server: str, slot: Dict[str, Any], list_tools: bool, ready: asyncio.Future) -> None:
+        """Mở 1 session, báo `ready`, rồi giữ tới khi có tín hiệu đóng — đóng trong chính task này (anyio)."""
+        pool = self._pools[server]
+        try:
+            async with self._AsyncExitStack() as stack:
+                session = await self._open_session(
+                    stack, pool, on_eof=lambda: self._mark_dead(server, slot, "transport closed"),
+                    message_handler=self._notification_handler(server),
+                )
+                if list_tools:
+                    await self._list_and_register(server, session)
+                slot["session"] = session
+                slot["last_used"] = time.monotonic()
+                pool["slots"].append(slot)
+                if pool["down_since"] is not None:
+                    pool["downtime_s"] += time.monotonic() - pool["down_since"]
+                    pool["down_since"] = None
+                if not ready.done():
+                    ready.set_result(True)
+                self._pool_changed(server)
+                await slot["stop"].wait()
+        except asyncio.CancelledError:
+            if not ready.done():
+                ready.cancel()
+            raise
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                print(f"[MCP] Server '{server}' session #{slot['id']} ended: {_exc_text(e)}")
+                # transport HTTP báo lỗi bằng exception (không phải EOF như stdio) → cùng đường mất kết nối
+                if self._pools.get(server) is pool:
+                    self._mark_dead(server, slot, f"transport error ({_exc_text(e).split(':')[0]})")
+        finally:
+            if slot in pool["slots"]:
+                pool["slots"].remove(slot)
+            self._runners.pop(f"{server}#{slot['id']}", None)
+            if slot["session"] is not None and not pool["slots"] and pool["down_since"] is None:
+                pool["down_since"] = time.monotonic()
+            # đang reconnect → giữ tool (call trả lỗi nhanh, model báo được tool nào lỗi)
+            if not pool["slots"] and not pool["starting"] and not pool["reconnecting"]:
+                self._drop_server_tools(server)
+            self._pool_changed(server)
+
+    # ---------- internal: health / reconnect ----------
+    def _mark_dead(self, server: str, slot: Dict[str, Any], reason: str) -> None:
+        """Session hỏng (process chết, pipe gãy, ping lỗi): call đang chạy trên nó lỗi ngay, runner đóng + reconnect."""
+        if slot["dead"].is_set() or slot["stop"].is_set():
+            return
+        slot["dead"].set()
+        slot["stop"].set()
+        METRICS.inc("mcp_session_lost", server=server)
+        print(f"[MCP] Server '{server}' session #{slot['id']} lost: {reason}")
+        self._server_status[server] = {**self._server_status.get(server, {}), "error": reason}
+        pool = self._pools[server]
+        if pool["down_since"] is None and not any(not s["stop"].is_set() for s in pool["slots"]):
+            pool["down_since"] = time.monotonic()
+        # reconnect ngay (không đợi runner đóng xong) → _acquire thấy "reconnecting", không mở session trùng
+        if slot["session"] is not None and not self._stopping:
+            self._maybe_reconnect(server)
+
+    def _maybe_reconnect(self, server: str) -> None:
+        pool = self._pools[server]
+        live = [s for s in pool["slots"] if not s["stop"].is_set()]
+        if pool["reconnecting"] or pool["closing"] or len(live) >= pool["cfg"]["min"]:
+            return
+        pool["reconnecting"] = True
+        asyncio.ensure_future(self._reconnect(server))
+
+    async def _reconnect(self, server: str) -> None:
+        """Mở lại session (list lại tool) với backoff mũ + jitter tới khi được hoặc bridge dừng."""
+        pool = self._pools[server]
+        attempt = 0
+        try:
+            while not self._stopping and not pool["closing"]:
+                attempt += 1
+                self._server_status[server] = {
+                    **self._server_status.get(server, {}), "state": "reconnecting", "attempt": attempt,
+                }
+                pool["starting"] += 1
+                t0 = time.monotonic()
+                try:
+                    await self._spawn_session(server, list_tools=True)
+                except Exception as e:
+                    err = "startup timeout" if isinstance(e, asyncio.TimeoutError) else _exc_text(e)
+                    delay = random.uniform(0.5, 1.0) * min(self.reconnect_max_delay, 2 ** (attempt - 1))
+                    print(f"[MCP] Reconnect '{server}' attempt {attempt} failed: {err} — retry in {delay:.1f}s.")
+                    METRICS.inc("mcp_reconnect_failures", server=server)
+                    self._server_status[server] = {**self._server_status[server], "error": err}
+                    await asyncio.sleep(delay)
+                    continue
+                pool["reconnects"] += 1
+                n_tools = sum(1 for srv, _ in self._tools.values() if srv == server)
+                METRICS.inc("mcp_reconnects", server=server)
+                print(f"[MCP] Server '{server}' reconnected (attempt {attempt}) with {n_tools} tool(s) in {time.monotonic() - t0:.2f}s.")
+                self._server_status[server] = {"state": "ready", "tools": n_tools,
+                                               "startup_s": round(time.monotonic() - t0, 3)}
+                return
+        finally:
+            pool["reconnecting"] = False
+            self._pool_changed(server)
+
+    async def _health_loop(self, server: str) -> None:
+        """Ping các session đang rảnh (session bận đã có call timeout lo)."""
+        pool = self._pools[server]
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            for s in list(pool["slots"]):
+                if s["stop"].is_set() or s["inflight"] > 0:
+                    continue
+                t0 = time.monotonic()
+                try:
+                    await asyncio.wait_for(s["session"].send_ping(), self.ping_timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._mark_dead(server, s, f"ping failed ({type(e).__name__})")
+                    continue
+                METRICS.observe("mcp_ping_seconds", time.monotonic() - t0, server=server)
+
+    # ---------- internal: hot reload / tools/list_changed ----------
+    async def _reload_async(self) -> Dict[str, Any]:
+        if not self._started:
+            # chưa khởi động xong lần đầu → reload = chờ/chạy start (đọc config mới nhất)
+            await self._start_async()
+            return {"added": list(self._specs), "removed": [], "restarted": [], "updated": [], "relisted": []}
+        if self._reload_lock is None:
+            self._reload_lock = asyncio.Lock()
+        async with self._reload_lock:
+            return await self._reload_locked()
+
+    async def _reload_locked(self) -> Dict[str, Any]:
+        t0 = time.monotonic()
+        cfg = await self._load_config()
+        if not cfg:
+            # file hỏng/mất giữa chừng → giữ nguyên server đang chạy (không gỡ hết vì 1 lần ghi dở)
+            METRICS.inc("mcp_reload_errors")
+            print(f"[MCP] Reload skipped: {self.config_path} missing or invalid.")
+            return {"error": f"config missing or invalid: {self.config_path}"}
+        servers = self._servers_from(cfg)
+        self._open_store(cfg.get("immutableStore"))
+
+        retry = {n for n, st in self._server_status.items() if st.get("state") in ("failed", "skipped")}
+        added = [n for n in servers if n not in self._specs or n in retry]
+        removed = [n for n in self._specs if n not in servers]
+        kept = [n for n in servers if n not in added]
+        restarted = [n for n in kept if self._spawn_key(self._specs[n]) != self._spawn_key(servers[n])]
+        updated = [n for n in kept if n not in restarted and self._specs[n] != servers[n]]
+        relisted = [n for n in kept if n not in restarted]
+
+        # 1) gỡ server bị xoá / đổi command-args-env (drain song song); pool hỏng của server failed cũng dọn
+        gone = removed + restarted + [n for n in added if n in self._pools]
+        await asyncio.gather(*(self._stop_server(n) for n in gone))
+        for n in removed:
+            self._specs.pop(n, None)
+            for policies in (self._cache_policies, self._cache_caps, self._compact_policies, self._schema_policies,
+                             self._immutable_tools, self._schema_stats, self._limit_policies):
+                policies.pop(n, None)
+            for key in [k for k in self._limiters if k[0] == n]:
+                self._limiters.pop(key, None)   # call còn đang chờ giữ tham chiếu riêng → vẫn release được
+
+        # 2) chỉ đổi policy → áp dụng tại chỗ, giữ session
+        for n in updated:
+            self._specs[n] = servers[n]
+            self._apply_policies(n, servers[n])
+            self._update_pool(n, servers[n])
+
+        # 3) khởi động server mới / khởi động lại + list lại tool của server giữ nguyên (song song)
+        for n in added + restarted:
+            self._server_status[n] = {"state": "pending"}
+        starts = [self._prepare_server(n, servers[n]) for n in added + restarted]
+        await asyncio.gather(*(c for c in starts if c is not None), *(self._relist(n) for n in relisted))
+
+        summary = {"added": added, "removed": removed, "restarted": restarted, "updated": updated,
+                   "relisted": relisted, "tools": len(self._tools), "elapsed_s": round(time.monotonic() - t0, 3)}
+        METRICS.inc("mcp_reloads")
+        print(f"[MCP] Reload done in {summary['elapsed_s']:.2f}s — added={added} removed={removed} "
+              f"restarted={restarted} updated={updated}, {len(self._tools)} tool(s).")
+        return summary
+
+    async def _stop_server(self, name: str) -> None:
+        """Gỡ 1 server: gỡ tool (call mới không tới nữa) → đợi call đang chạy (≤ drain_timeout) → đóng session."""
+        self._drop_server_tools(name)
+        for k in [k for k in self._cache if k[0] == name]:
+            self._cache.pop(k, None)
+        self._server_status.pop(name, None)
+        pool = self._pools.get(name)
+        if pool is None:
+            return
+        pool["closing"] = True
+        for bg in (pool["reaper"], pool["health"], pool["relist"]):
+            if bg is not None:
+                bg.cancel()
+        self._pool_changed(name)  # caller đang chờ slot → tỉnh dậy, nhận "unavailable"
+
+        t_end = time.monotonic() + self.drain_timeout
+        while any(s["inflight"] for s in pool["slots"]):
+            left = t_end - time.monotonic()
+            if left <= 0:
+                n = sum(s["inflight"] for s in pool["slots"])
+                print(f"[MCP] Server '{name}' drain timeout — closing with {n} call(s) in flight.")
+                break
+            fut = asyncio.get_running_loop().create_future()
+            pool["waiters"].append(fut)
+            try:
+                await asyncio.wait_for(fut, left)
+            except asyncio.TimeoutError:
+                pass
+
+        for s in pool["slots"]:
+            s["stop"].set()
+        tasks = [t for k, t in list(self._runners.items()) if k.rsplit("#", 1)[0] == name]
+        if tasks:
+            _done, pending = await asyncio.wait(tasks, timeout=5)
+            for t in pending:
+                t.cancel()
+        if self._pools.get(name) is pool:
+            self._pools.pop(name, None)
+        await self._close_http(pool)
+        METRICS.set("mcp_pool_sessions", 0, server=name)
+        METRICS.set("mcp_pool_inflight", 0, server=name)
+        print(f"[MCP] Server '{name}' stopped.")
+
+    def _update_pool(self, name: str, spec: Dict[str, Any]) -> None:
+        """Đổi "pool"/"startupTimeout" khi reload mà không khởi động lại server."""
+        pool = self._pools.get(name)
+        if pool is None:
+            return
+        pool["cfg"] = self._load_pool_policy(name, spec)
+        pool["timeout"] = self._startup_timeout_of(spec)
+        live = sum(1 for s in pool["slots"] if not s["stop"].is_set())
+        for _ in range(pool["cfg"]["min"] - live - pool["starting"]):
+            pool["starting"] += 1
+            asyncio.ensure_future(self._spawn_session_bg(name))
+        if pool["cfg"]["max"] > pool["cfg"]["min"] and pool["reaper"] is None:
+            pool["reaper"] = asyncio.ensure_future(self._pool_reaper(name))
+
+    async def _relist(self, server: str, delay: float = 0.0) -> None:
+        """List lại tool của server qua 1 session đang sống (reload / tools/list_changed)."""
+        if delay > 0:
+            await asyncio.sleep(delay)
+        pool = self._pools.get(server)
+        if pool is None or pool["closing"]:
+            return
+        slot = next((s for s in pool["slots"] if not s["stop"].is_set()), None)
+        if slot is None:
+            return
+        before = {san for san, (srv, _) in self._tools.items() if srv == server}
+        try:
+            await asyncio.wait_for(self._list_and_register(server, slot["session"]), pool["timeout"] or None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[MCP] Re-list '{server}' failed: {_exc_text(e)}")
+            return
+        after = {san for san, (srv, _) in self._tools.items() if srv == server}
+        st = self._server_status.get(server) or {}
+        if st.get("state") == "ready":
+            self._server_status[server] = {**st, "tools": len(after)}
+        if after != before:
+            print(f"[MCP] Server '{server}' tools changed: +{len(after - before)} -{len(before - after)} "
+                  f"({len(after)} total).")
+
+    def _notification_handler(self, server: str):
+        """message_handler cho ClientSession: bắt notifications/tools/list_changed."""
+        async def _on_message(msg) -> None:
+            if isinstance(getattr(msg, "root", None), mcp_types.ToolListChangedNotification):
+                METRICS.inc("mcp_tools_list_changed", server=server)
+                self._schedule_relist(server)
+        return _on_message
+
+    def _schedule_relist(self, server: str) -> None:
+        pool = self._pools.get(server)
+        if pool is None or pool["closing"]:
+            return
+        if pool["relist"] is not None and not pool["relist"].done():
+            return  # nhiều session / nhiều thông báo liền nhau → gộp thành 1 lần list
+        pool["relist"] = asyncio.ensure_future(self._relist(server, delay=0.5))
+
+    async def _watch_config(self) -> None:
+        """Poll mtime/size của mcp.json; đổi → reload (không cần thư viện watch)."""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                st = os.stat(self.config_path)
+            except OSError:
+                continue  # file tạm thời biến mất (editor ghi kiểu rename) → đợi nhịp sau
+            if (st.st_mtime_ns, st.st_size) == self._config_sig:
                 continue
-            cmd_resolved = self._resolve_cmd(cmd)
+            await asyncio.sleep(min(1.0, self.watch_interval))  # editor thường ghi nhiều lần liền nhau
+            print(f"[MCP] {self.config_path} changed — reloading.")
             try:
-                await self._connect_and_list(name, cmd_resolved, args, env)
+                await self._reload_async()
             except Exception as e:
-                print(f"[MCP] Connect '{name}' failed: {type(e).__name__}: {e}")
+                METRICS.inc("mcp_reload_errors")
+                print(f"[MCP] Reload failed: {type(e).__name__}: {e}")
                 traceback.print_exc()
-                continue
 
-        self._started = True
+    # ---------- internal: session pool ----------
+    def _load_pool_policy(self, server: str, spec: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        "pool": {"min": 1, "max": 4, "max_inflight": 8, "idle_seconds": 120}  (hoặc "pool": 3 = cố định 3 session)
+        max_inflight: số call đồng thời tối đa / session (0 = không giới hạn).
+        Không có key → 1 session, không giới hạn (như trước).
+        """
+        cfg = spec.get("pool") or {}
+        if isinstance(cfg, int):
+            cfg = {"min": cfg, "max": cfg}
+        try:
+            mn = max(1, int(cfg.get("min", 1)))
+            return {
+                "min": mn,
+                "max": max(mn, int(cfg.get("max", mn))),
+                "max_inflight": max(0, int(cfg.get("max_inflight", 0))),
+                "idle_s": float(cfg.get("idle_seconds", 120)),
+            }
+        except (TypeError, ValueError, AttributeError) as e:
+            print(f"[MCP] Invalid pool policy for '{server}': {e}")
+            return {"min": 1, "max": 1, "max_inflight": 0, "idle_s": 120.0}
+
+    async def _acquire(self, server: str) -> Optional[Dict[str, Any]]:
+        """Session ít tải nhất còn dưới trần in-flight; hết chỗ → scale up (nếu được) và chờ."""
+        pool = self._pools.get(server)
+        if pool is None:
+            return None
+        cap = pool["cfg"]["max_inflight"]
+        waited = False
+        while True:
+            if pool["closing"]:
+                return None  # server đang bị gỡ / khởi động lại (reload)
+            live = [s for s in pool["slots"] if not s["stop"].is_set()]
+            best = min(live, key=lambda s: s["inflight"], default=None)
+            if best is None or best["inflight"] > 0:
+                self._maybe_scale_up(server, len(live))  # mọi session đều đang bận
+            if best is not None and (cap <= 0 or best["inflight"] < cap):
+                best["inflight"] += 1
+                best["last_used"] = time.monotonic()
+                self._pool_changed(server)
+                return best
+            if best is None and (pool["reconnecting"] or not pool["starting"]):
+                return None  # server không còn session nào (hoặc đang reconnect → lỗi nhanh, không treo)
+            if not waited:
+                waited = True
+                METRICS.inc("mcp_pool_waits", server=server)
+            fut = asyncio.get_running_loop().create_future()
+            pool["waiters"].append(fut)
+            await fut
+
+    def _release(self, server: str, slot: Dict[str, Any]) -> None:
+        slot["inflight"] -= 1
+        slot["last_used"] = time.monotonic()
+        self._pool_changed(server)
+
+    def _maybe_scale_up(self, server: str, live: int) -> None:
+        pool = self._pools[server]
+        if pool["starting"] or live >= pool["cfg"]["max"]:
+            return
+        pool["starting"] += 1
+        METRICS.inc("mcp_pool_scale_up", server=server)
+        print(f"[MCP] Server '{server}' busy — opening session {live + 1}/{pool['cfg']['max']}.")
+        asyncio.ensure_future(self._spawn_session_bg(server))
+
+    async def _pool_reaper(self, server: str) -> None:
+        """Đóng bớt session rảnh quá idle_seconds, giữ tối thiểu min."""
+        pool = self._pools[server]
+        while True:
+            cfg = pool["cfg"]  # reload có thể đổi policy tại chỗ
+            await asyncio.sleep(max(1.0, cfg["idle_s"] / 2))
+            now = time.monotonic()
+            live = [s for s in pool["slots"] if not s["stop"].is_set()]
+            for s in sorted(live, key=lambda s: s["last_used"]):
+                if len(live) <= cfg["min"]:
+                    break
+                if s["inflight"] == 0 and now - s["last_used"] >= cfg["idle_s"]:
+                    s["stop"].set()
+                    live.remove(s)
+                    METRICS.inc("mcp_pool_scale_down", server=server)
+                    print(f"[MCP] Server '{server}' idle — closing session #{s['id']} ({len(live)} left).")
+
+    def _pool_changed(self, server: str) -> None:
+        """Cập nhật gauge + đánh thức caller đang chờ slot."""
+        pool = self._pools.get(server)
+        if pool is None:
+            return
+        METRICS.set("mcp_pool_sessions", len(pool["slots"]), server=server)
+        METRICS.set("mcp_pool_inflight", sum(s["inflight"] for s in pool["slots"]), server=server)
+        waiters, pool["waiters"] = pool["waiters"], []
+        for f in waiters:
+            if not f.done():
+                f.set_result(None)
+
+    def _drop_server_tools(self, server: str) -> None:
+        """Gỡ tool của 1 server khỏi bản nháp + phát hành snapshot mới (chỉ gọi trong loop nền)."""
+        if any(srv == server for srv, _ in self._tools.values()):
+            self._replace_server_tools(server, [])
+
+    def reload(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Đọc lại mcp.json và áp dụng phần thay đổi, không cần restart bot (blocking):
+        server mới → khởi động; server bị xoá → drain rồi đóng; đổi command/args/env → khởi động lại;
+        chỉ đổi policy (cache/compact/immutable/limits/pool/startupTimeout) → áp dụng tại chỗ; còn lại → list lại tool.
+        Trả {"added", "removed", "restarted", "updated", "relisted", "tools", "elapsed_s"} hoặc {"error": ...}.
+        """
+        if not MCP_AVAILABLE:
+            return {"error": "MCP SDK not available"}
+        self._ensure_loop_thread()
+        return self._run_coro_blocking(self._reload_async(), timeout)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Đóng mọi session MCP (mỗi runner tự đóng context của nó)."""
+        if not self._loop:
+            return
+
+        async def _stop_all():
+            self._stopping = True
+            if self._watch_task is not None:
+                self._watch_task.cancel()
+            for pool in self._pools.values():
+                for bg in (pool["reaper"], pool["health"], pool["relist"]):
+                    if bg is not None:
+                        bg.cancel()
+                for s in pool["slots"]:
+                    s["stop"].set()
+            tasks = list(self._runners.values())
+            if tasks:
+                _done, pending = await asyncio.wait(tasks, timeout=timeout)
+                for t in pending:
+                    t.cancel()
+            for pool in self._pools.values():
+                await self._close_http(pool)
+        try:
+            self._run_coro_blocking(_stop_all(), timeout + 5)
+        except Exception as e:
+            print(f"[MCP] Stop failed: {type(e).__name__}: {e}")
+        if self._recorder is not None:
+            self._recorder.close()
+            print(f"[MCP] Recorded {self._recorder.records} record(s) to {self._recorder.path}")
+
+    def _load_cache_policy(self, server: str, spec: Dict[str, Any]) -> None:
+        """
+        Đọc "cache" trong spec server của mcp.json, ví dụ:
+            "cache": {"default_ttl": 0, "max_entries": 512, "ttl": {"get_chain_info": 30}}
+        TTL tính bằng giây; 0 = không cache. max_entries tính riêng cho server này (mặc định MCP_CACHE_MAX_ENTRIES).
+        """
+        cfg = spec.get("cache") or {}
+        if not isinstance(cfg, dict):
+            return
+        policy: Dict[str, float] = {}
+        try:
+            policy["*"] = float(cfg.get("default_ttl", 0) or 0)
+            for tool, ttl in (cfg.get("ttl") or {}).items():
+                policy[str(tool)] = float(ttl or 0)
+            cap = max(1, int(cfg["max_entries"])) if cfg.get("max_entries") else None
+        except (TypeError, ValueError) as e:
+            print(f"[MCP] Invalid cache policy for '{server}': {e}")
+            return
+        self._cache_policies[server] = policy
+        if cap is not None:
+            self._cache_caps[server] = cap
+
+    def _load_limit_policy(self, server: str, spec: Dict[str, Any]) -> None:
+        """
+        Đọc "limits" trong spec server của mcp.json, ví dụ:
+            "limits": {"max_concurrent": 8, "max_queue": 32, "queue_timeout": 5,
+                       "tools": {"search_docs": {"max_concurrent": 2, "max_queue": 4, "priority": "low"},
+                                 "get_balance": {"priority": "high"}}}
+        Key thiếu lấy theo MCP_MAX_CONCURRENT / MCP_MAX_QUEUE / MCP_QUEUE_TIMEOUT. Áp dụng ngay cho limiter đang có.
+        """
+        cfg = spec.get("limits")
+        if isinstance(cfg, dict):
+            d = self._default_limits
+            try:
+                tools = {}
+                for tool, tc in (cfg.get("tools") or {}).items():
+                    tc = tc if isinstance(tc, dict) else {}
+                    tools[str(tool)] = {
+                        **{k: int(tc[k]) for k in ("max_concurrent", "max_queue") if k in tc},
+                        "priority": priority_of(tc.get("priority")),
+                    }
+                self._limit_policies[server] = {
+                    "max_concurrent": max(0, int(cfg.get("max_concurrent", d["max_concurrent"]))),
+                    "max_queue": int(cfg.get("max_queue", d["max_queue"])),
+                    "queue_timeout": float(cfg.get("queue_timeout", d["queue_timeout"])),
+                    "tools": tools,
+                }
+            except (TypeError, ValueError, AttributeError) as e:
+                print(f"[MCP] Invalid limits policy for '{server}': {e}")
+        pol = self._limit_policy(server)
+        for (srv, key), lim in list(self._limiters.items()):
+            if srv == server:
+                lim.limit, lim.max_queue = self._limit_of(pol, key)
+                lim.wake()   # nới limit khi reload → waiter chạy ngay
+
+    def _limit_policy(self, server: str) -> Dict[str, Any]:
+        return self._limit_policies.get(server) or self._default_limits
+
+    def _limit_of(self, pol: Dict[str, Any], key: str) -> Tuple[int, int]:
+        """(limit, max_queue) của limiter server ("*") hoặc tool; tool không khai báo → không giới hạn riêng."""
+        if key == "*":
+            return pol["max_concurrent"], pol["max_queue"]
+        tc = pol["tools"].get(key) or {}
+        return max(0, tc.get("max_concurrent", 0)), tc.get("max_queue", pol["max_queue"])
+
+    def _limiter(self, server: str, key: str) -> PriorityLimiter:
+        lim = self._limiters.get((server, key))
+        if lim is None:
+            limit, max_queue = self._limit_of(self._limit_policy(server), key)
+            lim = PriorityLimiter(limit, max_queue)
+            labels = {"server": server} if key == "*" else {"server": server, "tool": key}
+
+            def _gauges(lim=lim, labels=labels) -> None:
+                METRICS.set("mcp_queue_depth", lim.queued, **labels)
+                METRICS.set("mcp_active_calls", lim.active, **labels)
+
+            lim.on_change = _gauges
+            self._limiters[(server, key)] = lim
+        return lim
+
+    async def _admit(self, server: str, tool: str, san: str) -> List[PriorityLimiter]:
+        """
+        Xin slot của tool (nếu tool có giới hạn riêng) rồi của server, theo ưu tiên của tool.
+        Hàng đợi đầy / chờ quá queue_timeout → AdmissionRejected. Trả các limiter đã giữ (release sau call).
+        """
+        pol = self._limit_policy(server)
+        tc = pol["tools"].get(tool) or {}
+        keys = ([tool] if ("max_concurrent" in tc or "max_queue" in tc) else []) + ["*"]
+        held: List[PriorityLimiter] = []
+        waited = 0.0
+        try:
+            for key in keys:
+                lim = self._limiter(server, key)
+                waited += await lim.acquire(tc.get("priority", priority_of(None)), pol["queue_timeout"])
+                held.append(lim)
+        except BaseException:
+            for lim in held:
+                lim.release()
+            raise
+        METRICS.observe("mcp_queue_wait_seconds", waited, tool=san)
+        return held
+
+    def queue_stats(self) -> Dict[str, Any]:
+        """Active / queued / giới hạn theo server (+ tool có giới hạn riêng) và số call bị từ chối."""
+        out: Dict[str, Any] = {}
+        for (srv, key), lim in list(self._limiters.items()):
+            st = lim.stats()
+            entry = out.setdefault(srv, {"tools": {}})
+            if key == "*":
+                entry.update(st)
+            else:
+                entry["tools"][key] = st
+        return {"servers": out, "rejected": METRICS.snapshot("mcp_rejected")["counters"]}
+
+    def _open_store(self, cfg: Optional[Dict[str, Any]]) -> None:
+        """
+        "immutableStore": {"path": ".cache/mcp_immutable.sqlite3", "max_mb": 64}
+        Không có key này → không dùng kho bất biến.
+        """
+        if not isinstance(cfg, dict) or self._store is not None:
+            return
+        try:
+            self._store = ImmutableStore(
+                cfg.get("path") or ".cache/mcp_immutable.sqlite3",
+                int(float(cfg.get("max_mb", 64)) * 1024 * 1024),
+            )
+            print(f"[MCP] Immutable store: {self._store.path}")
+        except Exception as e:
+            print(f"[MCP] Open immutable store failed: {type(e).__name__}: {e}")
+            self._store = None
 
     async def _load_config(self) -> Dict[str, Any]:
             if not os.path.exists(self.config_path):
@@ -193,6 +1195,8 @@ class MCPBridge:
                 return {}
             try:
                 # Đọc đồng bộ là OK vì đang ở background thread
+                st = os.stat(self.config_path)
+                self._config_sig = (st.st_mtime_ns, st.st_size)
                 with open(self.config_path, "r", encoding="utf-8") as f:
                     return json.load(f)
             except Exception as e:
@@ -200,86 +1204,287 @@ class MCPBridge:
                 import traceback; traceback.print_exc()
                 return {}
 
-    async def _connect_and_list(self, name: str, cmd: str, args: List[str], env_map: Optional[Dict[str, str]]):
-        merged_env = os.environ.copy()
-        if isinstance(env_map, dict):
-            for k, v in env_map.items():
-                if v is not None:
-                    merged_env[str(k)] = str(v)
-
-        # mở stdio client & ClientSession bằng AsyncExitStack để giữ persistent
-        stack = self._AsyncExitStack()
-        stdio_transport = await stack.enter_async_context(
-            stdio_client(StdioServerParameters(command=cmd, args=args, env=merged_env))
-        )
+    async def _open_session(self, stack, pool: Dict[str, Any], on_eof=None, message_handler=None):
+        spec = pool["spawn"]
+        if spec["kind"] == "stdio":
+            merged_env = os.environ.copy()
+            if isinstance(spec["env"], dict):
+                for k, v in spec["env"].items():
+                    if v is not None:
+                        merged_env[str(k)] = str(v)
+            # mở stdio client & ClientSession trên AsyncExitStack của runner để giữ persistent
+            transport = await stack.enter_async_context(
+                stdio_client(StdioServerParameters(command=spec["cmd"], args=spec["args"], env=merged_env))
+            )
+        elif spec["kind"] == "sse":
+            transport = await stack.enter_async_context(
+                sse_client(spec["url"], headers=spec["headers"], timeout=pool["timeout"] or 30,
+                           httpx_client_factory=self._http_client_factory(pool))
+            )
+        else:
+            # streamable HTTP trả (read, write, get_session_id)
+            transport = (await stack.enter_async_context(
+                streamablehttp_client(spec["url"], headers=spec["headers"], timeout=pool["timeout"] or 30,
+                                      httpx_client_factory=self._http_client_factory(pool))
+            ))[:2]
 
-        if isinstance(stdio_transport, tuple) and len(stdio_transport) == 2:
-            reader, writer = stdio_transport
-            session = await stack.enter_async_context(ClientSession(reader, writer))
+        if isinstance(transport, tuple) and len(transport) == 2:
+            reader, writer = transport
+            if on_eof is not None:
+                reader = await self._watch_reader(stack, reader, on_eof)
+            session = await stack.enter_async_context(ClientSession(reader, writer, message_handler=message_handler))
         else:
             # 1 số version trả thẳng client wrapper
-            session = await stack.enter_async_context(stdio_transport)  # type: ignore
+            session = await stack.enter_async_context(transport)  # type: ignore
 
         await session.initialize()
-        self._sessions[name] = session
-        self._stacks[name] = stack
+        return session
+
+    def _http_client_factory(self, pool: Dict[str, Any]):
+        """
+        httpx_client_factory cho SDK: mọi session HTTP của 1 server dùng chung 1 AsyncClient (pool kết nối
+        keep-alive). SDK mở/đóng client theo từng session → trả context KHÔNG đóng client; pool tự đóng
+        khi server bị gỡ / bridge dừng (_close_http).
+        """
+        @contextlib.asynccontextmanager
+        async def _factory(headers=None, timeout=None, auth=None):
+            client = pool["http"]
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    headers=headers, timeout=timeout if timeout is not None else httpx.Timeout(30.0), auth=auth,
+                    follow_redirects=True,
+                    limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.http_keepalive),
+                )
+                pool["http"] = client
+            yield client
+        return _factory
+
+    async def _close_http(self, pool: Dict[str, Any]) -> None:
+        client, pool["http"] = pool.get("http"), None
+        if client is not None:
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"[MCP] close HTTP client failed: {type(e).__name__}: {e}")
+
+    async def _watch_reader(self, stack, reader, on_eof):
+        """
+        Chèn 1 pump giữa stdout của server và ClientSession: stream kết thúc (process chết / pipe gãy)
+        → on_eof() ngay, không đợi tới call kế tiếp mới phát hiện.
+        """
+        send, recv = anyio.create_memory_object_stream(16)
+        tg = await stack.enter_async_context(anyio.create_task_group())
+        stack.callback(tg.cancel_scope.cancel)  # LIFO: huỷ pump trước khi tg thoát, rồi mới đóng stdio_client
+
+        async def _pump():
+            async with send:
+                try:
+                    async for msg in reader:
+                        await send.send(msg)
+                except (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream):
+                    pass
+            on_eof()
+
+        tg.start_soon(_pump)
+        return recv
 
-        # list tools
+    async def _list_and_register(self, name: str, session) -> None:
         resp = await session.list_tools()
         tools = getattr(resp, "tools", []) or []
-        count = 0
+        if self._recorder is not None:
+            self._recorder.list_tools(name, tools)
+        entries = []
+        stats: Dict[str, Dict[str, int]] = {}
+        server_cfg = self._schema_policies.get(name)
         for t in tools:
-            count += 1
             full = f"{name}:{t.name}"                 # tên gốc có dấu ':'
-            san  = self._sanitize_name(full)          # tên hợp lệ cho Anthropic
-
-            # lưu map 2 chiều
-            self._san_to_full[san] = full
-            self._full_to_san[full] = san
-
             meta = {
-                "name": san,                          # <-- QUAN TRỌNG: đưa tên đã sanitize cho Claude
+                "name": self._sanitize_name(full),    # <-- QUAN TRỌNG: đưa tên đã sanitize cho Claude
                 "description": getattr(t, "description", "") or "",
                 "input_schema": getattr(t, "input_schema", None)
                                 or getattr(t, "inputSchema", {"type": "object", "properties": {}}),
             }
-            self._tools[san] = (name, meta)  # lưu cả tên server để gọi tool sau này 
-        print(f"[MCP] Server '{name}' ready with {count} tool(s).")
+            # tool block gửi lại mỗi lượt → thu gọn description/schema 1 lần ở đây
+            meta, before, after = compact_tool(meta, schema_policy(server_cfg, t.name))
+            stats[full] = {"before": before, "after": after}
+            entries.append((full, meta))
+        self._schema_stats[name] = stats
+        if stats:
+            sm = summarize(stats)
+            METRICS.set("mcp_tool_schema_tokens", sm["after"], server=name)
+            print(f"[MCP] Server '{name}' tool schemas: ~{sm['before']} → ~{sm['after']} tokens "
+                  f"({sm['saved_pct']}% saved, {sm['tools']} tool(s))")
+        self._replace_server_tools(name, entries)
+
+    def _replace_server_tools(self, server: str, entries: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Thay toàn bộ tool của 1 server (list lại / reconnect / reload / gỡ server): dựng bản nháp MỚI
+        (tool của server khác giữ nguyên thứ tự) rồi phát hành snapshot 1 lần — reader không bao giờ
+        thấy trạng thái nửa cũ nửa mới.
+        """
+        tools = {k: v for k, v in self._tools.items() if v[0] != server}
+        san_to_full = {k: v for k, v in self._san_to_full.items() if k in tools}
+        for full, meta in entries:
+            san = meta["name"]
+            tools[san] = (server, meta)  # lưu cả tên server để gọi tool sau này
+            san_to_full[san] = full
+        self._tools = tools
+        self._san_to_full = san_to_full
+        self._full_to_san = {full: san for san, full in san_to_full.items()}
+        self._publish_registry()
+
+    def _publish_registry(self) -> None:
+        """Chỉ gọi trong loop nền: đóng băng bản nháp thành snapshot mới rồi gán 1 lần (atomic)."""
+        metas = tuple(dict(meta) for (_srv, meta) in self._tools.values())
+        self._registry = _Registry(
+            tools=MappingProxyType({k: (srv, dict(meta)) for k, (srv, meta) in self._tools.items()}),
+            san_to_full=MappingProxyType(dict(self._san_to_full)),
+            full_to_san=MappingProxyType(dict(self._full_to_san)),
+            metas=metas,
+            ranker=ToolRanker(metas),
+        )
 
     # ---------- internal: exec ----------
     async def _exec_tool_async(self, san_name: str, args: Dict[str, Any]) -> Dict[str, Any]:
-        # san_name: tên đã sanitize (key trong self._tools)
-        if san_name not in self._tools:
+        # san_name: tên đã sanitize (key trong snapshot registry)
+        reg = self._registry
+        if san_name not in reg.tools:
             return {"text": f"[MCP] unknown tool: {san_name}"}
 
-        server_name, _ = self._tools[san_name]
+        server_name, _ = reg.tools[san_name]
         # Map ngược về tên full "server:tool" để lấy local name
-        full = self._san_to_full.get(san_name, san_name)
+        full = reg.san_to_full.get(san_name, san_name)
         local_tool = full.split(":", 1)[1] if ":" in full else full
 
-        session = self._sessions.get(server_name)
-        if session is None:
-            return {"text": f"[MCP] server '{server_name}' not connected"}
+        canon = self._canonical_args(args)
+        immutable = self._is_immutable(server_name, local_tool, args)
+        if immutable:
+            loop = asyncio.get_running_loop()
+            stored = await loop.run_in_executor(None, self._store.get, server_name, local_tool, canon)
+            if stored is not None:
+                METRICS.inc("mcp_store_hits", tool=san_name)
+                data = self._parse_structured(stored.get("text") or "")
+                if data is not None:
+                    stored["data"] = data
+                return stored
+            METRICS.inc("mcp_store_misses", tool=san_name)
 
+        ttl = self._cache_ttl(server_name, local_tool)
+        if ttl <= 0 and not immutable:
+            return await self._call_tool(server_name, local_tool, full, args)
+
+        key = (server_name, local_tool, canon)
+        hit = self._cache.get(key)
+        if hit is not None and hit[0] > time.monotonic():
+            METRICS.inc("mcp_cache_hits", tool=san_name)
+            return self._copy_result(hit[1])
+
+        # single-flight: cùng key đang chạy → đợi chung kết quả
+        pending = self._inflight.get(key)
+        if pending is not None:
+            METRICS.inc("mcp_cache_coalesced", tool=san_name)
+            return self._copy_result(await asyncio.shield(pending))
+
+        if ttl > 0:
+            METRICS.inc("mcp_cache_misses", tool=san_name)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            out = await self._call_tool(server_name, local_tool, full, args)
+            if ttl > 0 and self._is_cacheable(out):
+                self._cache_put(key, out, ttl)
+            fut.set_result(out)
+            if immutable and self._is_cacheable(out) and self._looks_final(out):
+                loop = asyncio.get_running_loop()
+                try:
+                    # chỉ lưu text — "data" parse lại khi đọc (tránh lưu 2 bản)
+                    stored = {k: v for k, v in out.items() if k != "data"}
+                    await loop.run_in_executor(None, self._store.put, server_name, local_tool, canon, stored)
+                except Exception as e:
+                    print(f"[MCP] Immutable store put failed: {type(e).__name__}: {e}")
+            return self._copy_result(out)
+        except BaseException as e:
+            # báo lỗi cho các caller đang đợi chung (không để future treo)
+            if not fut.done():
+                fut.set_result({"text": f"[MCP] call_tool error on {full}: {type(e).__name__}: {e}"})
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _call_on_slot(self, slot: Dict[str, Any], local_tool: str, args: Dict[str, Any]):
+        """call_tool nhưng trả lỗi ngay (ConnectionError) nếu session bị đánh dấu chết giữa chừng."""
+        call = asyncio.ensure_future(slot["session"].call_tool(local_tool, args or {}))
+        lost = asyncio.ensure_future(slot["dead"].wait())
+        try:
+            await asyncio.wait({call, lost}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            lost.cancel()
+            if not call.done():
+                call.cancel()
+        if call.cancelled() or not call.done():
+            raise ConnectionError("session lost")
+        return call.result()
+
+    async def _call_tool(self, server_name: str, local_tool: str, full: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        san = self._registry.full_to_san.get(full, full)
         try:
-            result = await session.call_tool(local_tool, args or {})
+            held = await self._admit(server_name, local_tool, san)
+        except AdmissionRejected as e:
+            METRICS.inc("mcp_rejected", server=server_name, reason=e.reason)
+            return {"text": f"[MCP] server '{server_name}' busy: {full} rejected ({e})"}
+        t0 = time.monotonic()
+        try:
+            return await self._call_admitted(server_name, local_tool, full, args)
+        finally:
+            for lim in held:
+                lim.release()
+            METRICS.observe("mcp_call_seconds", time.monotonic() - t0, tool=san)
+
+    async def _call_admitted(self, server_name: str, local_tool: str, full: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        slot = await self._acquire(server_name)
+        if slot is None:
+            state = self._server_status.get(server_name, {}).get("state", "not connected")
+            return {"text": f"[MCP] server '{server_name}' unavailable ({state})"}
+
+        t0 = time.monotonic()
+        try:
+            result = await self._call_on_slot(slot, local_tool, args)
+        except ConnectionError:
+            return {"text": f"[MCP] server '{server_name}' connection lost during {full}"}
         except Exception as e:
+            if self._recorder is not None:
+                self._recorder.call_tool(server_name, local_tool, args, time.monotonic() - t0,
+                                         error=f"{type(e).__name__}: {e}")
             return {"text": f"[MCP] call_tool error on {full}: {type(e).__name__}: {e}"}
+        finally:
+            self._release(server_name, slot)
+        if self._recorder is not None:
+            self._recorder.call_tool(server_name, local_tool, args, time.monotonic() - t0, result=result)
 
+        out = self._convert_result(result, full)
+        if "spill_texts" in out:
+            out = await asyncio.get_running_loop().run_in_executor(None, self._write_spill, out, full)
+        # server báo lỗi (isError, vd. RPC upstream 502) → đánh dấu để cache / kho bất biến không giữ
+        is_error = result.get("isError") if isinstance(result, dict) else getattr(result, "isError", False)
+        if is_error is True:
+            out["is_error"] = True
+            METRICS.inc("mcp_tool_errors", tool=self._registry.full_to_san.get(full, full))
+        return out
+
+    def _convert_result(self, result: Any, full: str) -> Dict[str, Any]:
+        """CallToolResult / dict → {"text", "data"?} | {"image_path"} | {"text", "spill_path", ...}."""
         # 1) dict đặc biệt
         if isinstance(result, dict):
-            out = self._normalize_payload_dict(result)
+            out = self._normalize_payload_dict(result, full)
             if out:
                 return out
 
-        # 2) MCP result .content (list các text item)
+        # 2) MCP result .content (list các text item); structuredContent có sẵn → khỏi parse lại
         payload = getattr(result, "content", None)
         if isinstance(payload, list):
             texts = self._extract_texts_from_payload(payload)
             if texts:
-                raw = "\n".join(t for t in texts if t).strip()
-                pretty = self._maybe_parse_json_text(raw)
-                return {"text": pretty if pretty is not None else raw}
+                return self._text_result(texts, full, getattr(result, "structuredContent", None))
 
         # 3) fallback stringify
         try:
@@ -288,6 +1493,65 @@ class MCPBridge:
             return {"text": str(result)}
 
 
+    # ---------- internal: cache ----------
+    def _cache_ttl(self, server: str, tool: str) -> float:
+        policy = self._cache_policies.get(server)
+        if not policy:
+            return 0.0
+        return policy.get(tool, policy.get("*", 0.0))
+
+    def _canonical_args(self, args: Dict[str, Any]) -> str:
+        return json.dumps(args or {}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+    _MUTABLE_TAGS = {"latest", "pending", "safe", "finalized", "earliest"}
+
+    def _is_immutable(self, server: str, tool: str, args: Dict[str, Any]) -> bool:
+        """Tool được đánh dấu "immutable" và args trỏ tới 1 object cố định (không 'latest'/'pending')."""
+        if self._store is None or tool not in self._immutable_tools.get(server, ()):
+            return False
+        if not args:
+            return False
+        for v in args.values():
+            if isinstance(v, str) and v.strip().lower() in self._MUTABLE_TAGS:
+                return False
+        return True
+
+    def _looks_final(self, out: Dict[str, Any]) -> bool:
+        # lỗi từ server (isError) không bao giờ là kết quả cuối cùng
+        if out.get("is_error"):
+            return False
+        # tx chưa được đưa vào block / chưa tìm thấy → chưa bất biến, không lưu
+        low = (out.get("text") or "").lower()
+        return not any(k in low for k in ('"pending"', "not found", "could not be found"))
+
+    def _is_cacheable(self, out: Dict[str, Any]) -> bool:
+        # chỉ cache kết quả text thành công: lỗi của bridge bắt đầu bằng "[MCP]", lỗi của server có "is_error";
+        # result đã spill quá lớn → không giữ
+        txt = out.get("text") if isinstance(out, dict) else None
+        return (isinstance(txt, str) and bool(txt) and not txt.startswith("[MCP]")
+                and not out.get("is_error") and not out.get("spill_path"))
+
+    def _copy_result(self, out: Dict[str, Any]) -> Dict[str, Any]:
+        """Bản sao độc lập: "data" lồng nhau được copy sâu → caller sửa (compactor, postprocess) không làm hỏng cache."""
+        if "data" in out:
+            return {**out, "data": copy.deepcopy(out["data"])}
+        return dict(out)
+
+    def _cache_put(self, key: Tuple[str, str, str], out: Dict[str, Any], ttl: float) -> None:
+        now = time.monotonic()
+        server = key[0]
+        self._cache.pop(key, None)
+        self._cache[key] = (now + ttl, self._copy_result(out))
+        cap = self._cache_caps.get(server, self._cache_max_entries)
+        mine = [k for k in self._cache if k[0] == server]   # theo thứ tự chèn (cũ nhất trước)
+        if len(mine) > cap:
+            # bỏ entry hết hạn trước, sau đó bỏ entry cũ nhất — chỉ trong phần cache của server này
+            for k in [k for k in mine if self._cache[k][0] <= now]:
+                self._cache.pop(k, None)
+            mine = [k for k in mine if k in self._cache]
+            for k in mine[:max(0, len(mine) - cap)]:
+                self._cache.pop(k, None)
+
     # ---------- helpers ----------
     def _resolve_cmd(self, cmd: str) -> str:
         if os.name == "nt":
@@ -295,7 +1559,7 @@ class MCPBridge:
             if cmd.lower() == "npm":  return "npm.cmd"
         return cmd
 
-    def _normalize_payload_dict(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def _normalize_payload_dict(self, payload: Dict[str, Any], name: str = "result") -> Optional[Dict[str, Any]]:
         # ảnh theo đường dẫn
         p = payload.get("path") or payload.get("image_path")
         if isinstance(p, str) and p.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
@@ -305,28 +1569,87 @@ class MCPBridge:
         if isinstance(b64, str):
             try:
                 raw = base64.b64decode(b64)
-                fd, temp_path = tempfile.mkstemp(prefix="mcp_img_", suffix=".png")
-                os.close(fd)
-                with open(temp_path, "wb") as f:
-                    f.write(raw)
-                return {"image_path": temp_path}
+                return {"image_path": ARTIFACTS.put_bytes(raw, prefix="mcp_img", suffix=".png")}
             except Exception as e:
                 return {"text": f"[MCP] invalid base64: {e}"}
-        # text (thử pretty json)
+        # text (kèm object nếu là JSON)
         if isinstance(payload.get("text"), str):
-            pretty = self._maybe_parse_json_text(payload["text"])
-            return {"text": pretty if pretty is not None else payload["text"]}
+            return self._text_result([payload["text"]], name, payload.get("structuredContent"))
         return None
 
-    def _maybe_parse_json_text(self, s: str) -> Optional[str]:
-        s = (s or "").strip()
-        if not s:
+    def _parse_structured(self, s: Any) -> Any:
+        """dict/list nếu `s` (str/bytes) là JSON object/array; còn lại None."""
+        head = s.lstrip()[:1]
+        if head not in ("{", "[", b"{", b"["):
             return None
         try:
-            obj = json.loads(s)
-            return json.dumps(obj, ensure_ascii=False, indent=2)
+            obj = loads_json(s)
         except Exception:
             return None
+        return obj if isinstance(obj, (dict, list)) else None
+
+    def _text_result(self, texts: List[str], name: str, structured: Any = None) -> Dict[str, Any]:
+        """
+        {"text": text gốc, "data": object đã parse (nếu là JSON)} — không dump lại JSON;
+        chatbot thu gọn / vẽ bảng thẳng từ "data". Quá spill_chars → _write_spill.
+        """
+        # FastMCP bọc giá trị không phải object thành {"result": ...} → bóc ra; chuỗi thì parse text như thường
+        if isinstance(structured, dict) and list(structured) == ["result"]:
+            structured = structured["result"]
+        data = structured if isinstance(structured, (dict, list)) else None
+        if self.spill_chars > 0 and sum(len(t) for t in texts) > self.spill_chars:
+            # quá lớn → _call_admitted ghi file + parse + rút gọn trong executor (_write_spill), không trên loop
+            return {"text": "", "spill_texts": texts, "spill_data": data}
+        raw = (texts[0] if len(texts) == 1 else "\n".join(t for t in texts if t)).strip()
+        if data is None:
+            data = self._parse_structured(raw)
+        return {"text": raw, "data": data} if data is not None else {"text": raw}
+
+    def _write_spill(self, out: Dict[str, Any], name: str) -> Dict[str, Any]:
+        """
+        Chạy trong executor: ghi từng phần text ra kho artifact (không nối chuỗi), rồi parse + rút gọn.
+        Chỉ trả {"text": bản rút gọn, "spill_path"} — không giữ object đầy đủ trong RAM (đọc lại từ file nếu cần).
+        """
+        texts = out.pop("spill_texts")
+        data = out.pop("spill_data", None)
+        path = None
+        try:
+            with ARTIFACTS.writer("mcp_spill", ".txt") as w:
+                first = True
+                for t in texts:
+                    if not t:
+                        continue
+                    if not first:
+                        w.write(b"\n")
+                    w.write(t.encode("utf-8"))
+                    first = False
+            path, size = w.path, w.size
+        except OSError as e:
+            print(f"[MCP] spill failed for {name}: {type(e).__name__}: {e}")
+        if data is None:
+            if len(texts) == 1:
+                data = self._parse_structured(texts[0])
+            elif path is not None:
+                with open(path, "rb") as f:
+                    data = self._parse_structured(f.read())
+        if data is not None:
+            text = compact_text("", DEFAULT_POLICY, data=data)
+        else:
+            limit = DEFAULT_POLICY["max_str"] * 10
+            parts: List[str] = []
+            for t in texts:
+                if not t:
+                    continue
+                parts.append(t[:limit - sum(len(p) for p in parts)])
+                if sum(len(p) for p in parts) >= limit:
+                    break
+            text = "\n".join(parts)
+        if path is None:
+            return {"text": text + "\n…(đã rút gọn; không lưu được kết quả đầy đủ)"}
+        METRICS.inc("mcp_result_spills")
+        METRICS.observe("mcp_result_spill_bytes", size)
+        print(f"[MCP] result of {name} spilled to {path} ({size} bytes)")
+        return {"text": text + f"\n…(kết quả đầy đủ {size} bytes: {path})", "spill_path": path}
 
     def _extract_texts_from_payload(self, payload_list) -> List[str]:
         texts = []
@@ -0,0 +1,119 @@
+# mcp_record.py
+import os, json, queue, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Ghi lại traffic MCP (list_tools + call_tool) ra file JSONL để replay offline bằng fake_mcp.py.
+# Bật bằng env MCP_RECORD=recordings/sei.jsonl (ghi nối tiếp, mỗi dòng 1 record):
+#   {"type": "list_tools", "server": str, "ts": float, "tools": [Tool JSON (name, description, inputSchema...)]}
+#   {"type": "call_tool",  "server": str, "ts": float, "tool": str, "args": dict,
+#    "duration_s": float, "result": CallToolResult JSON | None, "error": str | None}
+# Chỉ dùng để test/benchmark: file chứa nguyên dữ liệu trả về (địa chỉ ví, số dư...).
+
+
+def canonical_args(args: Dict[str, Any]) -> str:
+    return json.dumps(args or {}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _dump(obj: Any) -> Any:
+    # pydantic model của mcp.types → JSON thuần (giữ alias: inputSchema, structuredContent, isError)
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json", by_alias=True, exclude_none=True)
+    return obj
+
+
+class Recorder:
+    """
+    Ghi record JSONL qua 1 thread writer riêng: caller (loop nền của bridge) chỉ đẩy vào hàng đợi,
+    model_dump / json.dumps / ghi + flush chạy ngoài loop → không chặn loop, không làm lệch latency đo được.
+    Flush từng dòng → file dùng được kể cả khi process bị kill.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+        self._q: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._closed = False
+        self.records = 0
+        self._thread = threading.Thread(target=self._writer, name="MCPRecorder", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls) -> Optional["Recorder"]:
+        path = os.getenv("MCP_RECORD", "").strip()
+        return cls(path) if path else None
+
+    def _writer(self) -> None:
+        while True:
+            rec = self._q.get()
+            if rec is None:
+                break
+            try:
+                if "tools" in rec:
+                    rec["tools"] = [_dump(t) for t in rec["tools"]]
+                if rec.get("result") is not None:
+                    rec["result"] = _dump(rec["result"])
+                self._f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+                self._f.flush()
+                self.records += 1
+            except Exception as e:
+                print(f"[MCP] record write failed: {type(e).__name__}: {e}")
+        self._f.close()
+
+    def _write(self, rec: Dict[str, Any]) -> None:
+        if not self._closed:
+            self._q.put(rec)
+
+    def list_tools(self, server: str, tools: List[Any]) -> None:
+        self._write({"type": "list_tools", "server": server, "ts": time.time(), "tools": list(tools)})
+
+    def call_tool(self, server: str, tool: str, args: Dict[str, Any], duration_s: float,
+                  result: Any = None, error: Optional[str] = None) -> None:
+        self._write({
+            "type": "call_tool", "server": server, "ts": time.time(), "tool": tool, "args": dict(args or {}),
+            "duration_s": round(duration_s, 6), "result": result, "error": error,
+        })
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Ghi nốt các record đang chờ rồi đóng file."""
+        if self._closed:
+            return
+        self._closed = True
+        self._q.put(None)
+        self._thread.join(timeout)
+
+
+class Recording:
+    """Nội dung 1 file record của 1 server: tool list cuối cùng + các lần gọi theo (tool, args)."""
+
+    def __init__(self, tools: List[Dict[str, Any]], calls: Dict[Tuple[str, str], List[Dict[str, Any]]]):
+        self.tools = tools
+        self.calls = calls
+        self.by_tool: Dict[str, List[Dict[str, Any]]] = {}
+        for (tool, _), recs in calls.items():
+            self.by_tool.setdefault(tool, []).extend(recs)
+
+
+def load_recording(path: str, server: Optional[str] = None) -> Recording:
+    """Đọc file JSONL; server None → server của record đầu tiên."""
+    tools: List[Dict[str, Any]] = []
+    calls: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if server is None:
+                server = rec.get("server")
+            if rec.get("server") != server:
+                continue
+            if rec.get("type") == "list_tools":
+                tools = rec.get("tools") or []
+            elif rec.get("type") == "call_tool":
+                calls.setdefault((rec["tool"], canonical_args(rec.get("args"))), []).append(rec)
+    return Recording(tools, calls)
@@ -0,0 +1,100 @@
+# mcp_store.py
+import os, json, sqlite3, hashlib, threading, time
+from typing import Any, Dict, Optional
+
+# Kho kết quả MCP "bất biến" (tx theo hash, block đã finalize...) lưu trên đĩa bằng SQLite.
+# - key = sha256(server, tool, canonical args) → content-addressed theo request
+# - giới hạn dung lượng theo byte, evict theo LRU (last_access)
+# - sống sót qua restart
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key         TEXT PRIMARY KEY,
+    server      TEXT NOT NULL,
+    tool        TEXT NOT NULL,
+    args        TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    created     REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_last_access ON entries(last_access);
+"""
+
+
+class ImmutableStore:
+    """SQLite store có LRU size cap. Thread-safe (1 connection + lock)."""
+
+    def __init__(self, path: str = ".cache/mcp_immutable.sqlite3", max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max(1024, int(max_bytes))
+        self._lock = threading.Lock()
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def make_key(server: str, tool: str, canonical_args: str) -> str:
+        h = hashlib.sha256()
+        h.update(f"{server}\x00{tool}\x00{canonical_args}".encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, server: str, tool: str, canonical_args: str) -> Optional[Dict[str, Any]]:
+        key = self.make_key(server, tool, canonical_args)
+        with self._lock:
+            row = self._db.execute("SELECT payload FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        try:
+            out = json.loads(row[0])
+        except Exception:
+            return None
+        return out if isinstance(out, dict) else None
+
+    def put(self, server: str, tool: str, canonical_args: str, result: Dict[str, Any]) -> None:
+        key = self.make_key(server, tool, canonical_args)
+        payload = json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+        size = len(payload.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, server, tool, args, payload, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, server, tool, canonical_args, payload, size, now, now),
+            )
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        # bỏ entry ít dùng nhất tới khi còn ~90% cap để tránh evict liên tục
+        target = int(self.max_bytes * 0.9)
+        rows = self._db.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall()
+        drop = []
+        for key, size in rows:
+            if self._total <= target:
+                break
+            drop.append((key,))
+            self._total -= size
+        if drop:
+            self._db.executemany("DELETE FROM entries WHERE key = ?", drop)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"path": self.path, "entries": n, "bytes": self._total, "max_bytes": self.max_bytes}
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._db.close()
+            except Exception:
+                pass
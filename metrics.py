@@ -0,0 +1,84 @@
+# metrics.py
+import threading, time
+from collections import deque
+from typing import Any, Dict, Tuple
+
+# Bộ đếm/summary nhỏ trong process — không phụ thuộc thư viện ngoài.
+# Key dạng "name{k=v,...}" (label sắp xếp) để dễ in/log và xuất qua HTTP.
+
+_MAX_SAMPLES = 2048
+
+
+def _key(name: str, labels: Dict[str, Any]) -> str:
+    if not labels:
+        return name
+    inner = ",".join(f"{k}={labels[k]}" for k in sorted(labels))
+    return f"{name}{{{inner}}}"
+
+
+def _percentile(sorted_vals, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(p / 100.0 * (len(sorted_vals) - 1)))))
+    return float(sorted_vals[idx])
+
+
+class Metrics:
+    """Counter / gauge / summary thread-safe, truy cập được từ mọi thread và loop."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._samples: Dict[str, Tuple[deque, list]] = {}  # key -> (samples, [count, total])
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            self._counters[k] = self._counters.get(k, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            self._gauges[k] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            slot = self._samples.get(k)
+            if slot is None:
+                slot = (deque(maxlen=_MAX_SAMPLES), [0, 0.0])
+                self._samples[k] = slot
+            slot[0].append(value)
+            slot[1][0] += 1
+            slot[1][1] += value
+
+    def get(self, name: str, **labels) -> float:
+        k = _key(name, labels)
+        with self._lock:
+            if k in self._counters:
+                return self._counters[k]
+            return self._gauges.get(k, 0)
+
+    def snapshot(self, prefix: str = "") -> Dict[str, Any]:
+        """Trả về dict {counters, gauges, summaries} (lọc theo prefix nếu có)."""
+        with self._lock:
+            counters = {k: v for k, v in self._counters.items() if k.startswith(prefix)}
+            gauges = {k: v for k, v in self._gauges.items() if k.startswith(prefix)}
+            raw = {k: (list(s), c[0], c[1]) for k, (s, c) in self._samples.items() if k.startswith(prefix)}
+        summaries = {}
+        for k, (vals, count, total) in raw.items():
+            vals.sort()
+            summaries[k] = {
+                "count": count,
+                "avg": (total / count) if count else 0.0,
+                "p50": _percentile(vals, 50),
+                "p95": _percentile(vals, 95),
+                "p99": _percentile(vals, 99),
+                "max": float(vals[-1]) if vals else 0.0,
+            }
+        return {"ts": time.time(), "counters": counters, "gauges": gauges, "summaries": summaries}
+
+
+# instance dùng chung cho cả process
+METRICS = Metrics()
@@ -0,0 +1,73 @@
+# model_router.py
+import os, json, time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from metrics import METRICS
+
+# Chọn model theo loại tác vụ (tier) thay vì gửi mọi thứ lên 1 model lớn:
+#   summary   — tóm tắt hội thoại (_maybe_summarize)
+#   intent    — câu xã giao/ngắn không cần tool (chit-chat, hỏi lại ý định)
+#   tool_args — vòng 1: model chỉ cần chọn tool + điền args
+#   answer    — câu trả lời cuối cho người dùng
+# Cấu hình qua env MODEL_ROUTES = đường dẫn file JSON hoặc chuỗi JSON, ví dụ:
+#   {"summary": {"model": "claude-3-5-haiku-20241022", "max_tokens": 512},
+#    "intent":  {"model": "claude-3-5-haiku-20241022", "max_tokens": 1024}}
+# Tier không cấu hình → dùng model mặc định của chatbot (hành vi cũ).
+
+TIERS = ("summary", "intent", "tool_args", "answer")
+
+_DEFAULT_MAX_TOKENS = {"summary": 512, "intent": 8000, "tool_args": 8000, "answer": 8000}
+
+
+class ModelRouter:
+    def __init__(self, default_model: str, routes: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.default_model = default_model
+        self._routes: Dict[str, Dict[str, Any]] = {}
+        for tier in TIERS:
+            spec = dict((routes or {}).get(tier) or {})
+            self._routes[tier] = {
+                "model": spec.get("model") or default_model,
+                "max_tokens": int(spec.get("max_tokens") or _DEFAULT_MAX_TOKENS[tier]),
+            }
+            if "temperature" in spec:
+                self._routes[tier]["temperature"] = float(spec["temperature"])
+
+    @classmethod
+    def from_env(cls, default_model: str) -> "ModelRouter":
+        raw = (os.getenv("MODEL_ROUTES") or "").strip()
+        routes: Dict[str, Any] = {}
+        if raw:
+            try:
+                if raw.startswith("{"):
+                    routes = json.loads(raw)
+                else:
+                    with open(raw, "r", encoding="utf-8") as f:
+                        routes = json.load(f)
+            except Exception as e:
+                print(f"[ROUTER] Invalid MODEL_ROUTES ({type(e).__name__}: {e}) — using default model.")
+                routes = {}
+        router = cls(default_model, routes if isinstance(routes, dict) else {})
+        print("[ROUTER] tiers:", {t: r["model"] for t, r in router._routes.items()})
+        return router
+
+    def route(self, tier: str) -> Dict[str, Any]:
+        """Trả về kwargs model/max_tokens(/temperature) cho messages.create/stream."""
+        return dict(self._routes.get(tier) or self._routes["answer"])
+
+    @contextmanager
+    def timed(self, tier: str):
+        """Ghi latency theo tier (kể cả thời gian retry) vào METRICS."""
+        model = self._routes.get(tier, {}).get("model", self.default_model)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            METRICS.observe("llm_latency_seconds", time.perf_counter() - t0, tier=tier, model=model)
+            if not ok:
+                METRICS.inc("llm_errors", tier=tier, model=model)
+
+    def stats(self) -> Dict[str, Any]:
+        return METRICS.snapshot("llm_latency_seconds")["summaries"]
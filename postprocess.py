@@ -0,0 +1,251 @@
+# postprocess.py
+import re, json
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Tokenizer 1 lượt cho câu trả lời cuối (final_text) của model.
+# Kết quả là list block theo đúng thứ tự, nối "raw" lại = text gốc:
+#   {"kind": "prose",     "raw": str}
+#   {"kind": "code",      "raw": str, "lang": str, "body": str}
+#   {"kind": "table",     "raw": str}                       # ≥3 dòng bảng ASCII/Markdown liên tiếp
+#   {"kind": "image",     "raw": str, "url": str}           # ![alt](url)
+#   {"kind": "tool_call", "raw": str, "args": dict|None}    # 'sei:xxx(...)' hoặc 'make_table_image({...})' in ra dạng text
+# Các fallback (vẽ bảng, bỏ rác) chỉ thao tác trên list block này — không quét lại toàn bộ text nhiều lần.
+
+_TABLE_LINE = re.compile(r"^\s*[\|\+].*[\|\+]\s*$")
+_MCP_NOISE_LINE = re.compile(r"^\s*(sei[:_][\w:]+)\s*(\([^)]*\))?\s*$", re.I)
+_INLINE = re.compile(
+    r"(?P<image>!\[[^\]]*\]\((?P<url>[^)]+)\))"
+    r"|(?P<mti>make_table_image\s*\(\s*(?P<obj>\{[\s\S]*?\})\s*\))",
+    re.I,
+)
+_PLOT_MARKERS = ("matplotlib", "plt.", "pandas")
+
+
+def parse_answer(text: str) -> List[Dict[str, Any]]:
+    """Tách text thành block trong 1 lượt duyệt theo dòng."""
+    blocks: List[Dict[str, Any]] = []
+    if not text:
+        return blocks
+    lines = text.splitlines(keepends=True)
+    prose: List[str] = []
+    table: List[str] = []
+
+    def _flush_table():
+        if not table:
+            return
+        if len(table) >= 3:
+            _flush_prose()
+            blocks.append({"kind": "table", "raw": "".join(table)})
+        else:
+            prose.extend(table)
+        table.clear()
+
+    def _flush_prose():
+        if not prose:
+            return
+        chunk = "".join(prose)
+        prose.clear()
+        pos = 0
+        for m in _INLINE.finditer(chunk):
+            if m.start() > pos:
+                blocks.append({"kind": "prose", "raw": chunk[pos:m.start()]})
+            if m.group("image"):
+                blocks.append({"kind": "image", "raw": m.group(0), "url": m.group("url")})
+            else:
+                blocks.append({"kind": "tool_call", "raw": m.group(0), "args": _parse_table_call(m.group("obj"))})
+            pos = m.end()
+        if pos < len(chunk):
+            blocks.append({"kind": "prose", "raw": chunk[pos:]})
+
+    i, n = 0, len(lines)
+    while i < n:
+        ln = lines[i]
+        stripped = ln.strip()
+        if stripped.startswith("```"):
+            if len(stripped) > 3 and stripped.endswith("```"):
+                # ```code``` trên cùng 1 dòng
+                _flush_table(); _flush_prose()
+                blocks.append({"kind": "code", "raw": ln, "lang": "", "body": stripped[3:-3]})
+                i += 1
+                continue
+            # tìm fence đóng; không có → coi như prose
+            j = i + 1
+            while j < n and "```" not in lines[j]:
+                j += 1
+            if j < n:
+                _flush_table(); _flush_prose()
+                raw = "".join(lines[i:j + 1])
+                body = "".join(lines[i + 1:j])
+                blocks.append({"kind": "code", "raw": raw, "lang": stripped[3:].strip().lower(), "body": body})
+                i = j + 1
+                continue
+        if _TABLE_LINE.match(ln):
+            table.append(ln)
+        elif _MCP_NOISE_LINE.match(stripped):
+            _flush_table(); _flush_prose()
+            blocks.append({"kind": "tool_call", "raw": ln, "args": None})
+        else:
+            _flush_table()
+            prose.append(ln)
+        i += 1
+    _flush_table()
+    _flush_prose()
+    return blocks
+
+
+def render_blocks(blocks: List[Dict[str, Any]]) -> str:
+    text = "".join(b["raw"] for b in blocks)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def prose_text(blocks: List[Dict[str, Any]]) -> str:
+    return "".join(b["raw"] for b in blocks if b["kind"] == "prose")
+
+
+# ---------- trích dữ liệu từ block ----------
+def series_table(block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Image block có series=[...] trong URL (đồ thị) → bảng Date, APR (%)."""
+    if block.get("kind") != "image":
+        return None
+    try:
+        qs = parse_qs(urlparse(block["url"]).query or "")
+        raw_series = (qs.get("series") or [None])[0]
+        if not raw_series:
+            return None
+        arr = json.loads(unquote(raw_series))
+        # kỳ vọng dạng [{"name":"...","data":[{"x":"2024-01-01","y":11.2}, ...]}]
+        if not isinstance(arr, list) or not arr:
+            return None
+        rows = []
+        for pt in (arr[0] or {}).get("data") or []:
+            x, y = pt.get("x"), pt.get("y")
+            if x is None or y is None:
+                continue
+            try:
+                rows.append([str(x), f"{float(y):.2f}"])
+            except Exception:
+                continue
+        return {"columns": ["Date", "APR (%)"], "rows": rows} if rows else None
+    except Exception:
+        return None
+
+
+def _parse_table_call(raw_obj: str) -> Optional[Dict[str, Any]]:
+    """Args của make_table_image({...}) in ra text (hỗ trợ 'headers'→'columns')."""
+    try:
+        payload = json.loads(raw_obj)
+    except Exception:
+        try:
+            payload = json.loads(re.sub(r"'", '"', raw_obj))
+        except Exception:
+            return None
+    if not isinstance(payload, dict):
+        return None
+    cols = payload.get("columns") or payload.get("headers") or []
+    rows = payload.get("rows") or payload.get("data") or []
+    try:
+        font_size = int(payload.get("font_size", 18))
+    except (TypeError, ValueError):
+        font_size = 18
+    return {
+        "columns": [str(c) for c in cols],
+        "rows": rows,
+        "title": payload.get("title"),
+        "theme": payload.get("theme", "light"),
+        "font_size": font_size,
+        "cell_padding": payload.get("cell_padding", [16, 10]),
+    }
+
+
+def code_table_call(block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """make_table_image({...}) nằm trong code fence."""
+    if block.get("kind") != "code" or "make_table_image" not in block["body"]:
+        return None
+    m = _INLINE.search(block["body"])
+    return _parse_table_call(m.group("obj")) if m and m.group("mti") else None
+
+
+def is_plot_code(block: Dict[str, Any]) -> bool:
+    if block.get("kind") != "code":
+        return False
+    low = block["body"].lower()
+    return any(k in low for k in _PLOT_MARKERS)
+
+
+def apr_from_python(block: Dict[str, Any]) -> Optional[float]:
+    """current_apr = 9.76 trong code python."""
+    m = re.search(r"current_apr\s*=\s*([0-9]+(?:\.[0-9]+)?)", block.get("body") or "")
+    return float(m.group(1)) if m else None
+
+
+def apr_value(text: str) -> Optional[float]:
+    """
+    Cố tìm 1 số APR % trong đoạn văn (EN/VN).
+    Ví dụ: 'APR is around 10.8%' hoặc 'APR hiện tại ~ 9,76%'.
+    """
+    if not text:
+        return None
+    m = re.search(r"(?i)\bapr\b[^0-9]{0,12}([0-9]+(?:\.[0-9]+)?)\s*%", text.replace(",", "."))
+    return float(m.group(1)) if m else None
+
+
+def table_candidate(blocks: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Block bảng đầu tiên: code fence chứa '|'/'+-' (ưu tiên) hoặc block 'table' ngoài fence."""
+    first_code = next((b for b in blocks if b["kind"] == "code"), None)
+    if first_code is not None and ("|" in first_code["body"] or "+-" in first_code["body"]):
+        return first_code
+    return next((b for b in blocks if b["kind"] == "table"), None)
+
+
+def table_text(block: Dict[str, Any]) -> str:
+    return (block.get("body") if block["kind"] == "code" else block["raw"]).strip()
+
+
+# ---------- bảng từ kết quả MCP có cấu trúc ----------
+_MAX_DATA_ROWS = 50
+
+
+def _records(data: Any) -> Optional[List[Dict[str, Any]]]:
+    """list các dict (hoặc dict bọc đúng 1 list dict, vd. {"validators": [...]}) → list dict."""
+    if isinstance(data, dict):
+        lists = [v for v in data.values() if isinstance(v, list) and v and isinstance(v[0], dict)]
+        data = lists[0] if len(lists) == 1 else None
+    if isinstance(data, list) and data and all(isinstance(r, dict) for r in data):
+        return data
+    return None
+
+
+def _cell(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, (dict, list)):
+        s = json.dumps(v, ensure_ascii=False, separators=(",", ":"), default=str)
+        return s if len(s) <= 60 else s[:60] + "…"
+    return str(v)
+
+
+def _col_key(s: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", str(s).lower())
+
+
+def data_table_for(columns: List[str], datas: List[Any], max_rows: int = _MAX_DATA_ROWS) -> Optional[Dict[str, Any]]:
+    """
+    Bảng model in ra có mọi cột khớp key của 1 result có cấu trúc (so khớp bỏ hoa/thường, ký tự lạ)
+    → {"columns": columns, "rows"} lấy từ object đó. Không khớp → None.
+    """
+    want = [_col_key(c) for c in columns]
+    if not want or not all(want):
+        return None
+    for data in datas:
+        recs = _records(data)
+        if not recs:
+            continue
+        keys = {}
+        for r in recs[:max_rows]:
+            for k in r:
+                keys.setdefault(_col_key(k), k)
+        if all(w in keys for w in want):
+            src = [keys[w] for w in want]
+            return {"columns": list(columns), "rows": [[_cell(r.get(k)) for k in src] for r in recs[:max_rows]]}
+    return None
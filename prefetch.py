@@ -0,0 +1,166 @@
+# prefetch.py
+import re, json
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import METRICS
+
+# Prefetch MCP "đoán trước": với intent chắc chắn (địa chỉ ví → balance, tx hash → transaction,
+# APR → staking APR) gọi tool NGAY khi bắt đầu vòng 1 của Claude, song song với request LLM.
+# Nếu Claude đề xuất đúng tool + đúng args → dùng luôn kết quả (hit); khác → bỏ (wasted).
+# Kết quả lỗi của bridge ("[MCP] ..." busy/unavailable, is_error) không tính hit → chatbot gọi lại như thường.
+# Tool được chọn theo tên (từ khoá) + input_schema của tool MCP đang có, không hard-code server.
+#
+# Metric: mcp_prefetch_started / mcp_prefetch_hits / mcp_prefetch_wasted {intent=...}
+# Tắt bằng env MCP_PREFETCH=0.
+
+_RULES: List[Dict[str, Any]] = [
+    {
+        "intent": "balance",
+        "pattern": re.compile(r"\b(sei1[02-9ac-hj-np-z]{38,58}|0x[0-9a-fA-F]{40})\b"),
+        "tool_kw": ("balance",),
+        "arg_keys": ("address", "walletAddress", "account"),
+    },
+    {
+        "intent": "tx",
+        "pattern": re.compile(r"(?<![0-9a-fA-Fx])(0x[0-9a-fA-F]{64}|[0-9A-F]{64})(?![0-9a-fA-F])"),
+        "tool_kw": ("transaction", "_tx"),
+        "arg_keys": ("hash", "txHash", "transactionHash"),
+    },
+    {
+        "intent": "apr",
+        "pattern": re.compile(r"\bapr\b", re.I),
+        "tool_kw": ("apr",),
+        "arg_keys": (),
+    },
+]
+
+_MAX_PER_QUERY = 2
+
+
+def _canonical(args: Dict[str, Any]) -> str:
+    return json.dumps({k: v for k, v in (args or {}).items() if v is not None},
+                      sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _schema(tool: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    sch = tool.get("input_schema") or {}
+    return (sch.get("properties") or {}), list(sch.get("required") or [])
+
+
+def _pick_tool(rule: Dict[str, Any], value: Optional[str], tools: List[Dict[str, Any]]) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """Tool khớp từ khoá, điền được mọi field required → (name, args). Ưu tiên tên ngắn nhất (get_balance > get_erc20_balance)."""
+    best = None
+    for t in tools:
+        name = t.get("name") or ""
+        low = name.lower()
+        if not any(k in low for k in rule["tool_kw"]):
+            continue
+        props, required = _schema(t)
+        args: Dict[str, Any] = {}
+        if rule["arg_keys"]:
+            key = next((k for k in rule["arg_keys"] if k in props), None)
+            if key is None:
+                continue
+            args[key] = value
+        if any(r not in args for r in required):
+            continue
+        if best is None or len(name) < len(best[0]):
+            best = (name, args)
+    return best
+
+
+class PrefetchSet:
+    """Các prefetch của 1 lượt hỏi. take() khi Claude gọi tool; discard() khi xong lượt."""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[str, str], Tuple[str, Any]] = {}  # (tool, canonical args) -> (intent, future)
+
+    def add(self, intent: str, tool: str, args: Dict[str, Any], fut) -> None:
+        self._pending[(tool, _canonical(args))] = (intent, fut)
+        METRICS.inc("mcp_prefetch_started", intent=intent)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def take(self, tool: str, args: Dict[str, Any], timeout: Optional[float] = None,
+             deadline=None) -> Optional[Dict[str, Any]]:
+        """
+        Kết quả prefetch nếu khớp đúng tool + args (chờ tối đa `timeout` nếu chưa xong); None → gọi tool như thường.
+        Chờ quá hạn → huỷ call prefetch, trả lỗi timeout (không chạy lại call thứ 2 song song).
+        """
+        hit = self._pending.pop((tool, _canonical(args)), None)
+        if hit is None:
+            return None
+        intent, fut = hit
+        try:
+            out = fut.result(timeout)
+        except FutureTimeout:
+            fut.cancel()
+            METRICS.inc("mcp_prefetch_wasted", intent=intent)
+            if deadline is not None and deadline.expired():
+                deadline.expire("mcp")
+                return {"text": f"[MCP] {tool} cancelled: request deadline reached"}
+            return {"text": f"[MCP] {tool} timed out after {timeout or 0:g}s"}
+        except Exception as e:
+            print(f"[PREFETCH] {tool} failed: {type(e).__name__}: {e}")
+            METRICS.inc("mcp_prefetch_wasted", intent=intent)
+            return None
+        if not isinstance(out, dict) or out.get("is_error") or str(out.get("text") or "").startswith("[MCP]"):
+            METRICS.inc("mcp_prefetch_wasted", intent=intent)
+            return None
+        METRICS.inc("mcp_prefetch_hits", intent=intent)
+        return out
+
+    def discard(self) -> None:
+        # không huỷ call đang chạy (tránh làm rối session MCP) — chỉ bỏ kết quả
+        for intent, _fut in self._pending.values():
+            METRICS.inc("mcp_prefetch_wasted", intent=intent)
+        self._pending.clear()
+
+
+class Prefetcher:
+    def __init__(self, mcp, enabled: bool = True):
+        self.mcp = mcp
+        self.enabled = enabled
+
+    def plan(self, question: str, tools: List[Dict[str, Any]]) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """[(intent, tool, args)] cho câu hỏi — tối đa _MAX_PER_QUERY, không trùng."""
+        out: List[Tuple[str, str, Dict[str, Any]]] = []
+        seen = set()
+        for rule in _RULES:
+            for m in rule["pattern"].finditer(question or ""):
+                picked = _pick_tool(rule, m.group(1) if m.groups() else None, tools)
+                if picked is None:
+                    break
+                key = (picked[0], _canonical(picked[1]))
+                if key in seen:
+                    continue
+                seen.add(key)
+                out.append((rule["intent"], picked[0], picked[1]))
+                if len(out) >= _MAX_PER_QUERY:
+                    return out
+        return out
+
+    def start(self, question: str, tools: List[Dict[str, Any]]) -> PrefetchSet:
+        ps = PrefetchSet()
+        if not self.enabled or not tools:
+            return ps
+        for intent, tool, args in self.plan(question, tools):
+            fut = self.mcp.submit_tool(tool, args)
+            if fut is not None:
+                ps.add(intent, tool, args, fut)
+        return ps
+
+    def stats(self) -> Dict[str, Any]:
+        """Tổng + theo intent: started / hits / wasted / hit_rate."""
+        counters = METRICS.snapshot("mcp_prefetch_")["counters"]
+        by_intent: Dict[str, Dict[str, float]] = {}
+        for key, v in counters.items():
+            m = re.match(r"mcp_prefetch_(\w+)\{intent=(\w+)\}", key)
+            if m:
+                by_intent.setdefault(m.group(2), {"started": 0, "hits": 0, "wasted": 0})[m.group(1)] = v
+        total = {k: sum(d[k] for d in by_intent.values()) for k in ("started", "hits", "wasted")}
+        for d in [total, *by_intent.values()]:
+            d["hit_rate"] = (d["hits"] / d["started"]) if d["started"] else 0.0
+        return {**total, "by_intent": by_intent}
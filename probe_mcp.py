@@ -1,12 +1,259 @@
+# probe_mcp.py
+"""
+Đo latency / throughput tool MCP qua MCPBridge (số liệu để chỉnh pool, TTL cache, timeout).
+
+    python probe_mcp.py                                      # liệt kê tool + thời gian khởi động server
+    python probe_mcp.py -t sei_get_chain_info -n 50 -c 8     # 50 call, 8 song song
+    python probe_mcp.py -t 'sei_get_balance={"address": "sei1..."}' -t sei_get_chain_info -n 20
+    python probe_mcp.py --samples recordings/sei.jsonl -n 100 -c 16 --out run2.json --compare run1.json
+    python probe_mcp.py --cold-runs 5                        # khởi động lại bridge 5 lần, đo cold start
+
+-t TOOL[=JSON]: lặp lại được; cùng tool nhiều lần → các bộ args được dùng xoay vòng.
+--samples: JSON {"tool": [args, ...]} hoặc file JSONL từ MCP_RECORD (lấy args các call đã ghi).
+Mặc định bỏ qua cache của bridge (--cache để đo cả cache như cấu hình mcp.json).
+Lỗi = result bắt đầu bằng "[MCP]" (timeout, mất kết nối, lỗi tool...).
+"""
+import argparse, json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
 from mcp_bridge import MCPBridge
 
-b = MCPBridge("mcp.json")  # đổi đúng tên file JSON của bạn
-b.start()
-tools = b.anthropic_tools()
-print("TOOLS:", [t["name"] for t in tools])
-if tools:
-    # gọi thử tool đầu (nếu tool yêu cầu args, hãy xem tools[i]["input_schema"])
-    name = tools[0]["name"]
-    print("CALL:", name)
-    out = b.exec_tool(name, {})
-    print("RESULT:", out)
+
+def _pct(vals: List[float], p: float) -> float:
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(round(p / 100.0 * (len(vals) - 1))))]
+
+
+def _parse_tool_arg(spec: str) -> Tuple[str, Dict[str, Any]]:
+    name, sep, raw = spec.partition("=")
+    if not sep:
+        return name.strip(), {}
+    args = json.loads(raw)
+    if not isinstance(args, dict):
+        raise ValueError(f"args of {name} must be a JSON object")
+    return name.strip(), args
+
+
+def _load_samples(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """{"tool": [args, ...]} từ file JSON, hoặc từ record call_tool trong file JSONL (MCP_RECORD)."""
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        raw = f.read()
+    try:
+        obj = json.loads(raw)
+    except ValueError:
+        obj = None
+    if isinstance(obj, dict):
+        for tool, samples in obj.items():
+            out[tool] = [s for s in (samples if isinstance(samples, list) else [samples]) if isinstance(s, dict)]
+        return out
+    seen = set()
+    for line in raw.splitlines():
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(rec, dict) or rec.get("type") != "call_tool":
+            continue
+        name = f"{rec['server']}:{rec['tool']}"
+        key = (name, json.dumps(rec.get("args") or {}, sort_keys=True))
+        if key not in seen:
+            seen.add(key)
+            out.setdefault(name, []).append(rec.get("args") or {})
+    return out
+
+
+def _start_bridge(config: str) -> Tuple[MCPBridge, Dict[str, Any]]:
+    b = MCPBridge(config)
+    b.start()
+    return b, b.status()
+
+
+def _payload_bytes(out: Dict[str, Any]) -> int:
+    if out.get("spill_path"):
+        try:
+            return os.path.getsize(out["spill_path"])
+        except OSError:
+            pass
+    if out.get("image_path"):
+        try:
+            return os.path.getsize(out["image_path"])
+        except OSError:
+            return 0
+    return len((out.get("text") or "").encode("utf-8"))
+
+
+def _profile(b: MCPBridge, plan: Dict[str, List[Dict[str, Any]]], calls: int, concurrency: int,
+             warmup: int, timeout: Optional[float]) -> Dict[str, Any]:
+    """Chạy `calls` call / tool (sau `warmup` call bỏ qua), tối đa `concurrency` call cùng lúc."""
+
+    def _one(name: str, args: Dict[str, Any]) -> Tuple[str, float, bool, int, str]:
+        t0 = time.perf_counter()
+        out = b.exec_tool(name, args, timeout=timeout)
+        dt = time.perf_counter() - t0
+        txt = out.get("text") or ""
+        err = isinstance(txt, str) and txt.startswith("[MCP]")
+        return name, dt, err, 0 if err else _payload_bytes(out), txt[:200] if err else ""
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="probe") as ex:
+        if warmup > 0:
+            list(ex.map(lambda job: _one(*job), [(n, s[i % len(s)]) for n, s in plan.items() for i in range(warmup)]))
+        jobs = [(n, s[i % len(s)]) for i in range(calls) for n, s in plan.items()]  # xen kẽ các tool
+        t_start = time.perf_counter()
+        results = list(ex.map(lambda job: _one(*job), jobs))
+        wall = time.perf_counter() - t_start
+
+    tools: Dict[str, Any] = {}
+    for name in plan:
+        rows = [r for r in results if r[0] == name]
+        lat = [r[1] for r in rows]
+        ok_sizes = [r[3] for r in rows if not r[2]]
+        errors = [r[4] for r in rows if r[2]]
+        tools[name] = {
+            "calls": len(rows),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(rows), 4) if rows else 0.0,
+            "p50_s": round(_pct(lat, 50), 4),
+            "p95_s": round(_pct(lat, 95), 4),
+            "p99_s": round(_pct(lat, 99), 4),
+            "max_s": round(max(lat), 4) if lat else 0.0,
+            "bytes_p50": int(_pct(ok_sizes, 50)),
+            "bytes_max": max(ok_sizes) if ok_sizes else 0,
+            "sample_error": errors[0] if errors else None,
+        }
+    return {
+        "wall_s": round(wall, 3),
+        "throughput_per_s": round(len(results) / wall, 2) if wall > 0 else 0.0,
+        "tools": tools,
+    }
+
+
+def _print_report(run: Dict[str, Any]) -> None:
+    print("\nCold start (s):")
+    for srv, vals in run["cold_start"].items():
+        print(f"  {srv:<24} " + " ".join(f"{v:.2f}" if v is not None else "fail" for v in vals))
+    prof = run.get("profile")
+    if not prof:
+        return
+    print(f"\n{'tool':<40} {'n':>5} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'bytes p50':>10} {'bytes max':>10}")
+    for name, t in prof["tools"].items():
+        print(f"{name[:40]:<40} {t['calls']:>5} {t['error_rate'] * 100:>5.1f}% {t['p50_s']:>8.3f} {t['p95_s']:>8.3f} "
+              f"{t['p99_s']:>8.3f} {t['max_s']:>8.3f} {t['bytes_p50']:>10} {t['bytes_max']:>10}")
+        if t["sample_error"]:
+            print(f"    error: {t['sample_error']}")
+    print(f"\n{sum(t['calls'] for t in prof['tools'].values())} calls in {prof['wall_s']:.2f}s "
+          f"({prof['throughput_per_s']:.1f}/s) at concurrency {run['params']['concurrency']}")
+
+
+def _print_compare(base: Dict[str, Any], cur: Dict[str, Any]) -> None:
+    def _delta(a: float, b: float) -> str:
+        if not a:
+            return "   n/a"
+        return f"{(b - a) / a * 100:+6.1f}%"
+
+    print(f"\nCompare with {base.get('label') or 'base'} (latency: base → now, Δ):")
+    bt = (base.get("profile") or {}).get("tools") or {}
+    for name, t in ((cur.get("profile") or {}).get("tools") or {}).items():
+        o = bt.get(name)
+        if o is None:
+            print(f"  {name}: not in base run")
+            continue
+        print(f"  {name[:40]:<40} p50 {o['p50_s']:.3f}→{t['p50_s']:.3f} {_delta(o['p50_s'], t['p50_s'])}  "
+              f"p95 {o['p95_s']:.3f}→{t['p95_s']:.3f} {_delta(o['p95_s'], t['p95_s'])}  "
+              f"err {o['error_rate'] * 100:.1f}%→{t['error_rate'] * 100:.1f}%")
+    bp, cp = base.get("profile") or {}, cur.get("profile") or {}
+    if bp.get("throughput_per_s") and cp.get("throughput_per_s"):
+        print(f"  throughput {bp['throughput_per_s']:.1f}/s → {cp['throughput_per_s']:.1f}/s "
+              f"{_delta(bp['throughput_per_s'], cp['throughput_per_s'])}")
+    bc = base.get("cold_start") or {}
+    for srv, vals in (cur.get("cold_start") or {}).items():
+        old = [v for v in bc.get(srv, []) if v is not None]
+        new = [v for v in vals if v is not None]
+        if old and new:
+            print(f"  cold start {srv}: {_pct(old, 50):.2f}s → {_pct(new, 50):.2f}s {_delta(_pct(old, 50), _pct(new, 50))}")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="MCP tool latency / throughput profiler")
+    ap.add_argument("--config", default=os.getenv("MCP_SERVERS_CONFIG_PATH", "mcp.json"))
+    ap.add_argument("-t", "--tool", action="append", default=[], help="TOOL hoặc TOOL={json args}; lặp lại được")
+    ap.add_argument("--samples", default=None, help="JSON {tool: [args]} hoặc JSONL từ MCP_RECORD")
+    ap.add_argument("-n", "--calls", type=int, default=20, help="số call mỗi tool")
+    ap.add_argument("-c", "--concurrency", type=int, default=4)
+    ap.add_argument("--warmup", type=int, default=1, help="call khởi động mỗi tool (không tính)")
+    ap.add_argument("--timeout", type=float, default=None, help="timeout mỗi call (mặc định MCP_CALL_TIMEOUT)")
+    ap.add_argument("--cache", action="store_true", help="giữ cache/kho bất biến của bridge (mặc định tắt)")
+    ap.add_argument("--cold-runs", type=int, default=1, help="số lần khởi động bridge để đo cold start")
+    ap.add_argument("--out", default=None, help="ghi kết quả JSON (để --compare lần sau)")
+    ap.add_argument("--compare", default=None, help="file JSON của lần chạy trước")
+    ap.add_argument("--label", default=None, help="tên lần chạy (ghi vào --out)")
+    a = ap.parse_args(argv)
+
+    plan: Dict[str, List[Dict[str, Any]]] = {}
+    if a.samples:
+        for name, samples in _load_samples(a.samples).items():
+            plan.setdefault(name, []).extend(samples or [{}])
+    for spec in a.tool:
+        name, args = _parse_tool_arg(spec)
+        plan.setdefault(name, []).append(args)
+
+    # cold start: các lần trước khởi động rồi dừng ngay, lần cuối giữ lại để profile
+    cold: Dict[str, List[Optional[float]]] = {}
+    b = None
+    for i in range(max(1, a.cold_runs)):
+        if b is not None:
+            b.stop()
+        b, st = _start_bridge(a.config)
+        for srv, s in st["servers"].items():
+            cold.setdefault(srv, []).append(s.get("startup_s") if s.get("state") == "ready" else None)
+
+    tools = b.anthropic_tools()
+    run: Dict[str, Any] = {
+        "label": a.label or time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": {"calls": a.calls, "concurrency": a.concurrency, "warmup": a.warmup, "cache": a.cache},
+        "cold_start": cold,
+    }
+    sch = b.schema_stats()
+    run["schema"] = {k: sch[k] for k in ("tools", "before", "after", "saved_pct")}
+    try:
+        if not plan:
+            # token định nghĩa tool trước → sau schema_compactor (policy "schema" trong mcp.json)
+            by_san = {b.tool_name(full): s for full, s in sch["tools"].items()}
+            print("TOOLS:")
+            for t in tools:
+                req = (t.get("input_schema") or {}).get("required") or []
+                s = by_san.get(t["name"]) or {}
+                tok = f"  ~{s['before']}→{s['after']} tok" if s else ""
+                print(f"  {t['name']}{tok}" + (f"  (required: {', '.join(req)})" if req else ""))
+            print(f"  total schema tokens: ~{sch['before']} → ~{sch['after']} ({sch['saved_pct']}% saved)")
+        else:
+            unknown = [n for n in plan if b.tool_name(n) is None]
+            if unknown:
+                print(f"[PROBE] unknown tool(s): {', '.join(unknown)}", file=sys.stderr)
+                return 1
+            # gộp "server:tool" và tên sanitize về 1 key → so sánh được giữa các lần chạy
+            merged: Dict[str, List[Dict[str, Any]]] = {}
+            for n, samples in plan.items():
+                merged.setdefault(b.tool_name(n), []).extend(samples)
+            plan = merged
+            if not a.cache:
+                b.disable_cache()
+            run["profile"] = _profile(b, plan, max(1, a.calls), a.concurrency, a.warmup, a.timeout)
+        _print_report(run)
+        if a.compare:
+            with open(a.compare, "r", encoding="utf-8") as f:
+                _print_compare(json.load(f), run)
+        if a.out:
+            with open(a.out, "w", encoding="utf-8") as f:
+                json.dump(run, f, ensure_ascii=False, indent=2)
+            print(f"\n[PROBE] saved {a.out}")
+    finally:
+        b.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
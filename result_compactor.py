@@ -0,0 +1,136 @@
+# result_compactor.py
+import json, re
+from typing import Any, Dict, List, Optional, Union
+
+try:  # orjson (tuỳ chọn): parse/dump nhanh hơn json chuẩn nhiều lần với result MCP lớn
+    import orjson
+except ImportError:
+    orjson = None
+
+# Thu gọn kết quả MCP trước khi gửi vào vòng 2 của Claude:
+# - JSON compact (không indent) — result nằm trong ngân sách thì chỉ minify, không cắt, giữ cả field rỗng
+#   ("delegations": [] nghĩa là "không có"); bỏ field rỗng chỉ khi policy đặt "prune_empty" hoặc vượt ngân sách
+# - mảng dài → giữ max_items phần tử đầu + {"_omitted": n, "_total": N} (chỉ khi policy đặt max_items
+#   hoặc khi vượt ngân sách: lúc đó thu nhỏ dần từ DEFAULT_POLICY theo _SHRINK_STEPS)
+# - bỏ field rỗng; nếu tool có allowlist "fields" thì dict nào chứa field trong allowlist chỉ giữ các field đó
+# - ngân sách token cho TẤT CẢ tool result trong 1 lượt (chia đều kiểu water-filling)
+# Policy đọc từ mcp.json (per server):
+#   "compact": {"max_items": 20, "max_str": 400, "prune_empty": true, "fields": {"get_validators": ["moniker", "tokens"]}}
+
+DEFAULT_POLICY = {"max_items": 20, "max_str": 400, "prune_empty": True, "fields": None}
+
+# các nấc thu gọn dần khi 1 result vượt phần ngân sách của nó
+_SHRINK_STEPS = [(DEFAULT_POLICY["max_items"], DEFAULT_POLICY["max_str"]), (10, 200), (5, 120), (3, 80), (1, 60)]
+
+
+def estimate_tokens(s: str) -> int:
+    """Ước lượng token thô (~4 ký tự/token) — đủ để chia ngân sách, không cần tokenizer."""
+    return (len(s or "") + 3) // 4
+
+
+# orjson đọc số nguyên > 64-bit thành float (mất chính xác: số wei, usei...) → những text này dùng json chuẩn
+_BIG_INT = re.compile(rb"\d{20}")
+
+
+def loads_json(s: Union[str, bytes]) -> Any:
+    """json.loads, dùng orjson nếu có. Raise ValueError nếu không phải JSON."""
+    if orjson is not None:
+        raw = s.encode("utf-8") if isinstance(s, str) else s
+        if not _BIG_INT.search(raw):
+            return orjson.loads(raw)
+    return json.loads(s)
+
+
+def dumps_compact(obj: Any) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass  # số nguyên > 64-bit... → json chuẩn
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def compact_obj(obj: Any, *, max_items: int = 20, max_str: int = 400, fields: Optional[List[str]] = None,
+                prune_empty: bool = True) -> Any:
+    """max_items / max_str <= 0 = không giới hạn; prune_empty → bỏ field None/""/[]/{}."""
+    allow = set(fields or [])
+
+    def walk(o: Any) -> Any:
+        if isinstance(o, dict):
+            items = o.items()
+            if allow:
+                keep = [(k, v) for k, v in o.items() if k in allow]
+                if keep:
+                    items = keep
+            if prune_empty:
+                return {k: walk(v) for k, v in items if v is not None and v != "" and v != [] and v != {}}
+            return {k: walk(v) for k, v in items}
+        if isinstance(o, list):
+            n = len(o)
+            if 0 < max_items < n:
+                return [walk(x) for x in o[:max_items]] + [{"_omitted": n - max_items, "_total": n}]
+            return [walk(x) for x in o]
+        if isinstance(o, str) and 0 < max_str < len(o):
+            return o[:max_str] + "…"
+        return o
+
+    return walk(obj)
+
+
+def _parse_json(text: str) -> Optional[Any]:
+    s = (text or "").strip()
+    if not s or s[0] not in "[{":
+        return None
+    try:
+        return loads_json(s)
+    except Exception:
+        return None
+
+
+def compact_text(text: str, policy: Optional[Dict[str, Any]] = None, *, data: Any = None) -> str:
+    """
+    Thu gọn 1 result theo policy: chỉ cắt/bỏ theo key policy có đặt (max_items/max_str/fields/prune_empty),
+    thiếu → chỉ minify.
+    Text không phải JSON được giữ nguyên.
+    """
+    pol = policy or {}
+    obj = data if data is not None else _parse_json(text)
+    if obj is None:
+        return text
+    return dumps_compact(compact_obj(obj, max_items=int(pol.get("max_items") or 0), max_str=int(pol.get("max_str") or 0),
+                                     fields=pol.get("fields"), prune_empty=bool(pol.get("prune_empty"))))
+
+
+def _shrink(text: str, budget: int, policy: Optional[Dict[str, Any]], data: Any = None) -> str:
+    obj = data if data is not None else _parse_json(text)
+    if obj is not None:
+        fields = (policy or {}).get("fields")
+        for max_items, max_str in _SHRINK_STEPS:
+            out = dumps_compact(compact_obj(obj, max_items=max_items, max_str=max_str, fields=fields))
+            if estimate_tokens(out) <= budget:
+                return out
+        text = out
+    max_chars = max(0, budget * 4 - 20)
+    return text[:max_chars] + "\n…(đã rút gọn)" if len(text) > max_chars else text
+
+
+def apply_token_budget(entries: List[Dict[str, Any]], budget_tokens: int) -> List[Dict[str, Any]]:
+    """
+    entries: [{"text": str, "policy": dict|None, "data": Any (tuỳ chọn)}, ...] — sửa "text" tại chỗ.
+    Result nhỏ được giữ nguyên, phần dư chia đều cho các result lớn.
+    """
+    if budget_tokens <= 0 or not entries:
+        return entries
+    sizes = [estimate_tokens(e.get("text") or "") for e in entries]
+    if sum(sizes) <= budget_tokens:
+        return entries
+    order = sorted(range(len(entries)), key=lambda i: sizes[i])
+    remaining = budget_tokens
+    for pos, i in enumerate(order):
+        share = remaining // (len(order) - pos)
+        alloc = min(sizes[i], share)
+        if sizes[i] > alloc:
+            entries[i]["text"] = _shrink(entries[i]["text"], alloc, entries[i].get("policy"), entries[i].get("data"))
+            alloc = estimate_tokens(entries[i]["text"])
+        remaining = max(0, remaining - alloc)
+    return entries
@@ -0,0 +1,180 @@
+# schema_compactor.py
+import json, re
+from typing import Any, Dict, Optional, Tuple
+
+from result_compactor import dumps_compact, estimate_tokens
+
+# Thu gọn định nghĩa tool MCP (description + input_schema) trước khi gửi cho Claude — tool block
+# được gửi lại mỗi lượt nên chiếm phần lớn input token:
+# - cắt description của tool (max_desc) và của từng field (max_prop_desc) tại ranh giới câu/từ
+# - bỏ key không giúp model chọn/gọi tool: title, examples, default, $schema (policy "drop")
+#   (tên property trùng các key này vẫn giữ: chỉ bỏ key schema, không bỏ field)
+# - sub-schema lặp lại trong 1 tool → "$defs" + "$ref" (chỉ khi thực sự ngắn hơn)
+# Policy theo server trong mcp.json (false = giữ nguyên):
+#   "schema": {"max_desc": 400, "max_prop_desc": 160, "drop": ["title", "examples", "default", "$schema"],
+#              "dedupe": true, "tools": {"get_balance": {"description": "...", "max_desc": 600}}}
+
+DEFAULT_SCHEMA_POLICY: Dict[str, Any] = {
+    "max_desc": 400,
+    "max_prop_desc": 160,
+    "drop": ["title", "examples", "default", "$schema"],
+    "dedupe": True,
+}
+
+# key mà value là map tên → sub-schema (tên không phải keyword, không được bỏ)
+_NAME_MAPS = ("properties", "patternProperties", "$defs", "definitions")
+# key mà value là dữ liệu, không phải schema
+_DATA_KEYS = ("enum", "const", "required")
+_MIN_DEDUPE_CHARS = 60
+
+
+def truncate_desc(text: str, limit: int) -> str:
+    """Gộp khoảng trắng; dài hơn `limit` → cắt ở cuối câu (nếu còn ≥ nửa) hoặc cuối từ, thêm '…'."""
+    s = re.sub(r"\s+", " ", text or "").strip()
+    if limit <= 0 or len(s) <= limit:
+        return s
+    cut = s[:limit]
+    end = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    if end >= limit // 2:
+        return cut[:end + 1]
+    sp = cut.rfind(" ")
+    return (cut[:sp] if sp >= limit // 2 else cut).rstrip(" ,;:") + "…"
+
+
+def _strip(node: Any, drop: frozenset, max_prop_desc: int) -> Any:
+    if isinstance(node, list):
+        return [_strip(x, drop, max_prop_desc) for x in node]
+    if not isinstance(node, dict):
+        return node
+    out: Dict[str, Any] = {}
+    for k, v in node.items():
+        if k in drop:
+            continue
+        if k in _NAME_MAPS and isinstance(v, dict):
+            out[k] = {name: _strip(sub, drop, max_prop_desc) for name, sub in v.items()}
+        elif k in _DATA_KEYS:
+            out[k] = v
+        elif k == "description" and isinstance(v, str):
+            d = truncate_desc(v, max_prop_desc)
+            if d:
+                out[k] = d
+        else:
+            out[k] = _strip(v, drop, max_prop_desc)
+    return out
+
+
+def _collect(node: Any, name: str, seen: Dict[str, Tuple[str, int]], depth: int = 0) -> None:
+    """Đếm sub-schema (dict, trừ gốc) theo JSON chuẩn hoá: canon -> (tên gợi ý, số lần)."""
+    if isinstance(node, list):
+        for x in node:
+            _collect(x, name, seen, depth + 1)
+        return
+    if not isinstance(node, dict):
+        return
+    if depth > 0 and "$ref" not in node:
+        canon = json.dumps(node, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        if len(canon) >= _MIN_DEDUPE_CHARS:
+            hint, n = seen.get(canon, (name, 0))
+            seen[canon] = (hint, n + 1)
+    for k, v in node.items():
+        if k in _NAME_MAPS and isinstance(v, dict):
+            for pname, sub in v.items():
+                _collect(sub, pname, seen, depth + 1)
+        elif k not in _DATA_KEYS:
+            _collect(v, name, seen, depth + 1)
+
+
+def _replace(node: Any, canon: str, ref: Dict[str, str], depth: int = 0) -> Any:
+    if isinstance(node, list):
+        return [_replace(x, canon, ref, depth + 1) for x in node]
+    if not isinstance(node, dict):
+        return node
+    if depth > 0 and json.dumps(node, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str) == canon:
+        return dict(ref)
+    out = {}
+    for k, v in node.items():
+        if k in _NAME_MAPS and isinstance(v, dict):
+            out[k] = {pname: _replace(sub, canon, ref, depth + 1) for pname, sub in v.items()}
+        elif k in _DATA_KEYS:
+            out[k] = v
+        else:
+            out[k] = _replace(v, canon, ref, depth + 1)
+    return out
+
+
+def dedupe_subschemas(schema: Dict[str, Any], max_defs: int = 8) -> Dict[str, Any]:
+    """Sub-schema giống hệt xuất hiện ≥ 2 lần → 1 bản trong "$defs", các chỗ dùng thành {"$ref"}."""
+    if not isinstance(schema, dict):
+        return schema
+    for _ in range(max_defs):
+        seen: Dict[str, Tuple[str, int]] = {}
+        _collect({k: v for k, v in schema.items() if k != "$defs"}, "def", seen)
+        best: Optional[Tuple[int, str, str]] = None
+        for canon, (hint, n) in seen.items():
+            saving = (n - 1) * len(canon) - n * (len(hint) + 20)   # ≈ độ dài {"$ref":"#/$defs/<hint>"}
+            if n >= 2 and saving > 0 and (best is None or saving > best[0]):
+                best = (saving, canon, hint)
+        if best is None:
+            break
+        _, canon, hint = best
+        defs = dict(schema.get("$defs") or {})
+        key = re.sub(r"[^A-Za-z0-9_]", "_", hint) or "def"
+        base, i = key, 2
+        while key in defs:
+            key, i = f"{base}{i}", i + 1
+        ref = {"$ref": f"#/$defs/{key}"}
+        schema = _replace({k: v for k, v in schema.items() if k != "$defs"}, canon, ref)
+        defs[key] = json.loads(canon)
+        schema["$defs"] = defs
+    return schema
+
+
+def tool_tokens(meta: Dict[str, Any]) -> int:
+    """Ước lượng token của 1 định nghĩa tool (JSON compact)."""
+    return estimate_tokens(dumps_compact(meta))
+
+
+def schema_policy(server_cfg: Any, tool: str) -> Optional[Dict[str, Any]]:
+    """Policy hiệu lực cho 1 tool: mặc định ← "schema" của server ← "tools"[tool]. None = tắt."""
+    if server_cfg is False:
+        return None
+    cfg = server_cfg if isinstance(server_cfg, dict) else {}
+    pol = {**DEFAULT_SCHEMA_POLICY, **{k: v for k, v in cfg.items() if k != "tools"}}
+    override = (cfg.get("tools") or {}).get(tool)
+    if override is False:
+        return None
+    if isinstance(override, dict):
+        pol.update(override)
+    return pol
+
+
+def compact_tool(meta: Dict[str, Any], policy: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], int, int]:
+    """meta {"name", "description", "input_schema"} → (meta thu gọn, token trước, token sau)."""
+    before = tool_tokens(meta)
+    if policy is None:
+        return meta, before, before
+    out = dict(meta)
+    desc = policy.get("description")
+    out["description"] = truncate_desc(desc if isinstance(desc, str) else meta.get("description") or "",
+                                       int(policy.get("max_desc") or 0))
+    schema = meta.get("input_schema")
+    if isinstance(schema, dict):
+        drop = frozenset(str(k) for k in (policy.get("drop") or ()))
+        schema = _strip(schema, drop, int(policy.get("max_prop_desc") or 0))
+        if policy.get("dedupe", True):
+            schema = dedupe_subschemas(schema)
+        schema.setdefault("type", "object")
+        out["input_schema"] = schema
+    after = tool_tokens(out)
+    if after > before:   # không bao giờ làm dài hơn (vd. $defs không đáng)
+        return meta, before, before
+    return out, before, after
+
+
+def summarize(stats: Dict[str, Dict[str, int]]) -> Dict[str, Any]:
+    """Tổng token trước/sau của nhiều tool: {"tools", "before", "after", "saved_pct"}."""
+    before = sum(s["before"] for s in stats.values())
+    after = sum(s["after"] for s in stats.values())
+    return {"tools": len(stats), "before": before, "after": after,
+            "saved_pct": round((1 - after / before) * 100, 1) if before else 0.0}
+
@@ -0,0 +1,7 @@
+# tests/conftest.py
+import os, sys
+
+# module của repo nằm ở thư mục gốc (không phải package) → thêm vào sys.path cho test
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,110 @@
+# tests/test_admission.py
+import asyncio
+
+import pytest
+
+from admission import PRIORITIES, AdmissionRejected, PriorityLimiter, priority_of
+
+
+def test_priority_of():
+    assert priority_of("high") < priority_of("normal") < priority_of("low")
+    assert priority_of("LOW") == PRIORITIES["low"]
+    assert priority_of(None) == PRIORITIES["normal"]
+    assert priority_of(5) == 5
+
+
+def test_slots_go_to_highest_priority_then_fifo():
+    async def main():
+        lim = PriorityLimiter(limit=1, max_queue=10)
+        await lim.acquire()
+        order = []
+
+        async def waiter(tag, prio):
+            await lim.acquire(PRIORITIES[prio])
+            order.append(tag)
+            lim.release()
+
+        tasks = [asyncio.create_task(waiter(t, p)) for t, p in
+                 [("low1", "low"), ("n1", "normal"), ("high1", "high"), ("n2", "normal")]]
+        await asyncio.sleep(0)
+        assert lim.stats() == {"active": 1, "limit": 1, "queued": 4, "max_queue": 10}
+        lim.release()
+        await asyncio.gather(*tasks)
+        assert order == ["high1", "n1", "n2", "low1"]
+        assert lim.stats()["active"] == 0
+
+    asyncio.run(main())
+
+
+def test_full_queue_rejects_immediately():
+    async def main():
+        lim = PriorityLimiter(limit=1, max_queue=1)
+        await lim.acquire()
+        t = asyncio.create_task(lim.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as ei:
+            await lim.acquire()
+        assert ei.value.reason == "full" and ei.value.queued == 1
+        lim.release()
+        await t
+        assert lim.active == 1
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_rejects_and_leaves_queue():
+    async def main():
+        lim = PriorityLimiter(limit=1, max_queue=4)
+        await lim.acquire()
+        with pytest.raises(AdmissionRejected) as ei:
+            await lim.acquire(timeout=0.05)
+        assert ei.value.reason == "timeout"
+        assert lim.queued == 0 and lim.active == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_hands_slot_to_next():
+    async def main():
+        lim = PriorityLimiter(limit=1, max_queue=4)
+        await lim.acquire()
+        first = asyncio.create_task(lim.acquire(PRIORITIES["high"]))
+        second = asyncio.create_task(lim.acquire(PRIORITIES["low"]))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        lim.release()
+        await asyncio.wait_for(second, 1)
+        assert first.cancelled()
+        assert lim.active == 1 and lim.queued == 0
+
+    asyncio.run(main())
+
+
+def test_cancel_after_slot_granted_releases_it():
+    async def main():
+        lim = PriorityLimiter(limit=1, max_queue=4)
+        await lim.acquire()
+        granted = asyncio.create_task(lim.acquire())
+        nxt = asyncio.create_task(lim.acquire())
+        await asyncio.sleep(0)
+        lim.release()            # slot trao cho `granted` ...
+        granted.cancel()         # ... nhưng caller bị huỷ trước khi kịp chạy → slot sang `nxt`
+        await asyncio.wait_for(nxt, 1)
+        assert lim.active == 1 and lim.queued == 0
+
+    asyncio.run(main())
+
+
+def test_wake_after_limit_raised():
+    async def main():
+        lim = PriorityLimiter(limit=1, max_queue=4)
+        await lim.acquire()
+        t = asyncio.create_task(lim.acquire())
+        await asyncio.sleep(0)
+        lim.limit = 2
+        lim.wake()
+        await asyncio.wait_for(t, 1)
+        assert lim.active == 2
+
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+# tests/test_llm_retry.py
+import time
+
+import pytest
+
+from llm_retry import CircuitBreaker, OverloadedError, RetryEngine, is_overloaded, is_transient
+
+
+class Overloaded(Exception):
+    status_code = 529
+
+
+class Flaky(Exception):
+    status_code = 502
+
+
+def _open(cooldown=0.05, **kw):
+    br = CircuitBreaker(threshold=1, cooldown=cooldown, **kw)
+    br.record_overload()
+    assert br.state() == "open"
+    return br
+
+
+def test_classifiers():
+    assert is_overloaded(Overloaded("Overloaded"))
+    assert is_transient(Flaky("bad gateway")) and not is_overloaded(Flaky("bad gateway"))
+    e = Flaky("bad gateway")
+    e.partial_output = True
+    assert not is_transient(e)
+
+
+def test_open_breaker_sheds_when_wait_exceeds_queue_limit():
+    br = _open(cooldown=30, max_queue_wait=1)
+    with pytest.raises(OverloadedError):
+        br.admission_wait()
+
+
+def test_half_open_admits_exactly_one_probe():
+    br = _open()
+    assert br.admission_wait() > 0          # còn mở → phải chờ
+    time.sleep(0.06)
+    assert br.state() == "half_open"
+    assert br.admission_wait() == 0.0       # probe
+    assert br.admission_wait() > 0          # các request khác chờ kết quả probe
+    br.record_success()
+    assert br.state() == "closed"
+    assert br.admission_wait() == 0.0 and br.admission_wait() == 0.0
+
+
+def test_failed_probe_reopens():
+    br = _open()
+    time.sleep(0.06)
+    assert br.admission_wait() == 0.0
+    br.record_overload()
+    assert br.state() == "open"
+
+
+def test_probe_timeout_lets_another_request_probe():
+    br = _open(probe_timeout=0.05)
+    time.sleep(0.06)
+    assert br.admission_wait() == 0.0
+    time.sleep(0.06)                        # probe không báo kết quả
+    assert br.admission_wait() == 0.0
+
+
+def test_end_probe_keeps_half_open():
+    br = _open()
+    time.sleep(0.06)
+    assert br.admission_wait() == 0.0
+    br.end_probe()
+    assert br.state() == "half_open"
+    assert br.admission_wait() == 0.0       # request sau thăm dò tiếp
+
+
+def test_retry_engine_retries_transient_then_succeeds():
+    eng = RetryEngine(CircuitBreaker(), base=0.001)
+    n = [0]
+
+    def fn():
+        n[0] += 1
+        if n[0] < 3:
+            raise Flaky("bad gateway")
+        return "ok"
+
+    assert eng.call(fn) == "ok" and n[0] == 3
+    assert eng.breaker.state() == "closed"
+
+
+def test_retry_engine_never_retries_partial_stream():
+    br = CircuitBreaker(threshold=1, cooldown=30)
+    eng = RetryEngine(br, base=0.001)
+    n = [0]
+
+    def fn():
+        n[0] += 1
+        e = Overloaded("Overloaded")
+        e.partial_output = True
+        raise e
+
+    with pytest.raises(Overloaded):
+        eng.call(fn)
+    assert n[0] == 1
+    assert br.state() == "open"             # quá tải vẫn được ghi nhận
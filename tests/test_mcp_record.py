@@ -0,0 +1,80 @@
+# tests/test_mcp_record.py
+# Ghi 1 phiên MCP thật (server FastMCP nhỏ) bằng MCP_RECORD rồi replay qua fake_mcp.py:
+# kết quả exec_tool phải giống hệt lúc ghi, cache của bridge hoạt động như với server thật.
+import json, os, sys
+
+import pytest
+
+pytest.importorskip("mcp")
+
+from mcp_bridge import MCPBridge
+from mcp_record import load_recording
+from metrics import METRICS
+
+SERVER = '''
+from mcp.server.fastmcp import FastMCP
+m = FastMCP("rec")
+
+@m.tool()
+def get_balance(address: str) -> str:
+    "Balance of an address"
+    return '{"address": "%s", "balance": "%d"}' % (address, len(address) * 1000)
+
+@m.tool()
+def get_chain_info() -> str:
+    "Chain info"
+    return '{"chain_id": "pacific-1", "height": 123}'
+
+if __name__ == "__main__":
+    m.run()
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALLS = [("sei_get_balance", {"address": "sei1abc"}), ("sei_get_balance", {"address": "sei1xyz00"}),
+         ("sei_get_chain_info", {})]
+
+
+def _write_cfg(path, spec):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"mcpServers": {"sei": spec}}, f)
+    return str(path)
+
+
+def _run(cfg, calls):
+    b = MCPBridge(cfg)
+    b.start()
+    try:
+        assert b.wait_ready(30)
+        return [b.exec_tool(name, args) for name, args in calls]
+    finally:
+        b.stop()
+
+
+def test_record_then_replay(tmp_path, monkeypatch):
+    srv = tmp_path / "srv.py"
+    srv.write_text(SERVER, encoding="utf-8")
+    rec = tmp_path / "rec.jsonl"
+
+    # 1) ghi
+    monkeypatch.setenv("MCP_RECORD", str(rec))
+    recorded = _run(_write_cfg(tmp_path / "live.json", {"command": sys.executable, "args": [str(srv)]}), CALLS)
+    monkeypatch.delenv("MCP_RECORD")
+    assert [json.loads(r["text"])["balance"] for r in recorded[:2]] == ["7000", "9000"]
+
+    recording = load_recording(str(rec))
+    assert {t["name"] for t in recording.tools} == {"get_balance", "get_chain_info"}
+    assert sum(len(v) for v in recording.calls.values()) == len(CALLS)
+
+    # 2) replay qua fake_mcp (có cache) — gọi mỗi call 2 lần
+    replay_cfg = _write_cfg(tmp_path / "replay.json", {
+        "command": sys.executable, "args": [os.path.join(ROOT, "fake_mcp.py"), str(rec), "--strict"],
+        "cache": {"default_ttl": 60},
+    })
+    hits0 = METRICS.get("mcp_cache_hits", tool="sei_get_balance")
+    misses0 = METRICS.get("mcp_cache_misses", tool="sei_get_balance")
+    replayed = _run(replay_cfg, CALLS + CALLS)
+
+    assert [r["text"] for r in replayed] == [r["text"] for r in recorded] * 2
+    assert replayed[0]["data"] == {"address": "sei1abc", "balance": "7000"}
+    assert METRICS.get("mcp_cache_misses", tool="sei_get_balance") - misses0 == 2
+    assert METRICS.get("mcp_cache_hits", tool="sei_get_balance") - hits0 == 2
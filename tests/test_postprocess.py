@@ -0,0 +1,47 @@
+# tests/test_postprocess.py
+import postprocess as pp
+
+ANSWER = """Số dư của ví:
+
+| token | amount |
+|-------|--------|
+| SEI   | 12.5   |
+
+![chart](https://quickchart.io/chart?c=%7B%7D)
+make_table_image({"columns": ["a", "b"], "rows": [[1, 2]]})
+sei:get_balance(address=sei1abc)
+```python
+import matplotlib.pyplot as plt
+plt.plot([1, 2])
+```
+Xong.
+"""
+
+
+def test_parse_answer_round_trip():
+    blocks = pp.parse_answer(ANSWER)
+    assert "".join(b["raw"] for b in blocks) == ANSWER
+    assert [b["kind"] for b in blocks if b["kind"] != "prose"] == ["table", "image", "tool_call", "tool_call", "code"]
+
+
+def test_parse_answer_blocks():
+    blocks = pp.parse_answer(ANSWER)
+    by_kind = {}
+    for b in blocks:
+        by_kind.setdefault(b["kind"], []).append(b)
+    assert by_kind["image"][0]["url"].startswith("https://quickchart.io/")
+    assert by_kind["tool_call"][0]["args"] is not None
+    assert by_kind["tool_call"][1]["args"] is None
+    assert by_kind["code"][0]["lang"] == "python" and pp.is_plot_code(by_kind["code"][0])
+
+
+def test_short_table_and_unclosed_fence_stay_prose():
+    text = "| a |\n| b |\nkết thúc\n```python\nx = 1\n"
+    blocks = pp.parse_answer(text)
+    assert [b["kind"] for b in blocks] == ["prose"]
+    assert pp.render_blocks(blocks) == text.strip()
+
+
+def test_empty():
+    assert pp.parse_answer("") == []
+    assert pp.render_blocks([]) == ""
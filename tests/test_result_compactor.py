@@ -0,0 +1,44 @@
+# tests/test_result_compactor.py
+import json
+
+from result_compactor import apply_token_budget, compact_text, estimate_tokens
+
+ROWS = [{"moniker": f"val{i}", "tokens": str(i * 1000), "jailed": None, "delegations": []} for i in range(200)]
+
+
+def _entry(data, policy=None):
+    return {"text": compact_text("", policy or {}, data=data), "policy": policy or {}, "data": data}
+
+
+def test_empty_policy_only_minifies():
+    data = {"delegations": [], "note": None, "rows": list(range(50))}
+    assert json.loads(compact_text(json.dumps(data, indent=2), {})) == data
+
+
+def test_policy_caps_and_prunes():
+    out = json.loads(compact_text("", {"max_items": 2, "prune_empty": True}, data=ROWS))
+    assert out[:2] == [{"moniker": "val0", "tokens": "0"}, {"moniker": "val1", "tokens": "1000"}]
+    assert out[2] == {"_omitted": 198, "_total": 200}
+
+
+def test_under_budget_untouched():
+    entries = [_entry({"a": [], "b": list(range(30))})]
+    before = entries[0]["text"]
+    apply_token_budget(entries, 10_000)
+    assert entries[0]["text"] == before
+
+
+def test_over_budget_shrinks_large_and_keeps_small():
+    small = _entry({"height": 123})
+    big = _entry(ROWS)
+    entries = apply_token_budget([small, big], 400)
+    assert small["text"] == '{"height":123}'
+    assert estimate_tokens(big["text"]) <= 400
+    assert '"_omitted"' in big["text"]
+    assert sum(estimate_tokens(e["text"]) for e in entries) <= 400
+
+
+def test_non_json_over_budget_is_cut():
+    e = {"text": "x" * 4000, "policy": None}
+    apply_token_budget([e], 100)
+    assert estimate_tokens(e["text"]) <= 100 and e["text"].endswith("(đã rút gọn)")
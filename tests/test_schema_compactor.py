@@ -0,0 +1,48 @@
+# tests/test_schema_compactor.py
+from schema_compactor import compact_tool, dedupe_subschemas, schema_policy, tool_tokens, truncate_desc
+
+ADDR = {"type": "string", "description": "A sei1 bech32 or 0x EVM address of the account to look up", "pattern": "^(sei1|0x)"}
+
+
+def test_truncate_desc():
+    assert truncate_desc("  a   b  ", 10) == "a b"
+    assert truncate_desc("First sentence here. Second one is long.", 30) == "First sentence here."
+    assert truncate_desc("word " * 20, 22).endswith("…")
+
+
+def test_dedupe_moves_repeats_to_defs():
+    schema = {"type": "object", "properties": {"from": dict(ADDR), "to": dict(ADDR), "amount": {"type": "string"}}}
+    out = dedupe_subschemas(schema)
+    assert out["properties"]["from"] == out["properties"]["to"]
+    assert "$ref" in out["properties"]["from"]
+    key = out["properties"]["from"]["$ref"].rsplit("/", 1)[1]
+    assert out["$defs"][key] == ADDR
+
+
+def test_dedupe_skips_single_use():
+    schema = {"type": "object", "properties": {"from": dict(ADDR)}}
+    assert dedupe_subschemas(schema) == schema
+
+
+def test_compact_drops_keys_but_not_properties_named_like_them():
+    meta = {"name": "t", "description": "d", "input_schema": {
+        "type": "object", "title": "T", "$schema": "x",
+        "properties": {"title": {"type": "string", "title": "Title", "default": "a", "examples": ["b"]}}}}
+    out, before, after = compact_tool(meta, schema_policy({}, "t"))
+    assert out["input_schema"] == {"type": "object", "properties": {"title": {"type": "string"}}}
+    assert after < before
+
+
+def test_never_longer():
+    # thêm "type": "object" làm schema dài hơn → giữ nguyên bản gốc
+    meta = {"name": "t", "description": "short", "input_schema": {}}
+    out, before, after = compact_tool(meta, schema_policy({}, "t"))
+    assert out is meta and after == before == tool_tokens(meta)
+
+
+def test_policy_off_and_override():
+    assert schema_policy(False, "t") is None
+    assert schema_policy({"tools": {"t": False}}, "t") is None
+    pol = schema_policy({"max_desc": 10, "tools": {"t": {"description": "custom"}}}, "t")
+    out, _, _ = compact_tool({"name": "t", "description": "original long text", "input_schema": {}}, pol)
+    assert out["description"] == "custom"
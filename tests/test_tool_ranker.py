@@ -0,0 +1,52 @@
+# tests/test_tool_ranker.py
+from tool_ranker import ToolRanker, expand_query, tokenize
+
+
+def _tool(name, desc, *props):
+    return {"name": name, "description": desc,
+            "input_schema": {"type": "object", "properties": {p: {"type": "string"} for p in props}}}
+
+
+TOOLS = [
+    _tool("sei_get_balance", "Get the native token balance of an address", "address"),
+    _tool("sei_get_transaction", "Get transaction details by hash", "hash"),
+    _tool("sei_get_latest_block", "Get the latest block height and time"),
+    _tool("sei_get_chain_info", "Get chain id and network status"),
+    _tool("sei_search_docs", "Search the SEI documentation"),
+    _tool("sei_get_delegations", "List staking delegations of a delegator", "address"),
+]
+
+
+def _names(r, idx):
+    return [r.names[i] for i in idx]
+
+
+def test_tokenize_and_expand():
+    assert tokenize("getLatestBlock_heights") == ["latest", "block", "height"]
+    assert "balance" in expand_query("số dư ví này là bao nhiêu?")
+
+
+def test_top_k_ranks_relevant_first():
+    r = ToolRanker(TOOLS)
+    assert _names(r, r.top_k("số dư của ví sei1 là bao nhiêu", 2))[0] == "sei_get_balance"
+    assert _names(r, r.top_k("block mới nhất", 1)) == ["sei_get_latest_block"]
+
+
+def test_must_always_included_first():
+    r = ToolRanker(TOOLS)
+    picked = _names(r, r.top_k("block mới nhất", 2, must=["sei_search_docs", "unknown_tool"]))
+    assert picked == ["sei_search_docs", "sei_get_latest_block"]
+
+
+def test_allowed_filters_and_k_zero_returns_all():
+    r = ToolRanker(TOOLS)
+    allowed = {"sei_get_balance", "sei_get_delegations"}
+    assert set(_names(r, r.top_k("block mới nhất", 1, allowed=allowed))) <= allowed
+    assert _names(r, r.top_k("x", 0)) == [t["name"] for t in TOOLS]
+    # tool bị lọc thì `must` cũng không đưa vào
+    assert "sei_search_docs" not in _names(r, r.top_k("docs", 1, must=["sei_search_docs"], allowed=allowed))
+
+
+def test_fills_in_registration_order_without_signal():
+    r = ToolRanker(TOOLS)
+    assert _names(r, r.top_k("zzz", 3)) == [t["name"] for t in TOOLS[:3]]
@@ -0,0 +1,114 @@
+# tool_ranker.py
+import math, re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set
+
+# Chọn top-k tool MCP liên quan tới câu hỏi (BM25 trên tên + description + tên field), không cần thư viện ngoài.
+# Index dựng 1 lần khi registry đổi (mcp_bridge._publish_registry) → mỗi câu hỏi chỉ tính điểm.
+# - tên tool nặng hơn description (_NAME_WEIGHT), tên field input_schema tính 1 lần
+# - câu hỏi tiếng Việt / địa chỉ / tx hash được thêm từ khoá tiếng Anh (_HINTS) vì description là tiếng Anh
+# - tool trong `must` (tên user gõ, tool prefetch) luôn có mặt; thiếu tín hiệu → bù theo thứ tự đăng ký
+
+_NAME_WEIGHT = 3
+_STOP = {
+    "a", "an", "the", "of", "for", "to", "in", "on", "and", "or", "by", "with", "is", "are", "be", "this",
+    "that", "it", "from", "as", "at", "get", "use", "tool", "mcp", "sei", "returns", "return", "given",
+}
+_HINTS = [
+    (re.compile(r"\b(sei1[02-9ac-hj-np-z]{38,58}|0x[0-9a-fA-F]{40})\b"), "address balance wallet account"),
+    (re.compile(r"(?<![0-9a-fA-Fx])(0x[0-9a-fA-F]{64}|[0-9A-F]{64})(?![0-9a-fA-F])"), "transaction hash tx receipt"),
+    (re.compile(r"số dư|còn bao nhiêu"), "balance"),
+    (re.compile(r"giao dịch"), "transaction tx"),
+    (re.compile(r"khối|block"), "block height"),
+    (re.compile(r"mới nhất|gần nhất|hiện tại"), "latest current"),
+    (re.compile(r"\bví\b|địa chỉ"), "address wallet account"),
+    (re.compile(r"hợp đồng"), "contract"),
+    (re.compile(r"phí|gas"), "fee gas"),
+    (re.compile(r"ủy thác|uỷ thác|stake|staking"), "delegation delegate staking validator"),
+    (re.compile(r"chuyển|gửi tiền"), "transfer send"),
+    (re.compile(r"mạng|chain|network"), "chain network info status"),
+    (re.compile(r"bảng|table"), "table image"),
+    (re.compile(r"tài liệu|docs?\b"), "docs search documentation"),
+]
+
+
+def _stem(w: str) -> str:
+    if len(w) > 4 and w.endswith("ies"):
+        return w[:-3] + "y"
+    if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+        return w[:-1]
+    return w
+
+
+def tokenize(text: str) -> List[str]:
+    """camelCase / snake_case / dấu câu → token thường đã bỏ số nhiều; bỏ stopword."""
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text or "")
+    return [_stem(w) for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in _STOP and len(w) > 1]
+
+
+def expand_query(query: str) -> str:
+    """Câu hỏi + từ khoá tiếng Anh suy ra từ mẫu (_HINTS)."""
+    low = (query or "").lower()
+    extra = [kw for pat, kw in _HINTS if pat.search(query or "") or pat.search(low)]
+    return " ".join([query or "", *extra])
+
+
+def _doc_tokens(meta: Dict[str, Any]) -> List[str]:
+    name = meta.get("name") or ""
+    props = ((meta.get("input_schema") or {}).get("properties") or {}) if isinstance(meta.get("input_schema"), dict) else {}
+    return tokenize(name) * _NAME_WEIGHT + tokenize(meta.get("description") or "") + tokenize(" ".join(props))
+
+
+class ToolRanker:
+    """Index BM25 bất biến trên danh sách tool (dict Anthropic: name/description/input_schema)."""
+
+    def __init__(self, metas: Sequence[Dict[str, Any]], k1: float = 1.2, b: float = 0.75):
+        self.names = [m.get("name") or "" for m in metas]
+        self._tf = [Counter(_doc_tokens(m)) for m in metas]
+        self._len = [sum(tf.values()) for tf in self._tf]
+        self._avg = (sum(self._len) / len(self._len)) if self._len else 0.0
+        df: Counter = Counter()
+        for tf in self._tf:
+            df.update(tf.keys())
+        n = len(self._tf)
+        self._idf = {t: math.log(1 + (n - d + 0.5) / (d + 0.5)) for t, d in df.items()}
+        self.k1, self.b = k1, b
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def scores(self, query: str) -> List[float]:
+        """Điểm BM25 của từng tool (cùng thứ tự với lúc dựng index)."""
+        q = set(tokenize(expand_query(query)))
+        out = []
+        for tf, ln in zip(self._tf, self._len):
+            s = 0.0
+            norm = self.k1 * (1 - self.b + self.b * ln / self._avg) if self._avg else self.k1
+            for t in q:
+                f = tf.get(t)
+                if f:
+                    s += self._idf[t] * f * (self.k1 + 1) / (f + norm)
+            out.append(s)
+        return out
+
+    def top_k(self, query: str, k: int, must: Iterable[str] = (), allowed: Optional[Set[str]] = None) -> List[int]:
+        """
+        Chỉ số tool được chọn: `must` trước, rồi theo điểm giảm dần, rồi (nếu còn chỗ) theo thứ tự đăng ký.
+        k <= 0 → mọi tool được phép. `allowed` lọc theo tên (None = tất cả).
+        """
+        ok = [i for i, nm in enumerate(self.names) if allowed is None or nm in allowed]
+        if k <= 0 or len(ok) <= k:
+            return ok
+        pos = {nm: i for i, nm in enumerate(self.names)}
+        ok_set = set(ok)
+        picked = [pos[nm] for nm in dict.fromkeys(must) if pos.get(nm) in ok_set]
+        sc = self.scores(query)
+        ranked = sorted((i for i in ok if sc[i] > 0), key=lambda i: -sc[i])
+        seen = set(picked)
+        for i in [*ranked, *ok]:
+            if len(picked) >= k:
+                break
+            if i not in seen:
+                seen.add(i)
+                picked.append(i)
+        return picked
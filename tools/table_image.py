@@ -1,8 +1,10 @@
 # tools/table_image.py
-import os, tempfile, time
+import io
 from typing import List, Any, Literal, Tuple
 from PIL import Image, ImageDraw, ImageFont
 
+from artifact_store import ARTIFACTS
+
 # ---- Font fallback: Arial -> Calibri -> DejaVu -> Noto -> default ----
 def _load_font(size: int):
     candidates = [
@@ -24,32 +26,6 @@ def _text_size(font: ImageFont.FreeTypeFont, text: str) -> Tuple[int, int]:
     bbox = font.getbbox(text or "")
     return (bbox[2] - bbox[0], bbox[3] - bbox[1])
 
-def _ensure_outdir_and_abs(filename: str | None) -> str:
-    """
-    - Nếu có filename:
-        + nếu là relative -> join vào ./out_images
-        + tạo thư mục nếu chưa có
-    - Nếu không có:
-        + tạo ./out_images/table_<ts>.png
-    Trả về path tuyệt đối.
-    """
-    if filename:
-        # nếu là path tương đối, ghi vào ./out_images
-        if not os.path.isabs(filename):
-            out_dir = os.path.join(os.getcwd(), "out_images")
-            os.makedirs(out_dir, exist_ok=True)
-            path = os.path.join(out_dir, filename)
-        else:
-            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
-            path = filename
-        return os.path.abspath(path)
-
-    # mặc định: ./out_images/table_<ts>.png (dễ debug hơn /tmp)
-    out_dir = os.path.join(os.getcwd(), "out_images")
-    os.makedirs(out_dir, exist_ok=True)
-    fname = f"table_{int(time.time()*1000)}.png"
-    return os.path.abspath(os.path.join(out_dir, fname))
-
 def render_table_image(
     columns: List[str],
     rows: List[List[Any]],
@@ -155,11 +131,10 @@ def render_table_image(
         outline=grid, width=1
     )
 
-    # ---- Chọn đường dẫn xuất (tuyệt đối) ----
-    out_path = _ensure_outdir_and_abs(out_path)
-
-    img.save(out_path, format="PNG")
-    return os.path.abspath(out_path)
+    # ---- Lưu vào kho artifact: tên theo nội dung (out_path chỉ dùng làm tiền tố tên) ----
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return ARTIFACTS.put_bytes(buf.getvalue(), prefix=out_path or "table", suffix=".png")
 
 MAKE_TABLE_IMAGE_TOOL_DEF = {
     "name": "make_table_image",
@@ -182,7 +157,7 @@ MAKE_TABLE_IMAGE_TOOL_DEF = {
                 "default": [16,10],
                 "description": "[pad_x, pad_y] pixels"
             },
-            "filename": {"type": "string", "description": "Optional output filename (relative -> ./out_images)."}
+            "filename": {"type": "string", "description": "Optional file name prefix (files are stored in the artifact directory)."}
         },
         "required": ["columns","rows"]
     }